@@ -3,7 +3,7 @@ from fastapi import APIRouter
 api_router = APIRouter()
 
 # Импорт и подключение роутеров для различных эндпоинтов
-from app.api.endpoints import parser, auth, chat, website_import # Добавили website_import
+from app.api.endpoints import parser, auth, chat, website_import, llm_stats # Добавили website_import
 
 api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
 api_router.include_router(parser.router, prefix="/parser", tags=["parser"])
@@ -11,3 +11,5 @@ api_router.include_router(parser.router, prefix="/parser", tags=["parser"])
 api_router.include_router(chat.router, prefix="/chat", tags=["chat"])
 # Добавляем новый роутер для импорта с сайта
 api_router.include_router(website_import.router, tags=["Website Import"]) # Префикс задан внутри роутера (/website-import)
+# Метрики LLM-слоя (кэш ответов и т.д.)
+api_router.include_router(llm_stats.router, prefix="/llm", tags=["LLM"])
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db import get_sql_db
 from app.schemas.user import UserCreate, Token
@@ -8,7 +8,7 @@ from app.services import auth, recaptcha
 router = APIRouter()
 
 @router.post("/register", response_model=Token)
-async def register(user: UserCreate, recaptcha_token: str, db: Session = Depends(get_sql_db)):
+async def register(user: UserCreate, recaptcha_token: str, db: AsyncSession = Depends(get_sql_db)):
     """Регистрация нового пользователя"""
     # Проверяем токен reCAPTCHA
     if not recaptcha.verify_recaptcha_token(recaptcha_token, "REGISTER"):
@@ -18,7 +18,7 @@ async def register(user: UserCreate, recaptcha_token: str, db: Session = Depends
         )
     
     # Создаем пользователя
-    db_user = auth.create_user(db, user)
+    db_user = await auth.create_user(db, user)
     
     # Создаем токен доступа
     access_token = auth.create_access_token(
@@ -28,9 +28,9 @@ async def register(user: UserCreate, recaptcha_token: str, db: Session = Depends
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.post("/token", response_model=Token)
-async def login(email: str, password: str, db: Session = Depends(get_sql_db)):
+async def login(email: str, password: str, db: AsyncSession = Depends(get_sql_db)):
     """Вход пользователя"""
-    user = auth.authenticate_user(db, email, password)
+    user = await auth.authenticate_user(db, email, password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
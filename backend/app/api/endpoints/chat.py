@@ -1,39 +1,183 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
-from sqlalchemy.orm import Session
-from typing import List, Dict, Any
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status, Body
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional
+import asyncio
 import base64
+import logging
 import requests
 from bs4 import BeautifulSoup
 
-from app.db import get_sql_db
-from app.db.models import Project, User, ChatMessage
+from app.core.llm_context import LLM_LONG_REQUEST_DEADLINE_SECONDS, LLM_REQUEST_DEADLINE_SECONDS, bind_llm_call_context, llm_deadline, run_with_deadline
+from app.db import get_sql_db, AsyncSessionLocal
+from app.db.models import Project, User, ChatMessage, UploadedFile
 from app.schemas.chat import ChatMessageCreate, ChatMessageResponse, ChatHistoryResponse
 from app.services import auth, gemini
+from app.services.chat_jobs import ChatJobQueueFull, chat_jobs
+from app.services.chat_history import CHAT_HISTORY_MAX_PAGE_SIZE, CHAT_HISTORY_PAGE_SIZE, InvalidCursorError, load_messages_page
+from app.services.conversation_memory import load_chat_context, update_conversation_summary
+from app.services.question_index import get_question_index, record_asked_questions
+from app.services.single_flight import single_flight
+from app.services.upload_stream import InvalidUpload, UploadTooLarge, receive_upload
+from app.services.llm_streaming import format_sse_event
 
-router = APIRouter()
+logger = logging.getLogger(__name__)
 
-@router.get("/{project_id}/messages", response_model=ChatHistoryResponse)
-async def get_chat_history(project_id: int, db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
-    """Получение истории сообщений чата для проекта"""
-    # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+router = APIRouter(dependencies=[Depends(llm_deadline())])
+
+# Режим хода: sync - ответ в теле запроса, job - сразу 202 с id задачи (services/chat_jobs)
+TurnMode = Literal["sync", "job"]
+_MODE_QUERY = Query(
+    "sync",
+    description="job - сразу вернуть 202 с id задачи; результат приходит в WebSocket /{project_id}/ws и доступен в GET /{project_id}/jobs/{job_id}",
+)
+
+def _compose_briefing_reply(briefing_data: Dict[str, Any], questions: List[str]) -> str:
+    """Формирует ответ ассистента по итогам хода брифинга"""
+    # Определяем, нужны ли уточняющие вопросы
+    if briefing_data["completion_percentage"] < 100:
+        # Формируем ответное сообщение с учетом процента заполнения
+        if briefing_data["completion_percentage"] >= 85:
+            # Если форма почти заполнена, предлагаем завершить
+            assistant_content = f"Мы уже собрали значительную часть информации ({briefing_data['completion_percentage']}%). "
+            assistant_content += "Вы можете перейти к следующему этапу или дополнить информацию, ответив на эти вопросы:\n\n"
+        else:
+            # Если форма заполнена менее чем на 85%, просим дополнить информацию
+            assistant_content = f"Я проанализировал информацию и обновил форму брифинга ({briefing_data['completion_percentage']}% заполнено). "
+            assistant_content += "Для более полного заполнения брифинга, пожалуйста, ответьте на следующие вопросы:\n\n"
+        
+        # Добавляем вопросы к сообщению
+        assistant_content += "\n\n".join(questions)
+        
+        # Если заполнено менее 50%, предлагаем альтернативные способы предоставления информации
+        if briefing_data["completion_percentage"] < 50:
+            assistant_content += "\n\nТакже вы можете загрузить КП/презентацию или указать ссылку на ваш сайт для более точного анализа."
+    else:
+        # Если форма заполнена полностью, сообщаем об этом
+        assistant_content = "Отлично! Все необходимые данные собраны (100%). Вы можете перейти к следующему этапу."
+        
+        # Если хотим показать краткую сводку собранной информации
+        assistant_content += "\n\nВот краткая сводка собранной информации:\n\n"
+        
+        if briefing_data.get("utp"):
+            assistant_content += f"✅ УТП: {briefing_data['utp']}\n\n"
+        
+        if briefing_data.get("product_description"):
+            # Ограничиваем длину для краткости
+            product_desc = briefing_data["product_description"]
+            if len(product_desc) > 150:
+                product_desc = product_desc[:150] + "..."
+            assistant_content += f"✅ Описание продукта: {product_desc}\n\n"
+        
+        assistant_content += "✅ Элементы воронки: "
+        if briefing_data.get("funnel_elements") and len(briefing_data["funnel_elements"]) > 0:
+            funnel_elements = [elem.get("name", "Этап") for elem in briefing_data["funnel_elements"]]
+            assistant_content += ", ".join(funnel_elements)
+        else:
+            assistant_content += "не определены"
     
-    if not project:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Проект не найден"
-        )
+    return assistant_content
+
+async def _apply_briefing_turn_result(db: AsyncSession, project: Project, analysis_result: Dict[str, Any]) -> str:
+    """Сохраняет результат хода брифинга в проект и возвращает текст ответа ассистента"""
+    if analysis_result["status"] == "success":
+        # Обновляем данные брифинга в проекте
+        briefing_data = analysis_result["data"]
+        briefing_data["completion_percentage"] = analysis_result["completion_percentage"]
+        
+        # Сохраняем саммари этапа (может быть использовано позже для передачи в следующие этапы)
+        if "stage_summary" in analysis_result:
+            briefing_data["stage_summary"] = analysis_result["stage_summary"]
+        
+        # Обновляем проект с новыми данными брифинга
+        project.briefing_data = briefing_data
+        await db.commit()
+        
+        assistant_content = _compose_briefing_reply(briefing_data, analysis_result.get("questions", []))
+    else:
+        # Если анализ не удался, отправляем общий ответ
+        assistant_content = "Я не смог проанализировать вашу информацию. Пожалуйста, предоставьте более подробные сведения о вашем продукте или услуге."
+        assistant_content += "\n\nВы также можете загрузить КП/презентацию или указать ссылку на ваш сайт для более точного анализа."
     
-    # Получаем сообщения чата для проекта
-    messages = db.query(ChatMessage).filter(ChatMessage.project_id == project_id).order_by(ChatMessage.created_at).all()
+    return assistant_content
+
+def _briefing_turn_error_reply(error: Exception) -> str:
+    """Текст ответа ассистента при ошибке обработки сообщения"""
+    return f"Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте еще раз или обратитесь в поддержку.\n\nТехническая информация: {str(error)}"
+
+async def _save_assistant_reply(db: AsyncSession, project: Project, assistant_content: str) -> Dict[str, Any]:
+    """Сохраняет ответ ассистента и формирует ответ эндпоинта в формате, который ожидает фронтенд"""
+    # Сохраняем ответ ассистента
+    assistant_message = ChatMessage(
+        project_id=project.id,
+        role="assistant",
+        content=assistant_content
+    )
     
-    return {"messages": messages}
+    db.add(assistant_message)
+    # Заданные в ответе вопросы попадают в индекс проекта вместе с сообщением
+    await record_asked_questions(db, project.id, assistant_content)
+    await db.commit()
+    await db.refresh(assistant_message)
+    
+    return {
+        "status": "success",
+        "message": {
+            "id": assistant_message.id,
+            "role": assistant_message.role,
+            "content": assistant_message.content,
+            "project": {
+                "id": project.id,
+                "briefing_data": project.briefing_data
+            }
+        }
+    }
 
-@router.post("/{project_id}/messages", response_model=Dict[str, Any])
-async def send_message(project_id: int, message: ChatMessageCreate, db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
-    """Отправка сообщения в чат и получение ответа от Gemini"""
+def _submit_turn_job(
+    project_id: int,
+    kind: str,
+    turn: Callable[[AsyncSession, Project], Awaitable[Dict[str, Any]]],
+    deadline_seconds: float = LLM_REQUEST_DEADLINE_SECONDS,
+    followup: Optional[Callable[[int], Awaitable[Any]]] = None,
+) -> JSONResponse:
+    """Ставит ход в очередь задач чата и возвращает ответ 202 с id задачи"""
+    async def run() -> Dict[str, Any]:
+        # Сессия запроса к началу выполнения уже закрыта, поэтому ход работает в собственной
+        async with AsyncSessionLocal() as job_db:
+            job_project = await job_db.get(Project, project_id)
+            if job_project is None:
+                raise LookupError(f"Проект {project_id} не найден")
+            return await turn(job_db, job_project)
+    
+    try:
+        job = chat_jobs.submit(project_id, kind, run, deadline_seconds=deadline_seconds, followup=followup)
+    except ChatJobQueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "5"}
+        )
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={"status": "accepted", "job_id": job.id, "job_status": job.status}
+    )
+
+@router.get("/{project_id}/messages", response_model=ChatHistoryResponse)
+async def get_chat_history(
+    project_id: int,
+    limit: int = Query(CHAT_HISTORY_PAGE_SIZE, ge=1, le=CHAT_HISTORY_MAX_PAGE_SIZE),
+    before: Optional[str] = Query(None, description="Курсор older_cursor: сообщения до него"),
+    since: Optional[str] = Query(None, description="Курсор newer_cursor: сообщения после него"),
+    db: AsyncSession = Depends(get_sql_db),
+    current_user: User = Depends(auth.get_current_user)
+):
+    """
+    Страница истории сообщений чата для проекта: без курсора - последние limit сообщений,
+    before - более старые, since - новые после курсора (инкрементальное обновление)
+    """
     # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not project:
         raise HTTPException(
@@ -41,164 +185,196 @@ async def send_message(project_id: int, message: ChatMessageCreate, db: Session
             detail="Проект не найден"
         )
     
+    try:
+        return await load_messages_page(db, project_id, limit=limit, before=before, since=since)
+    except InvalidCursorError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+async def _message_turn(db: AsyncSession, project: Project, content: str) -> Dict[str, Any]:
+    """Ход брифинга по сообщению пользователя: сообщение, вызов модели, ответ ассистента"""
+    project_id = project.id
+    
     # Сохраняем сообщение пользователя
     user_message = ChatMessage(
         project_id=project_id,
         role="user",
-        content=message.content
+        content=content
     )
     
     db.add(user_message)
-    db.commit()
-    db.refresh(user_message)
+    await db.commit()
     
-    # Получаем историю сообщений для контекста
-    chat_history = db.query(ChatMessage).filter(ChatMessage.project_id == project_id).order_by(ChatMessage.created_at).all()
+    # Контекст для модели: саммари ранней части диалога + сообщения, еще не вошедшие в него
+    chat_context = await load_chat_context(db, project)
+    asked_questions = await get_question_index(db, project_id)
+    # Соединение возвращается в пул на время вызова модели
+    await db.commit()
     
     # Получаем ответ от Gemini с учетом контекста
     try:
-        # Преобразуем историю чата в формат для Gemini
-        chat_context = []
-        for msg in chat_history:
-            chat_context.append({"role": msg.role, "content": msg.content})
-        
         # Получаем текущие данные брифинга из проекта
         current_briefing_data = project.briefing_data if project.briefing_data else {}
         
-        # Анализируем сообщение и обновляем брифинг с учетом контекста чата и текущих данных
-        analysis_result = gemini.analyze_expert_info(
-            text=message.content, 
+        # Анализируем сообщение, обновляем брифинг и получаем уточняющие вопросы за один вызов модели
+        analysis_result = await gemini.run_briefing_turn(
+            text=content, 
             chat_history=chat_context,
-            current_data=current_briefing_data
+            current_data=current_briefing_data,
+            conversation_summary=project.conversation_summary,
+            asked_questions=asked_questions
         )
         
-        if analysis_result["status"] == "success":
-            # Обновляем данные брифинга в проекте
-            briefing_data = analysis_result["data"]
-            briefing_data["completion_percentage"] = analysis_result["completion_percentage"]
-            
-            # Сохраняем саммари этапа (может быть использовано позже для передачи в следующие этапы)
-            if "stage_summary" in analysis_result:
-                briefing_data["stage_summary"] = analysis_result["stage_summary"]
-            
-            # Обновляем проект с новыми данными брифинга
-            project.briefing_data = briefing_data
-            db.commit()
-            
-            # Определяем, нужны ли уточняющие вопросы
-            if briefing_data["completion_percentage"] < 100:
-                # Генерируем уточняющие вопросы с учетом контекста
-                questions = gemini.generate_follow_up_questions(briefing_data, chat_context)
-                
-                # Формируем ответное сообщение с учетом процента заполнения
-                if briefing_data["completion_percentage"] >= 85:
-                    # Если форма почти заполнена, предлагаем завершить
-                    assistant_content = f"Мы уже собрали значительную часть информации ({briefing_data['completion_percentage']}%). "
-                    assistant_content += "Вы можете перейти к следующему этапу или дополнить информацию, ответив на эти вопросы:\n\n"
-                else:
-                    # Если форма заполнена менее чем на 85%, просим дополнить информацию
-                    assistant_content = f"Я проанализировал информацию и обновил форму брифинга ({briefing_data['completion_percentage']}% заполнено). "
-                    assistant_content += "Для более полного заполнения брифинга, пожалуйста, ответьте на следующие вопросы:\n\n"
-                
-                # Добавляем вопросы к сообщению
-                assistant_content += "\n\n".join(questions)
-                
-                # Если заполнено менее 50%, предлагаем альтернативные способы предоставления информации
-                if briefing_data["completion_percentage"] < 50:
-                    assistant_content += "\n\nТакже вы можете загрузить КП/презентацию или указать ссылку на ваш сайт для более точного анализа."
-            else:
-                # Если форма заполнена полностью, сообщаем об этом
-                assistant_content = "Отлично! Все необходимые данные собраны (100%). Вы можете перейти к следующему этапу."
-                
-                # Если хотим показать краткую сводку собранной информации
-                assistant_content += "\n\nВот краткая сводка собранной информации:\n\n"
-                
-                if briefing_data.get("utp"):
-                    assistant_content += f"✅ УТП: {briefing_data['utp']}\n\n"
-                
-                if briefing_data.get("product_description"):
-                    # Ограничиваем длину для краткости
-                    product_desc = briefing_data["product_description"]
-                    if len(product_desc) > 150:
-                        product_desc = product_desc[:150] + "..."
-                    assistant_content += f"✅ Описание продукта: {product_desc}\n\n"
-                
-                assistant_content += "✅ Элементы воронки: "
-                if briefing_data.get("funnel_elements") and len(briefing_data["funnel_elements"]) > 0:
-                    funnel_elements = [elem.get("name", "Этап") for elem in briefing_data["funnel_elements"]]
-                    assistant_content += ", ".join(funnel_elements)
-                else:
-                    assistant_content += "не определены"
-        else:
-            # Если анализ не удался, отправляем общий ответ
-            assistant_content = "Я не смог проанализировать вашу информацию. Пожалуйста, предоставьте более подробные сведения о вашем продукте или услуге."
-            assistant_content += "\n\nВы также можете загрузить КП/презентацию или указать ссылку на ваш сайт для более точного анализа."
+        assistant_content = await _apply_briefing_turn_result(db, project, analysis_result)
     
     except Exception as e:
         # В случае ошибки отправляем сообщение об ошибке
-        assistant_content = f"Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте еще раз или обратитесь в поддержку.\n\nТехническая информация: {str(e)}"
+        assistant_content = _briefing_turn_error_reply(e)
     
-    # Сохраняем ответ ассистента
-    assistant_message = ChatMessage(
-        project_id=project_id,
-        role="assistant",
-        content=assistant_content
-    )
+    # Сохраняем ответ ассистента и возвращаем обновленный проект вместе с сообщением
+    return await _save_assistant_reply(db, project, assistant_content)
+
+@router.post("/{project_id}/messages", response_model=Dict[str, Any])
+async def send_message(project_id: int, message: ChatMessageCreate, background_tasks: BackgroundTasks, mode: TurnMode = _MODE_QUERY, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+    """Отправка сообщения в чат и получение ответа от Gemini (mode=job - сразу 202 с id задачи)"""
+    # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
-    db.add(assistant_message)
-    db.commit()
-    db.refresh(assistant_message)
+    if not project:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Проект не найден"
+        )
+    bind_llm_call_context(project_id=project_id)
     
-    # Возвращаем обновленный проект вместе с сообщением
-    return {
-        "status": "success",
-        "message": {
-            "id": assistant_message.id,
-            "role": assistant_message.role,
-            "content": assistant_message.content,
-            "project": {
-                "id": project.id,
-                "briefing_data": project.briefing_data
-            }
-        }
-    }
+    if mode == "job":
+        return _submit_turn_job(project_id, "message", lambda job_db, job_project: _message_turn(job_db, job_project, message.content), followup=update_conversation_summary)
+    
+    # Саммари диалога обновляется после отправки ответа, вне пути запроса
+    background_tasks.add_task(update_conversation_summary, project_id)
+    
+    return await _message_turn(db, project, message.content)
 
-@router.post("/{project_id}/upload-file", response_model=Dict[str, Any])
-async def upload_file(project_id: int, file_content: str = Body(..., embed=True), db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
-    """Обработка загруженного файла"""
+@router.post("/{project_id}/messages/stream")
+async def send_message_stream(project_id: int, message: ChatMessageCreate, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+    """
+    Отправка сообщения в чат с потоковым ответом (server-sent events).
+    
+    События: token (фрагмент ответа модели), field/item (поле брифинга или этап воронки
+    получены целиком), done (сохраненное сообщение ассистента в том же формате, что и у
+    POST /{project_id}/messages).
+    """
     # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not project:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Проект не найден"
         )
+    bind_llm_call_context(project_id=project_id)
+    
+    # Сохраняем сообщение пользователя
+    user_message = ChatMessage(
+        project_id=project_id,
+        role="user",
+        content=message.content
+    )
+    
+    db.add(user_message)
+    await db.commit()
+    
+    # Получаем контекст диалога и текущие данные брифинга до начала потока
+    chat_context = await load_chat_context(db, project)
+    conversation_summary = project.conversation_summary
+    current_briefing_data = project.briefing_data if project.briefing_data else {}
+    asked_questions = await get_question_index(db, project_id)
+    await db.commit()
+    
+    async def event_stream():
+        # Сессия из зависимости может быть закрыта раньше, чем закончится поток,
+        # поэтому результат хода сохраняем в собственной сессии
+        stream_db = AsyncSessionLocal()
+        try:
+            stream_project = await stream_db.get(Project, project_id)
+            # Соединение возвращается в пул на время генерации ответа
+            await stream_db.commit()
+            try:
+                assistant_content = None
+                async for event in gemini.stream_briefing_turn(
+                    text=message.content,
+                    chat_history=chat_context,
+                    current_data=current_briefing_data,
+                    conversation_summary=conversation_summary,
+                    asked_questions=asked_questions
+                ):
+                    if event["event"] == "result":
+                        assistant_content = await _apply_briefing_turn_result(stream_db, stream_project, event["data"])
+                    else:
+                        yield format_sse_event(event["event"], event["data"])
+                if assistant_content is None:
+                    raise RuntimeError("Поток ответа модели завершился без результата")
+            except Exception as e:
+                logger.error(f"Ошибка потоковой обработки сообщения в проекте {project_id}: {e}")
+                assistant_content = _briefing_turn_error_reply(e)
+            
+            yield format_sse_event("done", await _save_assistant_reply(stream_db, stream_project, assistant_content))
+        finally:
+            await stream_db.close()
+    
+    # Саммари диалога обновляется после завершения потока
+    background_tasks.add_task(update_conversation_summary, project_id)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background_tasks
+    )
+
+def _skipped_document_note(analysis_result: Dict[str, Any]) -> str:
+    """Пометка в ответе ассистента, если конец документа не анализировался (лимит на документ)"""
+    skipped_tokens = analysis_result.get("skipped_tokens")
+    if not skipped_tokens:
+        return ""
+    return f"\n\n⚠️ Документ слишком большой: его окончание (~{skipped_tokens} токенов) не анализировалось. Если важная информация находится в конце, отправьте ее отдельным сообщением."
+
+async def _document_turn(
+    db: AsyncSession,
+    project: Project,
+    user_content: str,
+    read_text: Callable[[], str],
+    uploaded_file: Optional[UploadedFile] = None,
+) -> Dict[str, Any]:
+    """
+    Ход брифинга по загруженному документу: анализ текста, вопросы, ответ ассистента.
+    read_text() извлекает текст документа (ошибка извлечения дает ответ об ошибке формата);
+    uploaded_file сохраняется только после успешного анализа - неудачную загрузку можно повторить.
+    """
+    project_id = project.id
     
-    # Извлекаем содержимое файла из base64
     try:
-        # Предполагаем, что file_content приходит в формате data:application/pdf;base64,XXXXX...
-        file_data = file_content.split(',')[1] if ',' in file_content else file_content
-        
-        # Декодируем base64 - теоретически может обрабатывать документы
-        # Для простоты берем только первые 100000 символов
-        decoded_content = base64.b64decode(file_data).decode('utf-8', errors='ignore')[:100000]
+        # Документ передается целиком: большие документы анализируются по частям (см. gemini.analyze_document_content)
+        decoded_content = read_text()
         
         # Сохраняем сообщение пользователя о загрузке файла
         user_message = ChatMessage(
             project_id=project_id,
             role="user",
-            content=f"Загружен файл с содержимым типа {file_content.split(';')[0] if ';' in file_content else 'document'}"
+            content=user_content
         )
         
         db.add(user_message)
-        db.commit()
+        # Соединение возвращается в пул на время вызова модели
+        await db.commit()
         
         # Получаем текущие данные брифинга
         current_briefing_data = project.briefing_data if project.briefing_data else {}
         
         # Обрабатываем содержимое файла через Gemini API
-        analysis_result = gemini.analyze_document_content(
+        analysis_result = await gemini.analyze_document_content(
             text=decoded_content,
             current_data=current_briefing_data
         )
@@ -214,7 +390,9 @@ async def upload_file(project_id: int, file_content: str = Body(..., embed=True)
             
             # Обновляем проект с новыми данными брифинга
             project.briefing_data = briefing_data
-            db.commit()
+            if uploaded_file is not None:
+                db.add(uploaded_file)
+            await db.commit()
             
             # Формируем ответное сообщение
             if briefing_data["completion_percentage"] >= 80:
@@ -239,9 +417,12 @@ async def upload_file(project_id: int, file_content: str = Body(..., embed=True)
                 assistant_content = f"Я проанализировал ваш файл и извлек некоторую информацию ({briefing_data['completion_percentage']}% заполнено), но для полного заполнения брифинга нужны дополнительные данные.\n\n"
                 
                 # Генерируем вопросы для уточнения
-                questions = gemini.generate_follow_up_questions(briefing_data, [])
+                asked_questions = await get_question_index(db, project_id)
+                await db.commit()
+                questions = await gemini.generate_follow_up_questions(briefing_data, [], asked_questions=asked_questions)
                 assistant_content += "Пожалуйста, ответьте на следующие вопросы:\n\n"
                 assistant_content += "\n\n".join(questions)
+            assistant_content += _skipped_document_note(analysis_result)
         else:
             # Если анализ не удался
             assistant_content = "Я не смог полноценно проанализировать ваш файл. Возможно, формат документа не поддерживается или содержимое зашифровано.\n\n"
@@ -262,44 +443,130 @@ async def upload_file(project_id: int, file_content: str = Body(..., embed=True)
                 "funnel_elements": [],
                 "completion_percentage": 0
             }
-            db.commit()
+            await db.commit()
     
-    # Сохраняем ответ ассистента
-    assistant_message = ChatMessage(
-        project_id=project_id,
-        role="assistant",
-        content=assistant_content
+    return await _save_assistant_reply(db, project, assistant_content)
+
+async def _file_turn(db: AsyncSession, project: Project, file_content: str) -> Dict[str, Any]:
+    """Ход брифинга по файлу из JSON-тела (data URL с содержимым в base64)"""
+    def read_text() -> str:
+        # Предполагаем, что file_content приходит в формате data:application/pdf;base64,XXXXX...
+        file_data = file_content.split(',')[1] if ',' in file_content else file_content
+        # Декодируем base64 - теоретически может обрабатывать документы.
+        return base64.b64decode(file_data).decode('utf-8', errors='ignore')
+    
+    file_type = file_content.split(';')[0] if ';' in file_content else 'document'
+    return await _document_turn(db, project, f"Загружен файл с содержимым типа {file_type}", read_text)
+
+async def _duplicate_upload_turn(db: AsyncSession, project: Project, filename: str, previous: UploadedFile) -> Dict[str, Any]:
+    """Ход по повторно загруженному файлу: сообщения сохраняются, документ не анализируется заново"""
+    db.add(ChatMessage(project_id=project.id, role="user", content=f"Загружен файл {filename}"))
+    uploaded_at = previous.created_at.strftime("%d.%m.%Y %H:%M") if previous.created_at else "ранее"
+    assistant_content = (
+        f"Этот файл уже загружался в проект ({previous.filename}, {uploaded_at}), и информация из него учтена в брифинге "
+        f"({(project.briefing_data or {}).get('completion_percentage', 0)}% заполнено).\n\n"
+        "Если в документе что-то изменилось, загрузите новую версию или расскажите об изменениях в чате."
     )
+    result = await _save_assistant_reply(db, project, assistant_content)
+    result["duplicate"] = True
+    return result
+
+@router.post("/{project_id}/upload-file", response_model=Dict[str, Any], dependencies=[Depends(llm_deadline(LLM_LONG_REQUEST_DEADLINE_SECONDS))])
+async def upload_file(project_id: int, file_content: str = Body(..., embed=True), mode: TurnMode = _MODE_QUERY, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+    """Обработка загруженного файла (mode=job - сразу 202 с id задачи)"""
+    # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
-    db.add(assistant_message)
-    db.commit()
-    db.refresh(assistant_message)
+    if not project:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Проект не найден"
+        )
+    bind_llm_call_context(project_id=project_id)
     
-    # Возвращаем результат в правильном формате (как ожидает фронтенд)
-    return {
-        "status": "success",
-        "message": {
-            "id": assistant_message.id,
-            "role": assistant_message.role,
-            "content": assistant_message.content,
-            "project": {
-                "id": project.id,
-                "briefing_data": project.briefing_data
-            }
-        }
-    }
+    if mode == "job":
+        return _submit_turn_job(project_id, "upload_file", lambda job_db, job_project: _file_turn(job_db, job_project, file_content), deadline_seconds=LLM_LONG_REQUEST_DEADLINE_SECONDS)
+    
+    return await _file_turn(db, project, file_content)
 
-@router.post("/{project_id}/process-link", response_model=Dict[str, Any])
-async def process_link(project_id: int, link: str = Body(..., embed=True), db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
-    """Обработка ссылки на сайт"""
-    # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+@router.post("/{project_id}/upload", response_model=Dict[str, Any], dependencies=[Depends(llm_deadline(LLM_LONG_REQUEST_DEADLINE_SECONDS))])
+async def upload_document(project_id: int, request: Request, mode: TurnMode = _MODE_QUERY, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+    """
+    Загрузка документа как multipart/form-data (поле file) вместо base64 в JSON.
+    Тело принимается потоком с лимитом размера (services/upload_stream): большой файл - 413.
+    Файл с тем же sha256, уже проанализированный в проекте, повторно не анализируется
+    (в ответе "duplicate": true). Ответ - как у upload-file (mode=job - сразу 202 с id задачи).
+    """
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not project:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Проект не найден"
         )
+    bind_llm_call_context(project_id=project_id)
+    # Соединение не держится, пока принимается тело
+    await db.commit()
+    
+    try:
+        upload = await receive_upload(request)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except InvalidUpload as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    try:
+        previous = await db.scalar(
+            select(UploadedFile)
+            .where(UploadedFile.project_id == project_id, UploadedFile.sha256 == upload.sha256)
+            .order_by(UploadedFile.id)
+            .limit(1)
+        )
+        await db.commit()
+        filename = upload.filename
+        # Текст извлекается до закрытия временного файла: задача (mode=job) выполняется позже.
+        # Чтение и декодирование до UPLOAD_MAX_BYTES - в отдельном потоке, не блокируя event loop
+        text = await asyncio.to_thread(upload.read_text) if previous is None else ""
+        uploaded_file = UploadedFile(project_id=project_id, sha256=upload.sha256, filename=filename, size=upload.size)
+    finally:
+        upload.close()
+    
+    if previous is not None:
+        turn = lambda turn_db, turn_project: _duplicate_upload_turn(turn_db, turn_project, filename, previous)
+    else:
+        turn = lambda turn_db, turn_project: _document_turn(turn_db, turn_project, f"Загружен файл {filename}", lambda: text, uploaded_file)
+    
+    if mode == "job":
+        return _submit_turn_job(project_id, "upload_document", turn, deadline_seconds=LLM_LONG_REQUEST_DEADLINE_SECONDS)
+    
+    return await turn(db, project)
+
+async def _fetch_link_text(link: str) -> str:
+    """Скачивает страницу по ссылке и извлекает текст в отдельном потоке, не блокируя event loop"""
+    def fetch() -> str:
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+        }
+        response = requests.get(link, headers=headers, timeout=10)
+        response.raise_for_status()  # Проверяем статус ответа
+        
+        # Получаем текст страницы и очищаем его
+        soup = BeautifulSoup(response.text, 'html.parser')
+        
+        # Удаляем все скрипты, стили и другие ненужные элементы
+        for script in soup(["script", "style", "meta", "noscript", "iframe"]):
+            script.extract()
+        
+        # Извлекаем текст из HTML
+        return soup.get_text(separator="\n", strip=True)
+    
+    # Одна и та же ссылка, отправленная одновременно, скачивается один раз; запрос ждет
+    # не дольше своего дедлайна (поток со скачиванием ограничен timeout=10)
+    return await run_with_deadline(single_flight.do("link_fetch", {"url": link}, lambda: asyncio.to_thread(fetch)))
+
+async def _link_turn(db: AsyncSession, project: Project, link: str) -> Dict[str, Any]:
+    """Ход брифинга по ссылке на сайт: загрузка страницы, анализ, ответ ассистента"""
+    project_id = project.id
     
     # Сохраняем сообщение пользователя о ссылке
     user_message = ChatMessage(
@@ -309,35 +576,22 @@ async def process_link(project_id: int, link: str = Body(..., embed=True), db: S
     )
     
     db.add(user_message)
-    db.commit()
+    # Соединение возвращается в пул на время загрузки страницы и вызова модели
+    await db.commit()
     
     assistant_content = ""
     
     try:
         # Пытаемся получить содержимое по ссылке
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-            }
-            response = requests.get(link, headers=headers, timeout=10)
-            response.raise_for_status()  # Проверяем статус ответа
-            
-            # Получаем текст страницы и очищаем его
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Удаляем все скрипты, стили и другие ненужные элементы
-            for script in soup(["script", "style", "meta", "noscript", "iframe"]):
-                script.extract()
-            
-            # Извлекаем текст из HTML
-            page_text = soup.get_text(separator="\n", strip=True)
+            page_text = await _fetch_link_text(link)
             
             # Получаем текущие данные брифинга
             current_briefing_data = project.briefing_data if project.briefing_data else {}
             
             # Анализируем содержимое страницы через Gemini API
-            analysis_result = gemini.analyze_document_content(
-                text=page_text[:50000],  # Ограничиваем размер текста
+            analysis_result = await gemini.analyze_document_content(
+                text=page_text,  # Длинные страницы анализируются по частям, без обрезки
                 current_data=current_briefing_data
             )
             
@@ -352,7 +606,7 @@ async def process_link(project_id: int, link: str = Body(..., embed=True), db: S
                 
                 # Обновляем проект с новыми данными брифинга
                 project.briefing_data = briefing_data
-                db.commit()
+                await db.commit()
                 
                 # Формируем ответное сообщение
                 if briefing_data["completion_percentage"] >= 80:
@@ -377,9 +631,12 @@ async def process_link(project_id: int, link: str = Body(..., embed=True), db: S
                     assistant_content = f"Я проанализировал информацию по вашей ссылке и извлек некоторые данные ({briefing_data['completion_percentage']}% заполнено), но для полного заполнения брифинга нужны дополнительные детали.\n\n"
                     
                     # Генерируем вопросы для уточнения
-                    questions = gemini.generate_follow_up_questions(briefing_data, [])
+                    asked_questions = await get_question_index(db, project_id)
+                    await db.commit()
+                    questions = await gemini.generate_follow_up_questions(briefing_data, [], asked_questions=asked_questions)
                     assistant_content += "Пожалуйста, ответьте на следующие вопросы:\n\n"
                     assistant_content += "\n\n".join(questions)
+                assistant_content += _skipped_document_note(analysis_result)
             else:
                 # Если анализ не удался
                 assistant_content = "Я не смог извлечь полезную информацию из страницы по вашей ссылке. Возможно, на странице недостаточно текстового контента или он защищен от автоматического извлечения.\n\n"
@@ -411,7 +668,7 @@ async def process_link(project_id: int, link: str = Body(..., embed=True), db: S
                 "funnel_elements": [],
                 "completion_percentage": 0
             }
-            db.commit()
+            await db.commit()
     
     # Сохраняем ответ ассистента
     assistant_message = ChatMessage(
@@ -421,8 +678,9 @@ async def process_link(project_id: int, link: str = Body(..., embed=True), db: S
     )
     
     db.add(assistant_message)
-    db.commit()
-    db.refresh(assistant_message)
+    await record_asked_questions(db, project_id, assistant_content)
+    await db.commit()
+    await db.refresh(assistant_message)
     
     # Возвращаем результат в правильном формате (как ожидает фронтенд)
     return {
@@ -436,4 +694,79 @@ async def process_link(project_id: int, link: str = Body(..., embed=True), db: S
                 "briefing_data": project.briefing_data
             }
         }
-    }
\ No newline at end of file
+    }
+
+@router.post("/{project_id}/process-link", response_model=Dict[str, Any], dependencies=[Depends(llm_deadline(LLM_LONG_REQUEST_DEADLINE_SECONDS))])
+async def process_link(project_id: int, link: str = Body(..., embed=True), mode: TurnMode = _MODE_QUERY, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+    """Обработка ссылки на сайт (mode=job - сразу 202 с id задачи)"""
+    # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
+    
+    if not project:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Проект не найден"
+        )
+    bind_llm_call_context(project_id=project_id)
+    
+    if mode == "job":
+        return _submit_turn_job(project_id, "process_link", lambda job_db, job_project: _link_turn(job_db, job_project, link), deadline_seconds=LLM_LONG_REQUEST_DEADLINE_SECONDS)
+    
+    return await _link_turn(db, project, link)
+
+@router.get("/{project_id}/jobs/{job_id}", response_model=Dict[str, Any])
+async def get_chat_job(project_id: int, job_id: str, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+    """Состояние задачи хода (опрос для клиентов без WebSocket): status и, после завершения, result или error"""
+    # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
+    
+    if not project:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Проект не найден"
+        )
+    
+    job = chat_jobs.get_job(job_id)
+    if job is None or job.project_id != project_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Задача не найдена или уже удалена"
+        )
+    return job.to_dict()
+
+async def _wait_disconnect(websocket: WebSocket):
+    """Читает (и игнорирует) сообщения клиента до отключения"""
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+@router.websocket("/{project_id}/ws")
+async def chat_job_events(websocket: WebSocket, project_id: int, token: str = Query(..., description="JWT токен (заголовок Authorization недоступен для WebSocket в браузере)")):
+    """
+    Канал событий задач ходов проекта: при подключении - текущее состояние задач проекта,
+    затем каждое изменение статуса (queued, running, succeeded, failed). Событие succeeded
+    содержит result - тот же ответ, что и у синхронного режима (сообщение ассистента и briefing_data).
+    """
+    async with AsyncSessionLocal() as db:
+        user = await auth.get_user_by_token(db, token)
+        project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == user.id)) if user else None
+    if project is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    async with chat_jobs.subscribe(project_id) as events:
+        disconnected = asyncio.ensure_future(_wait_disconnect(websocket))
+        try:
+            for event in chat_jobs.snapshot(project_id):
+                await websocket.send_json(event)
+            while True:
+                next_event = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event not in done:
+                    next_event.cancel()
+                    break
+                await websocket.send_json(next_event.result())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            disconnected.cancel()
@@ -2,18 +2,19 @@
 Эндпоинты для работы с проектами через Firebase Firestore.
 """
 import logging # Добавляем импорт logging
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Body
 from typing import List, Dict, Any, Optional
 from pydantic import BaseModel # Добавляем импорт BaseModel
 from firebase_admin import auth as firebase_auth
 
 from ...dependencies import get_db
+from ...core.llm_context import bind_llm_call_context, llm_deadline
 from ...db.firebase_models import ProjectCreate, ProjectUpdate, ProjectResponse 
 # Импортируем WebsiteImportResponse из правильного места
 from ...schemas.website_import import WebsiteImportResponse 
-from ...services import firebase_service, gemini
+from ...services import briefing_precompute, firebase_service, gemini
 from ...services.firebase_auth import get_current_user
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(llm_deadline())])
 logger = logging.getLogger(__name__) # Инициализируем логгер
 
 @router.post("/", response_model=ProjectResponse)
@@ -91,6 +92,7 @@ async def get_project(
 async def update_project(
     project_id: str,
     project_update: ProjectUpdate,
+    background_tasks: BackgroundTasks,
     db = Depends(get_db),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
@@ -123,6 +125,9 @@ async def update_project(
             detail="Не удалось обновить проект"
         )
     
+    # Название, описание и статус входят в данные сводки - пересчитываем ее в фоне
+    background_tasks.add_task(briefing_precompute.precompute_briefing_artifacts, db, project_id)
+    
     # Получаем обновленный проект
     updated_project = await firebase_service.get_project_by_id(db, project_id)
     
@@ -132,6 +137,7 @@ async def update_project(
 @router.post("/{project_id}/briefing/analyze", response_model=Dict[str, Any])
 async def analyze_briefing_info(
     project_id: str,
+    background_tasks: BackgroundTasks,
     text: str = Body(..., embed=True),
     db = Depends(get_db),
     current_user: Dict[str, Any] = Depends(get_current_user)
@@ -152,9 +158,10 @@ async def analyze_briefing_info(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="У вас нет доступа к этому проекту"
         )
+    bind_llm_call_context(project_id=project_id)
     
     # Анализируем информацию с помощью Gemini API
-    analysis_result = gemini.analyze_expert_info(text)
+    analysis_result = await gemini.analyze_expert_info(text)
     
     if analysis_result["status"] == "error":
         raise HTTPException(
@@ -169,6 +176,9 @@ async def analyze_briefing_info(
     # Обновляем проект в Firestore
     await firebase_service.update_project(db, project_id, {"briefing_data": briefing_data})
     
+    # Вопросы и сводка для новых данных считаются в фоне, после отправки ответа
+    background_tasks.add_task(briefing_precompute.precompute_briefing_artifacts, db, project_id)
+    
     return analysis_result
 
 
@@ -194,14 +204,10 @@ async def get_follow_up_questions(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="У вас нет доступа к этому проекту"
         )
+    bind_llm_call_context(project_id=project_id)
     
-    # Проверяем, есть ли данные брифинга
-    briefing_data = project.get("briefing_data", {})
-    if not briefing_data or not isinstance(briefing_data, dict) or not briefing_data.items():
-        return ["Расскажите о вашем продукте или услуге", "Что делает ваше предложение уникальным?", "Как клиенты обычно взаимодействуют с вашим продуктом?"]
-    
-    # Генерируем уточняющие вопросы на основе текущих данных
-    questions = gemini.generate_follow_up_questions(briefing_data)
+    # Предрасчитанные вопросы, если данные брифинга не менялись после расчета, иначе генерируем сейчас
+    questions = await briefing_precompute.get_follow_up_questions(db, project)
     
     return questions
 
@@ -223,6 +229,7 @@ class BriefingDataUpdate(BaseModel):
 async def update_briefing_data(
     project_id: str,
     briefing_update: BriefingDataUpdate, # Используем новую модель для тела запроса
+    background_tasks: BackgroundTasks,
     db = Depends(get_db),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
@@ -260,6 +267,7 @@ async def update_briefing_data(
         )
 
     logger.info(f"Briefing data for project {project_id} updated successfully.")
+    background_tasks.add_task(briefing_precompute.precompute_briefing_artifacts, db, project_id)
     # Возвращаем 204 No Content при успехе
     return None
 # --- END NEW ---
@@ -3,15 +3,21 @@
 """
 import logging
 from fastapi import APIRouter, Depends, HTTPException, status, Body
-from typing import Dict, Any
+from fastapi.responses import StreamingResponse
+from typing import Dict, Any, List
 
 from ...dependencies import get_db
-from ...services import gemini, firebase_service
+from ...core.llm_context import LLMDeadlineExceeded, bind_llm_call_context, llm_deadline
+from ...services import briefing_precompute, gemini, firebase_service
 from ...services.firebase_auth import get_current_user
+from ...services.llm_streaming import format_sse_event
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(llm_deadline())])
+
+# Максимум проектов в одном пакетном запросе сводок
+SUMMARY_BATCH_MAX_PROJECTS = 100
 
 @router.post("/{project_id}/summarize", response_model=Dict[str, Any])
 async def summarize_project(
@@ -43,18 +49,10 @@ async def summarize_project(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="У вас нет прав для получения сводки этого проекта"
             )
+        bind_llm_call_context(project_id=project_id)
         
-        # Подготавливаем данные для генерации сводки
-        project_data = {
-            "id": project.get("id"),
-            "name": project.get("name"),
-            "description": project.get("description"),
-            "status": project.get("status"),
-            "briefing_data": project.get("briefing_data", {})
-        }
-        
-        # Генерируем сводку с помощью Gemini API
-        summary_result = gemini.generate_project_summary(project_data)
+        # Предрасчитанная сводка, если данные проекта не менялись после расчета, иначе генерируем с помощью Gemini API
+        summary_result = await briefing_precompute.get_project_summary(db, project)
         
         if summary_result.get("status") == "error":
             logger.error(f"Ошибка при генерации сводки для проекта {project_id}: {summary_result.get('message')}")
@@ -65,12 +63,130 @@ async def summarize_project(
         
         return summary_result
     
-    except HTTPException:
-        # Пробрасываем HTTPException дальше
+    except (HTTPException, LLMDeadlineExceeded):
+        # Пробрасываем HTTPException и истечение дедлайна (504) дальше
         raise
     except Exception as e:
         logger.exception(f"Непредвиденная ошибка при генерации сводки для проекта {project_id}: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Внутренняя ошибка сервера: {str(e)}"
-        ) 
\ No newline at end of file
+        ) 
+
+@router.post("/{project_id}/summarize/stream")
+async def summarize_project_stream(
+    project_id: str,
+    db = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """
+    Потоковая генерация краткого описания проекта (server-sent events).
+    
+    События: token (фрагмент сводки), result (итог в формате POST /{project_id}/summarize).
+    Требует аутентификацию через Firebase.
+    """
+    logger.info(f"Запрос на потоковую суммаризацию проекта {project_id} от пользователя {current_user.get('uid')}")
+    
+    # Проверки выполняются до начала потока, чтобы ошибки доступа возвращались обычными HTTP-кодами
+    project = await firebase_service.get_project_by_id(db, project_id)
+    
+    if not project:
+        logger.warning(f"Попытка получить сводку для несуществующего проекта {project_id}")
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Проект не найден"
+        )
+    
+    if project.get("owner_id") != current_user.get("uid"):
+        logger.warning(f"Попытка пользователя {current_user.get('uid')} получить сводку чужого проекта {project_id}")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="У вас нет прав для получения сводки этого проекта"
+        )
+    bind_llm_call_context(project_id=project_id)
+    
+    project_data = briefing_precompute.summary_input(project)
+    # Актуальная предрасчитанная сводка отдается одним фрагментом, без обращения к модели
+    precomputed = await briefing_precompute.load_fresh_summary(db, project)
+    
+    async def event_stream():
+        if precomputed is not None:
+            yield format_sse_event("token", {"text": precomputed.get("summary", "")})
+            yield format_sse_event("result", precomputed)
+            return
+        try:
+            async for event in gemini.stream_project_summary(project_data):
+                yield format_sse_event(event["event"], event["data"])
+        except Exception as e:
+            logger.exception(f"Ошибка потоковой генерации сводки для проекта {project_id}: {e}")
+            yield format_sse_event("result", {"status": "error", "message": str(e)})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/summarize/batch")
+async def summarize_projects_batch(
+    project_ids: List[str] = Body(..., embed=True),
+    db = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """
+    Пакетная генерация сводок нескольких проектов (server-sent events).
+    
+    Проекты читаются одним пакетным запросом к Firestore, сводки генерируются параллельно
+    (не больше SUMMARY_BATCH_CONCURRENCY одновременно). События:
+    - result: {"project_id": ..., "status": "success", "summary": ...} по мере готовности;
+      для ненайденных, чужих проектов и ошибок генерации - status not_found / forbidden / error;
+    - done: {"total", "succeeded", "failed"} после всех проектов.
+    Ошибка одного проекта не прерывает пакет. Требует аутентификацию через Firebase.
+    """
+    # Повторяющиеся id обрабатываются один раз, порядок запроса сохраняется
+    project_ids = list(dict.fromkeys(project_id for project_id in project_ids if project_id))
+    if not project_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Список проектов пуст")
+    if len(project_ids) > SUMMARY_BATCH_MAX_PROJECTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Слишком много проектов в одном запросе (максимум {SUMMARY_BATCH_MAX_PROJECTS})"
+        )
+    logger.info(f"Запрос на пакетную суммаризацию {len(project_ids)} проектов от пользователя {current_user.get('uid')}")
+    
+    try:
+        projects = await firebase_service.get_projects_by_ids(db, project_ids)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Не удалось прочитать проекты: {str(e)}"
+        )
+    
+    # Проверка доступа для всего пакета сразу: недоступные проекты сразу получают итоговый результат
+    rejected = []
+    allowed = []
+    for project_id in project_ids:
+        project = projects.get(project_id)
+        if not project:
+            rejected.append({"project_id": project_id, "status": "not_found", "message": "Проект не найден"})
+        elif project.get("owner_id") != current_user.get("uid"):
+            rejected.append({"project_id": project_id, "status": "forbidden", "message": "У вас нет прав для получения сводки этого проекта"})
+        else:
+            allowed.append(project)
+    
+    async def event_stream():
+        succeeded = 0
+        for result in rejected:
+            yield format_sse_event("result", result)
+        async for project_id, summary_result in briefing_precompute.summarize_projects(db, allowed):
+            if summary_result.get("status") == "success":
+                succeeded += 1
+            yield format_sse_event("result", {"project_id": project_id, **summary_result})
+        yield format_sse_event("done", {"total": len(project_ids), "succeeded": succeeded, "failed": len(project_ids) - succeeded})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,69 @@
+"""
+Эндпоинты с метриками работы LLM-слоя (кэш ответов, реестр моделей, маршруты задач по моделям, бюджет промптов, governor, single-flight, hedging, разбор JSON-ответов, предрасчет вопросов и сводки),
+пулом SQL-соединений, очередью задач чата и учетом расхода токенов.
+"""
+from datetime import datetime, timedelta, timezone
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from typing import Dict, Any, Optional
+
+from ...db import get_pool_stats
+from ...dependencies import get_db
+
+from ...core.api_setup import get_context_cache_stats, get_llm_backend, get_model_stats, get_route_stats
+from ...services.firebase_auth import get_current_user
+from ...services.chat_jobs import chat_jobs
+from ...services.llm_cache import response_cache
+from ...services.llm_governor import llm_governor
+from ...services.llm_hedging import llm_hedging
+from ...services.prompt_budget import get_prompt_stats
+from ...services.single_flight import single_flight
+from ...services.usage_ledger import GROUP_BY_FIELDS, usage_ledger
+from ...services import briefing_precompute, structured_output
+
+router = APIRouter()
+
+
+@router.get("/stats", response_model=Dict[str, Any])
+async def get_llm_stats(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """Счетчики кэша ответов LLM, статистика моделей и маршрутов задач (задержка, токены, стоимость), размеров промптов, очереди, объединенных и дублированных вызовов, разбора JSON-ответов, предрасчета, пула SQL-соединений и очереди задач чата"""
+    backend = get_llm_backend()
+    return {
+        "backend": {"name": backend.name, **backend.get_stats()},
+        "cache": response_cache.get_stats(),
+        "models": get_model_stats(),
+        "routes": get_route_stats(),
+        "context_cache": get_context_cache_stats(),
+        "prompts": get_prompt_stats(),
+        "governor": llm_governor.get_stats(),
+        "single_flight": single_flight.get_stats(),
+        "hedging": llm_hedging.get_stats(),
+        "structured_output": structured_output.get_stats(),
+        "precompute": briefing_precompute.get_stats(),
+        "usage_ledger": usage_ledger.get_stats(),
+        "sql_pool": get_pool_stats(),
+        "chat_jobs": chat_jobs.get_stats(),
+    }
+
+
+@router.get("/usage", response_model=Dict[str, Any])
+async def get_llm_usage(
+    day_from: Optional[str] = Query(None, alias="from", description="Первый день (UTC, YYYY-MM-DD), по умолчанию 7 дней назад"),
+    day_to: Optional[str] = Query(None, alias="to", description="Последний день (UTC, YYYY-MM-DD), по умолчанию сегодня"),
+    project_id: Optional[str] = None,
+    group_by: str = "day",
+    db = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """Расход токенов LLM текущего пользователя за период: итоги и группы по дню, проекту, эндпоинту или модели"""
+    if group_by not in GROUP_BY_FIELDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"group_by должен быть одним из: {', '.join(GROUP_BY_FIELDS)}"
+        )
+    today = datetime.now(timezone.utc).date()
+    try:
+        day_to = (datetime.strptime(day_to, "%Y-%m-%d").date() if day_to else today).isoformat()
+        day_from = (datetime.strptime(day_from, "%Y-%m-%d").date() if day_from else today - timedelta(days=6)).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Даты должны быть в формате YYYY-MM-DD")
+    return await usage_ledger.query(db, current_user["uid"], day_from, day_to, project_id=project_id, group_by=group_by)
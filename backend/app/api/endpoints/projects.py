@@ -1,16 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Body
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 
+from app.core.llm_context import bind_llm_call_context, llm_deadline
 from app.db import get_sql_db
 from app.db.models import Project, User
 from app.schemas.project import ProjectCreate, ProjectResponse, ProjectUpdate, BriefingData
 from app.services import auth, gemini
+from app.services.question_index import get_question_index
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(llm_deadline())])
 
 @router.post("/", response_model=ProjectResponse)
-async def create_project(project: ProjectCreate, db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+async def create_project(project: ProjectCreate, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
     """Создание нового проекта"""
     db_project = Project(
         name=project.name,
@@ -21,21 +24,21 @@ async def create_project(project: ProjectCreate, db: Session = Depends(get_sql_d
     )
     
     db.add(db_project)
-    db.commit()
-    db.refresh(db_project)
+    await db.commit()
+    await db.refresh(db_project)
     
     return db_project
 
 @router.get("/", response_model=List[ProjectResponse])
-async def get_projects(db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+async def get_projects(db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
     """Получение списка проектов пользователя"""
-    projects = db.query(Project).filter(Project.owner_id == current_user.id).all()
+    projects = (await db.scalars(select(Project).where(Project.owner_id == current_user.id))).all()
     return projects
 
 @router.get("/{project_id}", response_model=ProjectResponse)
-async def get_project(project_id: int, db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+async def get_project(project_id: int, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
     """Получение информации о проекте"""
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not project:
         raise HTTPException(
@@ -46,9 +49,9 @@ async def get_project(project_id: int, db: Session = Depends(get_sql_db), curren
     return project
 
 @router.put("/{project_id}", response_model=ProjectResponse)
-async def update_project(project_id: int, project_update: ProjectUpdate, db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+async def update_project(project_id: int, project_update: ProjectUpdate, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
     """Обновление информации о проекте"""
-    db_project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+    db_project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not db_project:
         raise HTTPException(
@@ -62,25 +65,29 @@ async def update_project(project_id: int, project_update: ProjectUpdate, db: Ses
     for key, value in update_data.items():
         setattr(db_project, key, value)
     
-    db.commit()
-    db.refresh(db_project)
+    await db.commit()
+    await db.refresh(db_project)
     
     return db_project
 
 @router.post("/{project_id}/briefing/analyze", response_model=dict)
-async def analyze_briefing_info(project_id: int, text: str = Body(..., embed=True), db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+async def analyze_briefing_info(project_id: int, text: str = Body(..., embed=True), db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
     """Анализ информации о брифинге с помощью Gemini API"""
     # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not project:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Проект не найден"
         )
+    bind_llm_call_context(project_id=project_id)
+    
+    # Соединение возвращается в пул на время вызова модели
+    await db.commit()
     
     # Анализируем информацию с помощью Gemini API
-    analysis_result = gemini.analyze_expert_info(text)
+    analysis_result = await gemini.analyze_expert_info(text)
     
     if analysis_result["status"] == "error":
         raise HTTPException(
@@ -93,42 +100,48 @@ async def analyze_briefing_info(project_id: int, text: str = Body(..., embed=Tru
     briefing_data["completion_percentage"] = analysis_result["completion_percentage"]
     
     project.briefing_data = briefing_data
-    db.commit()
+    await db.commit()
     
     return analysis_result
 
 @router.post("/{project_id}/briefing/questions", response_model=List[str])
-async def get_follow_up_questions(project_id: int, db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+async def get_follow_up_questions(project_id: int, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
     """Получение уточняющих вопросов на основе текущих данных брифинга"""
     # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not project:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Проект не найден"
         )
+    bind_llm_call_context(project_id=project_id)
     
     # Проверяем, есть ли данные брифинга
     if not project.briefing_data:
         return ["Расскажите о вашем продукте или услуге", "Что делает ваше предложение уникальным?", "Как клиенты обычно взаимодействуют с вашим продуктом?"]
     
+    asked_questions = await get_question_index(db, project_id)
+    # Соединение возвращается в пул на время вызова модели
+    await db.commit()
+    
     # Генерируем уточняющие вопросы на основе текущих данных
-    questions = gemini.generate_follow_up_questions(project.briefing_data)
+    questions = await gemini.generate_follow_up_questions(project.briefing_data, asked_questions=asked_questions)
     
     return questions
 
 @router.post("/{project_id}/summarize", response_model=dict)
-async def summarize_project(project_id: int, db: Session = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
+async def summarize_project(project_id: int, db: AsyncSession = Depends(get_sql_db), current_user: User = Depends(auth.get_current_user)):
     """Генерация краткого описания проекта на основе его данных"""
     # Проверяем, существует ли проект и принадлежит ли он текущему пользователю
-    project = db.query(Project).filter(Project.id == project_id, Project.owner_id == current_user.id).first()
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == current_user.id))
     
     if not project:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Проект не найден"
         )
+    bind_llm_call_context(project_id=project_id)
     
     # Преобразуем проект в словарь для передачи в сервис
     project_data = {
@@ -139,8 +152,11 @@ async def summarize_project(project_id: int, db: Session = Depends(get_sql_db),
         "briefing_data": project.briefing_data
     }
     
+    # Соединение возвращается в пул на время вызова модели
+    await db.commit()
+    
     # Генерируем саммари проекта с помощью Gemini API
-    summary_result = gemini.generate_project_summary(project_data)
+    summary_result = await gemini.generate_project_summary(project_data)
     
     if summary_result["status"] == "error":
         raise HTTPException(
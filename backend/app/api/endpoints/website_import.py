@@ -1,12 +1,15 @@
 # backend/app/api/endpoints/website_import.py
-from fastapi import APIRouter, Depends, HTTPException, Body, Path
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Body, Path
+from ...core.llm_context import LLM_LONG_REQUEST_DEADLINE_SECONDS, llm_deadline
 from ...schemas.website_import import WebsiteImportRequest, WebsiteImportResponse
 # Импортируем сервис и функцию зависимости
 from ...services.website_importer_service import WebsiteImporterService, get_website_importer_service
+from ...services import briefing_precompute
 # Импортируем базовые схемы портретов для ответа GET (хотя WebsiteImportResponse их уже содержит)
 # from ...schemas.website_import import ExpertPortraitData, AudiencePortraitData, CompetitorPortraitData
 
-router = APIRouter()
+# Импорт скачивает страницу и разбирает ее моделью - у него увеличенный дедлайн
+router = APIRouter(dependencies=[Depends(llm_deadline(LLM_LONG_REQUEST_DEADLINE_SECONDS))])
 TAG = "Website Import"
 
 @router.post(
@@ -16,6 +19,7 @@ TAG = "Website Import"
     tags=[TAG]
 )
 async def import_briefing_from_website(
+    background_tasks: BackgroundTasks,
     request: WebsiteImportRequest = Body(...),
     website_importer: WebsiteImporterService = Depends(get_website_importer_service)
 ):
@@ -29,6 +33,8 @@ async def import_briefing_from_website(
             url=str(request.url),
             project_id=request.project_id
         )
+        # Данные брифинга изменились - вопросы и сводка пересчитываются в фоне
+        background_tasks.add_task(briefing_precompute.precompute_briefing_artifacts, website_importer.db, request.project_id)
         return response_data
     except HTTPException as http_exc:
         raise http_exc
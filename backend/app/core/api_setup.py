@@ -1,7 +1,13 @@
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 from googleapiclient.discovery import build
+import json
 import os
 import logging
+import threading
+import time
+from collections import deque
+from datetime import timedelta
 from dotenv import load_dotenv
 from googleapiclient.errors import HttpError
 # Убрали зависимости от google.auth, т.к. ключи будем брать из env
@@ -77,18 +83,360 @@ def get_youtube_api_client():
         return None
 
 # Меняем модель по умолчанию на gemini-2.0-flash-001 по предложению пользователя
-def get_gemini_model(model_name: str = 'models/gemini-2.0-flash-001') -> genai.GenerativeModel | None:
-    """Возвращает инстанс модели Gemini, если API настроено."""
+DEFAULT_GEMINI_MODEL = 'models/gemini-2.0-flash-001'
+
+# --- Реестр моделей Gemini ---
+# Один инстанс GenerativeModel на (имя модели, параметры генерации, настройки безопасности)
+# на весь процесс: горячие пути берут готовый инстанс из реестра и никогда не создают клиента заново.
+GEMINI_WARM_MODELS = [name.strip() for name in os.getenv("GEMINI_WARM_MODELS", DEFAULT_GEMINI_MODEL).split(",") if name.strip()]
+
+# Context caching статической инструкции (system_instruction) на стороне Gemini.
+# Gemini кэширует только достаточно длинный контекст: если инструкция слишком короткая
+# или модель не поддерживает кэш, инструкция передается обычным способом.
+GEMINI_CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE_ENABLED", "0").lower() not in ("0", "false", "no")
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Через сколько секунд повторять неудачное создание кэша (удваивается с каждой неудачей подряд)
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv("GEMINI_CONTEXT_CACHE_RETRY_SECONDS", "300"))
+_CONTEXT_CACHE_MAX_RETRY_SECONDS = 6 * 3600
+
+_model_registry: dict = {}
+_model_stats: dict = {}
+_model_registry_lock = threading.Lock()
+# (модель, инструкция) -> (инстанс CachedContent, время истечения, неудач подряд);
+# после неудачи - (None, время следующей попытки, неудач подряд)
+_context_caches: dict = {}
+_context_cache_stats = {"created": 0, "failed": 0, "expired": 0}
+
+
+def _model_registry_key(model_name: str, generation_config=None, safety_settings=None, system_instruction=None) -> str:
+    key = {"model": model_name, "generation_config": generation_config or {}, "safety_settings": safety_settings or []}
+    if system_instruction:
+        key["system_instruction"] = system_instruction
+    return json.dumps(key, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _get_cached_content(model_name: str, system_instruction: str):
+    """
+    Возвращает CachedContent с инструкцией (создает при первом обращении и по истечении TTL).
+    Вызывается под _model_registry_lock. None - кэширование сейчас недоступно для этой инструкции:
+    после неудачи создание повторяется не раньше, чем через GEMINI_CONTEXT_CACHE_RETRY_SECONDS
+    (с удвоением при неудачах подряд, до _CONTEXT_CACHE_MAX_RETRY_SECONDS).
+    """
+    cache_key = (model_name, system_instruction)
+    entry = _context_caches.get(cache_key)
+    now = time.time()
+    if entry is not None and entry[1] > now:
+        return entry[0]
+    failures = entry[2] if entry is not None else 0
+    if entry is not None and entry[0] is not None:
+        _context_cache_stats["expired"] += 1
+    try:
+        cached_content = genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS),
+        )
+    except Exception as e:
+        # Обычно инструкция короче минимального размера кэша, но бывают и временные ошибки API
+        failures += 1
+        retry_seconds = min(_CONTEXT_CACHE_MAX_RETRY_SECONDS, GEMINI_CONTEXT_CACHE_RETRY_SECONDS * 2 ** (failures - 1))
+        logger.warning(
+            f"Context caching недоступен для инструкции модели '{model_name}' ({len(system_instruction)} символов), "
+            f"повтор через {retry_seconds:.0f} с: {e}"
+        )
+        _context_caches[cache_key] = (None, now + retry_seconds, failures)
+        _context_cache_stats["failed"] += 1
+        return None
+    # Инстанс пересоздается чуть раньше истечения кэша на стороне Gemini
+    _context_caches[cache_key] = (cached_content, now + GEMINI_CONTEXT_CACHE_TTL_SECONDS * 0.9, 0)
+    _context_cache_stats["created"] += 1
+    logger.info(f"Создан context cache инструкции для модели '{model_name}' (TTL {GEMINI_CONTEXT_CACHE_TTL_SECONDS} с)")
+    return cached_content
+
+
+def get_gemini_model(model_name: str = DEFAULT_GEMINI_MODEL, generation_config: dict | None = None, safety_settings: list | None = None, system_instruction: str | None = None) -> genai.GenerativeModel | None:
+    """
+    Возвращает инстанс модели Gemini из реестра, если API настроено.
+    
+    Инстанс создается один раз для каждой комбинации (модель, generation_config, safety_settings,
+    system_instruction) и переиспользуется всеми последующими вызовами. При GEMINI_CONTEXT_CACHE_ENABLED
+    инструкция кэшируется на стороне Gemini, и инстанс создается из кэша (пересоздается по истечении TTL).
+    """
+    use_context_cache = bool(system_instruction) and GEMINI_CONTEXT_CACHE_ENABLED
+    key = _model_registry_key(model_name, generation_config, safety_settings, system_instruction)
+    model = _model_registry.get(key)
+    if model is not None and not use_context_cache:
+        return model
+
     if not _gemini_api_configured:
         logger.warning("Попытка получить модель Gemini до успешной конфигурации API.")
         if not setup_gemini_api(): # Попробуем настроить
              return None
-    try:
-        model = genai.GenerativeModel(model_name)
+    with _model_registry_lock:
+        cached_content = _get_cached_content(model_name, system_instruction) if use_context_cache else None
+        model = _model_registry.get(key)
+        if model is not None and getattr(model, "cached_content", None) == getattr(cached_content, "name", None):
+            return model
+        try:
+            if cached_content is not None:
+                model = genai.GenerativeModel.from_cached_content(
+                    cached_content,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                )
+            else:
+                model = genai.GenerativeModel(
+                    model_name,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                    system_instruction=system_instruction,
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при создании инстанса модели Gemini '{model_name}': {e}")
+            return None
+        _model_registry[key] = model
+        logger.info(f"В реестр добавлен инстанс модели Gemini '{model_name}' (всего инстансов: {len(_model_registry)})")
         return model
-    except Exception as e:
-        logger.error(f"Ошибка при создании инстанса модели Gemini '{model_name}': {e}")
-        return None
+
+
+def warm_gemini_models(model_names: list | None = None) -> int:
+    """
+    Прогревает реестр при старте приложения: создает инстансы моделей и общий async-клиент
+    Gemini, чтобы первый пользовательский запрос не тратил время на их инициализацию.
+    Вызывается из event loop (startup), т.к. async-клиент привязывается к текущему loop.
+    
+    Returns:
+        int: Количество прогретых моделей
+    """
+    warmed = 0
+    for model_name in model_names or GEMINI_WARM_MODELS:
+        if get_gemini_model(model_name) is not None:
+            warmed += 1
+    if warmed:
+        try:
+            genai_client.get_default_generative_async_client()
+        except Exception as e:
+            logger.warning(f"Не удалось заранее создать async-клиент Gemini: {e}")
+    logger.info(f"Прогрето моделей Gemini: {warmed}")
+    return warmed
+
+
+def record_model_call(model_name: str, latency_seconds: float, error: bool = False):
+    """Учитывает вызов модели в статистике реестра"""
+    with _model_registry_lock:
+        stats = _model_stats.setdefault(model_name, {"calls": 0, "errors": 0, "total_latency": 0.0})
+        stats["calls"] += 1
+        stats["total_latency"] += latency_seconds
+        if error:
+            stats["errors"] += 1
+
+
+def get_model_stats() -> dict:
+    """Статистика по моделям: количество вызовов, ошибок, средняя задержка и число инстансов в реестре"""
+    with _model_registry_lock:
+        instances: dict = {}
+        for key in _model_registry:
+            name = json.loads(key)["model"]
+            instances[name] = instances.get(name, 0) + 1
+        result = {}
+        for name in set(instances) | set(_model_stats):
+            stats = _model_stats.get(name, {"calls": 0, "errors": 0, "total_latency": 0.0})
+            result[name] = {
+                "instances": instances.get(name, 0),
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "avg_latency_ms": round(stats["total_latency"] / stats["calls"] * 1000, 1) if stats["calls"] else 0.0,
+            }
+        return result
+
+def get_context_cache_stats() -> dict:
+    """Статистика context caching инструкций: активные кэши, созданные, неудачные, истекшие"""
+    with _model_registry_lock:
+        return {
+            "enabled": GEMINI_CONTEXT_CACHE_ENABLED,
+            "active": sum(1 for entry in _context_caches.values() if entry[0] is not None),
+            "retry_pending": sum(1 for entry in _context_caches.values() if entry[0] is None),
+            **_context_cache_stats,
+        }
+
+# --- Маршрутизация задач по моделям ---
+# Каждая задача (уточняющие вопросы, извлечение, сводка, фрагменты документа и т.д.) получает
+# модель и бюджет ответа из таблицы маршрутов. Модель задается псевдонимом "fast" / "heavy"
+# или полным именем; если вход длиннее heavy_above_tokens, задача уходит на heavy_model
+# с бюджетом heavy_max_output_tokens. Маршруты переопределяются JSON в LLM_MODEL_ROUTES, например
+# {"summary": {"model": "heavy"}, "website_import": {"heavy_above_tokens": 20000}}.
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", DEFAULT_GEMINI_MODEL)
+GEMINI_HEAVY_MODEL = os.getenv("GEMINI_HEAVY_MODEL", "models/gemini-2.5-flash")
+# Порог входа (оценка токенов промпта), начиная с которого задача уходит на heavy-модель
+LLM_HEAVY_INPUT_TOKENS = int(os.getenv("LLM_HEAVY_INPUT_TOKENS", "12000"))
+LLM_MODEL_ROUTES = os.getenv("LLM_MODEL_ROUTES", "")
+# Цены моделей для оценки стоимости маршрутов: JSON {"модель": [USD за 1M входных, за 1M выходных токенов]}
+LLM_MODEL_PRICES = os.getenv("LLM_MODEL_PRICES", "")
+
+_MODEL_ALIASES = {"fast": GEMINI_FAST_MODEL, "heavy": GEMINI_HEAVY_MODEL}
+_DEFAULT_MODEL_PRICES = {
+    "models/gemini-2.0-flash-001": [0.10, 0.40],
+    "models/gemini-2.5-flash": [0.30, 2.50],
+}
+_DEFAULT_MODEL_ROUTES = {
+    # Три коротких вопроса
+    "follow_up_questions": {"model": "fast", "max_output_tokens": 512},
+    # JSON с полями брифинга и вопросами
+    "briefing_turn": {"model": "fast", "max_output_tokens": 2048},
+    "extraction": {"model": "fast", "max_output_tokens": 2048},
+    # Портреты эксперта, аудитории и конкурентов по тексту сайта (вход до DOCUMENT_TOKEN_BUDGET)
+    "website_import": {"model": "fast", "max_output_tokens": 4096},
+    "summary": {"model": "fast", "max_output_tokens": 1024},
+    "conversation_summary": {"model": "fast", "max_output_tokens": 1024},
+    "document": {"model": "fast", "max_output_tokens": 2048},
+    "document_chunk": {"model": "fast", "max_output_tokens": 2048},
+}
+# Значения по умолчанию для полей маршрута, не заданных в таблице
+_ROUTE_DEFAULTS = {
+    "model": "fast",
+    "max_output_tokens": 2048,
+    "heavy_model": "heavy",
+    # heavy-модель тратит часть бюджета ответа на рассуждения
+    "heavy_max_output_tokens": 8192,
+    "heavy_above_tokens": LLM_HEAVY_INPUT_TOKENS,
+}
+
+_ROUTE_LATENCY_SAMPLES = 500
+_route_stats: dict = {}
+_route_stats_lock = threading.Lock()
+
+
+def _load_json_setting(name: str, raw: str) -> dict:
+    if not raw:
+        return {}
+    try:
+        value = json.loads(raw)
+        if isinstance(value, dict):
+            return value
+        logger.error(f"{name} должна быть JSON-объектом, настройка игнорируется")
+    except ValueError as e:
+        logger.error(f"Не удалось разобрать {name}: {e}")
+    return {}
+
+
+def _build_model_routes() -> dict:
+    routes = {task: dict(_ROUTE_DEFAULTS, **route) for task, route in _DEFAULT_MODEL_ROUTES.items()}
+    for task, override in _load_json_setting("LLM_MODEL_ROUTES", LLM_MODEL_ROUTES).items():
+        if isinstance(override, dict):
+            routes[task] = dict(routes.get(task, _ROUTE_DEFAULTS), **override)
+    return routes
+
+
+_model_routes = _build_model_routes()
+_model_prices = {**_DEFAULT_MODEL_PRICES, **_load_json_setting("LLM_MODEL_PRICES", LLM_MODEL_PRICES)}
+
+
+class ModelRoute:
+    """Модель и бюджет ответа, выбранные для задачи."""
+
+    def __init__(self, task: str, model_name: str, max_output_tokens: int, tier: str):
+        self.task = task
+        self.model_name = model_name
+        self.max_output_tokens = max_output_tokens
+        # "base" или "heavy" (вход длиннее heavy_above_tokens) - какая ветка маршрута выбрана
+        self.tier = tier
+
+    def generation_config(self, generation_config: dict | None = None) -> dict:
+        """Параметры генерации с бюджетом ответа маршрута"""
+        return dict(generation_config or {}, max_output_tokens=self.max_output_tokens)
+
+
+def _resolve_model_name(name: str) -> str:
+    return _MODEL_ALIASES.get(name, name)
+
+
+def resolve_model_route(task: str, input_tokens: int = 0) -> ModelRoute:
+    """Модель и бюджет ответа для задачи с учетом размера входа (оценка токенов промпта)"""
+    route = _model_routes.get(task)
+    if route is None:
+        logger.warning(f"Для задачи '{task}' нет маршрута модели, используются значения по умолчанию")
+        route = _ROUTE_DEFAULTS
+    heavy_above = route.get("heavy_above_tokens") or 0
+    if heavy_above > 0 and input_tokens > heavy_above:
+        return ModelRoute(task, _resolve_model_name(route["heavy_model"]), int(route["heavy_max_output_tokens"]), "heavy")
+    return ModelRoute(task, _resolve_model_name(route["model"]), int(route["max_output_tokens"]), "base")
+
+
+def estimate_call_cost(model_name: str, input_tokens: int, output_tokens: int) -> float:
+    """Оценка стоимости вызова в USD по LLM_MODEL_PRICES (0, если цена модели неизвестна)"""
+    input_price, output_price = _model_prices.get(model_name, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def record_route_call(task: str, model_name: str, latency_seconds: float, input_tokens: int = 0, output_tokens: int = 0, error: bool = False):
+    """Учитывает вызов модели в статистике маршрута задачи"""
+    with _route_stats_lock:
+        stats = _route_stats.setdefault(
+            (task, model_name),
+            # Для p95 храним последние _ROUTE_LATENCY_SAMPLES замеров
+            {"calls": 0, "errors": 0, "total_latency": 0.0, "latencies": deque(maxlen=_ROUTE_LATENCY_SAMPLES), "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0},
+        )
+        stats["calls"] += 1
+        stats["total_latency"] += latency_seconds
+        stats["latencies"].append(latency_seconds)
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+        stats["cost_usd"] += estimate_call_cost(model_name, input_tokens, output_tokens)
+        if error:
+            stats["errors"] += 1
+
+
+def get_route_stats() -> dict:
+    """Таблица маршрутов и задержка, токены и стоимость вызовов по задачам и моделям"""
+    with _route_stats_lock:
+        calls = {}
+        for (task, model_name), stats in sorted(_route_stats.items()):
+            latencies = sorted(stats["latencies"])
+            calls.setdefault(task, {})[model_name] = {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "avg_latency_ms": round(stats["total_latency"] / stats["calls"] * 1000, 1) if stats["calls"] else 0.0,
+                "p95_latency_ms": round(latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1000, 1) if latencies else 0.0,
+                "input_tokens": stats["input_tokens"],
+                "output_tokens": stats["output_tokens"],
+                "cost_usd": round(stats["cost_usd"], 6),
+            }
+    policy = {
+        task: {
+            "model": _resolve_model_name(route["model"]),
+            "max_output_tokens": route["max_output_tokens"],
+            "heavy_model": _resolve_model_name(route["heavy_model"]),
+            "heavy_max_output_tokens": route["heavy_max_output_tokens"],
+            "heavy_above_tokens": route["heavy_above_tokens"],
+        }
+        for task, route in _model_routes.items()
+    }
+    return {"policy": policy, "calls": calls}
+
+# --- Бэкенд LLM ---
+# gemini (по умолчанию) или fake - локальная модель для нагрузочных тестов (см. llm_backends)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").strip().lower()
+
+_llm_backend = None
+
+
+def get_llm_backend():
+    """Возвращает бэкенд LLM процесса (создается при первом обращении по LLM_BACKEND)"""
+    global _llm_backend
+    if _llm_backend is None:
+        # Импорт здесь: llm_backends сам использует реестр моделей этого модуля
+        from .llm_backends import create_llm_backend
+
+        _llm_backend = create_llm_backend(LLM_BACKEND)
+        logger.info(f"Бэкенд LLM: {_llm_backend.name}")
+    return _llm_backend
+
+
+def set_llm_backend(backend):
+    """Подменяет бэкенд LLM процесса (бенчмарки, локальные прогоны)"""
+    global _llm_backend
+    _llm_backend = backend
+    logger.info(f"Бэкенд LLM заменен: {backend.name}")
 
 # Вызываем настройку при импорте модуля, чтобы быть готовыми
 setup_gemini_api()
@@ -0,0 +1,267 @@
+"""
+Бэкенды LLM.
+
+llm_client обращается к модели не через google.generativeai напрямую, а через
+бэкенд, выбранный в api_setup.get_llm_backend() (переменная окружения LLM_BACKEND):
+
+- "gemini" (по умолчанию) - Gemini через реестр моделей api_setup;
+- "fake" - локальная модель без сети и квоты для нагрузочного тестирования: отвечает
+  детерминированным (по промпту и FAKE_LLM_SEED) текстом или JSON, валидным по схеме
+  ответа (response_schema), с настраиваемым распределением задержки и инъекцией ошибок.
+
+Настройки fake-бэкенда:
+- FAKE_LLM_LATENCY: "fixed:0.5" | "uniform:0.2,1.5" | "lognormal:0.8,0.5" (медиана, sigma) | "0" - без задержки;
+- FAKE_LLM_ERROR_RATE: доля вызовов, завершающихся ошибкой (0..1);
+- FAKE_LLM_ERROR_CODES: коды ошибок через запятую (429/503 повторяются governor'ом);
+- FAKE_LLM_SEED: зерно генератора;
+- FAKE_LLM_TEXT: ответ на промпты без схемы (по умолчанию - короткий текст с двумя вопросами).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from .api_setup import GEMINI_CONTEXT_CACHE_ENABLED, get_gemini_model, warm_gemini_models
+
+logger = logging.getLogger(__name__)
+
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "lognormal:0.8,0.5")
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_ERROR_CODES = [int(code) for code in os.getenv("FAKE_LLM_ERROR_CODES", "429,503").split(",") if code.strip()]
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+FAKE_LLM_TEXT = os.getenv(
+    "FAKE_LLM_TEXT",
+    "Эксперт помогает клиентам быстрее достигать результата.\n"
+    "Какую главную проблему клиента решает ваш продукт?\n"
+    "Через какие этапы проходит клиент до покупки?",
+)
+
+# Доля задержки до первого фрагмента в потоковом режиме
+_FAKE_FIRST_CHUNK_SHARE = 0.3
+_FAKE_STREAM_CHUNK_CHARS = 40
+
+
+class LLMUnavailableError(RuntimeError):
+    """Модель недоступна (API не сконфигурировано или не удалось создать инстанс)."""
+
+
+class FakeLLMError(RuntimeError):
+    """Ошибка, внедренная fake-бэкендом (code - HTTP-код, как у ошибок google.api_core)."""
+
+    def __init__(self, code: int):
+        super().__init__(f"Fake LLM error {code}")
+        self.code = code
+
+
+class LLMResult:
+    """Ответ модели: текст и расход токенов (если бэкенд его сообщает)."""
+
+    def __init__(self, text: str, input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0):
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        # Часть input_tokens, взятая из context cache
+        self.cached_tokens = cached_tokens
+
+
+class LLMBackend:
+    """Интерфейс бэкенда LLM."""
+
+    name = "base"
+
+    def is_available(self, model_name: str, generation_config: Optional[Dict[str, Any]] = None, safety_settings: Optional[List[Dict[str, str]]] = None) -> bool:
+        return True
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None, safety_settings: Optional[List[Dict[str, str]]] = None, system_instruction: Optional[str] = None) -> LLMResult:
+        """Генерирует ответ; system_instruction - статическая часть промпта (см. services/prompts.py)"""
+        raise NotImplementedError
+
+    async def stream(self, model_name: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None, safety_settings: Optional[List[Dict[str, str]]] = None, system_instruction: Optional[str] = None) -> AsyncIterator[str]:
+        """Открывает поток фрагментов ответа (ошибки до первого фрагмента повторяются governor'ом)"""
+        raise NotImplementedError
+
+    def warm(self) -> int:
+        """Прогрев при старте приложения. Возвращает количество подготовленных моделей."""
+        return 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class GeminiBackend(LLMBackend):
+    """Gemini через реестр моделей api_setup."""
+
+    name = "gemini"
+
+    async def _model(self, model_name, generation_config, safety_settings, system_instruction=None):
+        # Параметры генерации, безопасности и инструкция уже зашиты в инстанс из реестра
+        if system_instruction and GEMINI_CONTEXT_CACHE_ENABLED:
+            # Создание (и продление) context cache - синхронный сетевой вызов, выполняем вне event loop
+            model = await asyncio.to_thread(get_gemini_model, model_name, generation_config, safety_settings, system_instruction)
+        else:
+            model = get_gemini_model(model_name, generation_config, safety_settings, system_instruction)
+        if not model:
+            raise LLMUnavailableError("Модель Gemini недоступна")
+        return model
+
+    def is_available(self, model_name, generation_config=None, safety_settings=None) -> bool:
+        return get_gemini_model(model_name, generation_config, safety_settings) is not None
+
+    async def generate(self, model_name, prompt, generation_config=None, safety_settings=None, system_instruction=None) -> LLMResult:
+        model = await self._model(model_name, generation_config, safety_settings, system_instruction)
+        response = await model.generate_content_async(prompt)
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResult(
+            response.text,
+            input_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+            cached_tokens=getattr(usage, "cached_content_token_count", 0) or 0,
+        )
+
+    async def stream(self, model_name, prompt, generation_config=None, safety_settings=None, system_instruction=None) -> AsyncIterator[str]:
+        model = await self._model(model_name, generation_config, safety_settings, system_instruction)
+        response = await model.generate_content_async(prompt, stream=True)
+
+        async def chunks():
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+
+        return chunks()
+
+    def warm(self) -> int:
+        return warm_gemini_models()
+
+
+def parse_latency_spec(spec: str) -> Callable[[random.Random], float]:
+    """Разбирает описание распределения задержки (см. FAKE_LLM_LATENCY)"""
+    kind, _, params = (spec or "0").partition(":")
+    values = [float(value) for value in params.split(",") if value.strip()]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values[0], values[1] if len(values) > 1 else 0.5
+        return lambda rng: rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+    # Просто число - фиксированная задержка
+    delay = float(kind)
+    return lambda rng: delay
+
+
+class FakeLLMBackend(LLMBackend):
+    """Локальная модель для нагрузочных тестов: без сети, с управляемой задержкой и ошибками."""
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency: str = FAKE_LLM_LATENCY,
+        error_rate: float = FAKE_LLM_ERROR_RATE,
+        error_codes: Optional[List[int]] = None,
+        seed: int = FAKE_LLM_SEED,
+        text: str = FAKE_LLM_TEXT,
+        blocking: bool = False,
+    ):
+        self.latency_spec = latency
+        self._latency = parse_latency_spec(latency)
+        self.error_rate = error_rate
+        self.error_codes = error_codes or FAKE_LLM_ERROR_CODES or [503]
+        self.seed = seed
+        self.text = text
+        # blocking=True имитирует синхронный вызов модели внутри async-кода (блокирует event loop)
+        self.blocking = blocking
+        self._calls = 0
+        self._rng = random.Random(seed)
+
+    def _prompt_rng(self, prompt: str, generation_config: Optional[Dict[str, Any]]) -> random.Random:
+        """Генератор содержимого ответа: один и тот же промпт всегда дает один и тот же ответ"""
+        digest = hashlib.sha256(f"{self.seed}:{prompt}:{sorted((generation_config or {}).keys())}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    async def _sleep(self, seconds: float):
+        if seconds <= 0:
+            return
+        if self.blocking:
+            time.sleep(seconds)
+        else:
+            await asyncio.sleep(seconds)
+
+    def _maybe_fail(self):
+        self._calls += 1
+        if self.error_rate > 0 and self._rng.random() < self.error_rate:
+            raise FakeLLMError(self._rng.choice(self.error_codes))
+
+    def _render(self, prompt: str, generation_config: Optional[Dict[str, Any]]) -> str:
+        schema = (generation_config or {}).get("response_schema")
+        if not schema:
+            return self.text
+        return json.dumps(_fake_value(schema, self._prompt_rng(prompt, generation_config), "result"), ensure_ascii=False)
+
+    async def generate(self, model_name, prompt, generation_config=None, safety_settings=None, system_instruction=None) -> LLMResult:
+        delay = self._latency(self._rng)
+        await self._sleep(delay)
+        self._maybe_fail()
+        text = self._render(prompt, generation_config)
+        input_chars = len(prompt) + len(system_instruction or "")
+        return LLMResult(text, input_tokens=input_chars // 4 + 1, output_tokens=len(text) // 4 + 1)
+
+    async def stream(self, model_name, prompt, generation_config=None, safety_settings=None, system_instruction=None) -> AsyncIterator[str]:
+        delay = self._latency(self._rng)
+        await self._sleep(delay * _FAKE_FIRST_CHUNK_SHARE)
+        self._maybe_fail()
+        text = self._render(prompt, generation_config)
+        pieces = [text[pos:pos + _FAKE_STREAM_CHUNK_CHARS] for pos in range(0, len(text), _FAKE_STREAM_CHUNK_CHARS)] or [""]
+        pause = delay * (1 - _FAKE_FIRST_CHUNK_SHARE) / len(pieces)
+
+        async def chunks():
+            for index, piece in enumerate(pieces):
+                if index:
+                    await self._sleep(pause)
+                yield piece
+
+        return chunks()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"calls": self._calls, "latency": self.latency_spec, "error_rate": self.error_rate}
+
+
+def _fake_value(schema: Dict[str, Any], rng: random.Random, name: str) -> Any:
+    """Значение, валидное по схеме ответа Gemini (подмножество OpenAPI, см. structured_output)"""
+    kind = schema.get("type", "string")
+    if kind == "object":
+        return {key: _fake_value(prop, rng, key) for key, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_fake_value(schema.get("items", {"type": "string"}), rng, name) for _ in range(rng.randint(2, 3))]
+    if kind == "integer":
+        return rng.randint(1, 100)
+    if kind == "number":
+        return round(rng.uniform(1, 100), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if schema.get("enum"):
+        return rng.choice(schema["enum"])
+    label = schema.get("description") or name
+    value = f"{label}: тестовое значение {rng.randint(1, 999)}"
+    # Вопросы должны выглядеть как вопросы (фильтр по "?")
+    return value + "?" if "question" in name else value
+
+
+_BACKENDS = {
+    GeminiBackend.name: GeminiBackend,
+    FakeLLMBackend.name: FakeLLMBackend,
+}
+
+
+def create_llm_backend(name: str) -> LLMBackend:
+    """Создает бэкенд по имени (LLM_BACKEND)"""
+    backend_class = _BACKENDS.get(name)
+    if backend_class is None:
+        logger.error(f"Неизвестный LLM_BACKEND '{name}', используется gemini")
+        backend_class = GeminiBackend
+    return backend_class()
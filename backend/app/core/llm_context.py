@@ -0,0 +1,116 @@
+"""
+Контекст текущего вызова LLM (кто и откуда обращается к модели).
+
+Значения хранятся в contextvar и привязываются один раз на запрос - в зависимостях
+аутентификации (uid и маршрут) или в сервисе (id проекта). Сервисы LLM-слоя
+(governor, учет и т.д.) читают контекст, не требуя передавать uid через все функции.
+
+Дедлайн запроса (deadline, по часам time.monotonic) задается зависимостью llm_deadline()
+на роутере или эндпоинте и доходит до llm_client без передачи через gemini.py и сервисы:
+вызов модели, не уложившийся в оставшееся время, отменяется с LLMDeadlineExceeded (HTTP 504).
+Фоновые задачи задают собственный дедлайн (LLM_BACKGROUND_DEADLINE_SECONDS), так как
+выполняются после ответа в контексте запроса.
+"""
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# --- Настройки (из переменных окружения) ---
+# Дедлайн обычного запроса, обращающегося к модели
+LLM_REQUEST_DEADLINE_SECONDS = float(os.getenv("LLM_REQUEST_DEADLINE_SECONDS", "60"))
+# Дедлайн долгих запросов (импорт сайта, анализ документа, пакетные сводки)
+LLM_LONG_REQUEST_DEADLINE_SECONDS = float(os.getenv("LLM_LONG_REQUEST_DEADLINE_SECONDS", "180"))
+# Дедлайн фоновых задач (саммари диалога, предрасчет вопросов и сводки)
+LLM_BACKGROUND_DEADLINE_SECONDS = float(os.getenv("LLM_BACKGROUND_DEADLINE_SECONDS", "300"))
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """Дедлайн запроса истек до получения ответа модели."""
+
+_llm_call_context: ContextVar[Dict[str, Any]] = ContextVar("llm_call_context", default={})
+
+
+def get_llm_call_context() -> Dict[str, Any]:
+    """Текущий контекст вызова LLM (uid, endpoint, project_id)"""
+    return _llm_call_context.get()
+
+
+def bind_llm_call_context(**values: Any):
+    """Дополняет контекст текущего запроса. Значения None игнорируются."""
+    context = dict(_llm_call_context.get())
+    context.update({key: value for key, value in values.items() if value is not None})
+    _llm_call_context.set(context)
+
+
+@contextmanager
+def llm_call_context(**values: Any) -> Iterator[Dict[str, Any]]:
+    """Временно дополняет контекст (например, для фоновой задачи) и восстанавливает прежний при выходе"""
+    context = dict(_llm_call_context.get())
+    context.update({key: value for key, value in values.items() if value is not None})
+    token = _llm_call_context.set(context)
+    try:
+        yield context
+    finally:
+        _llm_call_context.reset(token)
+
+
+def get_fairness_key() -> str:
+    """Ключ справедливой очереди: пользователь, иначе проект, иначе общий анонимный ключ"""
+    context = _llm_call_context.get()
+    if context.get("uid"):
+        return f"uid:{context['uid']}"
+    if context.get("project_id"):
+        return f"project:{context['project_id']}"
+    return "anonymous"
+
+
+def route_label(request: Optional[Any]) -> Optional[str]:
+    """Шаблон маршрута запроса (например, /api/chat/{project_id}/messages) для метрик"""
+    if request is None:
+        return None
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or request.url.path
+
+
+def deadline_after(seconds: float) -> float:
+    """Дедлайн через seconds секунд (значение для поля deadline контекста)"""
+    return time.monotonic() + seconds
+
+
+def remaining_time() -> Optional[float]:
+    """Сколько секунд осталось до дедлайна текущего запроса; None - дедлайн не задан"""
+    deadline = _llm_call_context.get().get("deadline")
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+async def run_with_deadline(awaitable: Awaitable[T]) -> T:
+    """Ждет awaitable не дольше, чем осталось до дедлайна; по истечении отменяет его"""
+    remaining = remaining_time()
+    if remaining is None:
+        return await awaitable
+    if remaining <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise LLMDeadlineExceeded("Дедлайн запроса истек до обращения к модели")
+    try:
+        return await asyncio.wait_for(awaitable, remaining)
+    except asyncio.TimeoutError as e:
+        raise LLMDeadlineExceeded(f"Модель не ответила за {remaining:.1f} с, оставшиеся до дедлайна запроса") from e
+
+
+def llm_deadline(seconds: Optional[float] = None):
+    """
+    Зависимость FastAPI: задает дедлайн вызовов модели для запроса (по умолчанию LLM_REQUEST_DEADLINE_SECONDS).
+    Зависимость эндпоинта выполняется после зависимости роутера и переопределяет ее дедлайн.
+    """
+    async def bind_deadline():
+        # async-зависимость выполняется в задаче запроса, поэтому значение видно эндпоинту
+        bind_llm_call_context(deadline=deadline_after(seconds if seconds is not None else LLM_REQUEST_DEADLINE_SECONDS))
+    return bind_deadline
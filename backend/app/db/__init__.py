@@ -1,21 +1,143 @@
-# Инициализация модуля базы данных
+"""
+Инициализация модуля базы данных.
+
+Эндпоинты работают с SQL через асинхронный движок SQLAlchemy (get_sql_db отдает AsyncSession),
+поэтому запросы не блокируют event loop. Асинхронный драйвер выбирается по схеме DATABASE_URL:
+sqlite -> aiosqlite, postgresql -> asyncpg.
+
+Соединения берутся из пула: SQL_POOL_SIZE постоянных и до SQL_MAX_OVERFLOW дополнительных;
+если свободного соединения нет дольше SQL_POOL_TIMEOUT секунд, запрос завершается ошибкой.
+Время ожидания соединения и заполненность пула доступны через get_pool_stats() и /llm/stats.
+
+Синхронные engine и SessionLocal оставлены для скриптов и бенчмарков.
+"""
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict
+
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", "10"))
+SQL_MAX_OVERFLOW = int(os.getenv("SQL_MAX_OVERFLOW", "10"))
+# Сколько секунд запрос ждет свободное соединение пула
+SQL_POOL_TIMEOUT = float(os.getenv("SQL_POOL_TIMEOUT", "30"))
+
+_ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+_WAIT_SAMPLES = 1000
+
+
+def async_database_url(url: str) -> str:
+    """URL с асинхронным драйвером для той же базы (sqlite -> aiosqlite, postgresql -> asyncpg)"""
+    scheme, separator, rest = url.partition("://")
+    driver = _ASYNC_DRIVERS.get(scheme.split("+", 1)[0])
+    return f"{driver}{separator}{rest}" if driver else url
+
+
+class _PoolWaitStats:
+    """Время получения соединения из пула асинхронного движка."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._samples: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+
+    def record(self, wait_seconds: float):
+        self.checkouts += 1
+        self.total_wait += wait_seconds
+        self.max_wait = max(self.max_wait, wait_seconds)
+        self._samples.append(wait_seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        ordered = sorted(self._samples)
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "p95_wait_ms": round(ordered[max(int(len(ordered) * 0.95) - 1, 0)] * 1000, 3) if ordered else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
 
+# Статистика общая для процесса: пул пересоздается при dispose(), а счетчики сохраняются
+_pool_wait = _PoolWaitStats()
+
+
+class MeteredAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Пул соединений асинхронного движка с замером ожидания свободного соединения."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            _pool_wait.timeouts += 1
+            logger.warning(f"Нет свободного соединения SQL за {self.timeout()} с: {self.status()}")
+            raise
+        _pool_wait.record(time.perf_counter() - started)
+        return connection
+
+
+# Логгер пула назван по модулю подкласса; уровень как у логгеров SQLAlchemy по умолчанию
+logging.getLogger(f"{__name__}.{MeteredAsyncQueuePool.__name__}").setLevel(logging.WARNING)
+
+async_engine = create_async_engine(
+    async_database_url(SQLALCHEMY_DATABASE_URL),
+    poolclass=MeteredAsyncQueuePool,
+    pool_size=SQL_POOL_SIZE,
+    max_overflow=SQL_MAX_OVERFLOW,
+    pool_timeout=SQL_POOL_TIMEOUT,
+    pool_pre_ping=not SQLALCHEMY_DATABASE_URL.startswith("sqlite"),
+)
+# expire_on_commit=False: после commit атрибуты объектов остаются загруженными -
+# неявная дозагрузка (ленивый SELECT) в асинхронной сессии невозможна
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Синхронный движок - для скриптов и бенчмарков; эндпоинты используют get_sql_db
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else {},
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+
 # Функция для получения сессии базы данных
-def get_sql_db():
-    db = SessionLocal()
-    try:
+async def get_sql_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Заполненность пула соединений асинхронного движка и время ожидания соединения"""
+    pool = async_engine.pool
+    return {
+        "pool_size": SQL_POOL_SIZE,
+        "max_overflow": SQL_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        **_pool_wait.get_stats(),
+    }
+
+
+async def close_sql_engine():
+    """Закрывает соединения пула (при остановке приложения)"""
+    await async_engine.dispose()
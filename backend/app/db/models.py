@@ -1,4 +1,5 @@
-from sqlalchemy import Boolean, Column, Integer, String, DateTime, ForeignKey, Text, JSON
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, ForeignKey, Text, JSON, Index
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 import uuid
@@ -37,6 +38,11 @@ class Project(Base):
     # Данные брифинга
     briefing_data = Column(JSON, nullable=True)
     
+    # Скользящая память чата: краткое содержание ранней части диалога
+    # и id последнего сообщения, которое в него вошло
+    conversation_summary = Column(Text, nullable=True)
+    summarized_message_id = Column(Integer, nullable=True)
+    
     # Отношение к пользователю
     owner = relationship("User", back_populates="projects")
     
@@ -46,12 +52,44 @@ class Project(Base):
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    # Keyset-пагинация истории чата (services/chat_history)
+    __table_args__ = (
+        Index("ix_chat_messages_project_created_id", "project_id", "created_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("projects.id"))
     role = Column(String)  # 'user' или 'assistant'
     content = Column(Text)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # В SQLite время хранится строкой: CURRENT_TIMESTAMP пишет его без микросекунд, и параметры
+    # запросов (курсоры истории) должны иметь тот же формат, иначе строки сравниваются неверно
+    created_at = Column(
+        DateTime(timezone=True).with_variant(sqlite.DATETIME(truncate_microseconds=True), "sqlite"),
+        server_default=func.now(),
+    )
     
     # Отношение к проекту
-    project = relationship("Project", back_populates="chat_messages")
\ No newline at end of file
+    project = relationship("Project", back_populates="chat_messages")
+
+class AskedQuestion(Base):
+    __tablename__ = "asked_questions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
+    # Уточняющий вопрос, заданный ассистентом (извлекается при сохранении сообщения)
+    text = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class UploadedFile(Base):
+    __tablename__ = "uploaded_files"
+    # Повторная загрузка файла в проект распознается по sha256 содержимого (POST /chat/{project_id}/upload)
+    __table_args__ = (
+        Index("ix_uploaded_files_project_sha256", "project_id", "sha256"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id"))
+    sha256 = Column(String(64))
+    filename = Column(String)
+    size = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,104 @@
+"""
+Обновление схемы SQL-базы до моделей app.db.models (миграций в репозитории нет).
+
+Обновление идемпотентно: создаются отсутствующие таблицы (вместе с их индексами), отсутствующие
+столбцы существующих таблиц (ALTER TABLE ... ADD COLUMN) и отсутствующие индексы. Существующие
+столбцы и индексы не изменяются и не удаляются, повторный запуск ничего не меняет.
+
+Покрывает изменения схемы:
+- projects.conversation_summary, projects.summarized_message_id - скользящая память чата;
+- таблица asked_questions - индекс заданных уточняющих вопросов;
+- индекс ix_chat_messages_project_created_id - keyset-пагинация истории чата;
+- таблица uploaded_files и индекс ix_uploaded_files_project_sha256 - повторные загрузки файлов.
+Для новой (пустой) базы создается вся схема.
+
+Запуск из директории backend (база - из DATABASE_URL, как у приложения):
+    python -m app.db.schema_upgrade --dry-run
+    python -m app.db.schema_upgrade
+При SQL_SCHEMA_UPGRADE_ON_STARTUP=1 обновление выполняется при старте приложения
+(только для одного процесса: несколько воркеров могут одновременно создавать одну таблицу).
+"""
+import argparse
+import logging
+import os
+from typing import List
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Connection
+
+from app.db import Base, async_engine, engine
+from app.db import models  # noqa: F401 - регистрирует таблицы в Base.metadata
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+SQL_SCHEMA_UPGRADE_ON_STARTUP = os.getenv("SQL_SCHEMA_UPGRADE_ON_STARTUP", "0").lower() not in ("0", "false", "no")
+
+
+def upgrade_schema(connection: Connection, dry_run: bool = False) -> List[str]:
+    """
+    Приводит схему базы к моделям: отсутствующие таблицы, столбцы и индексы.
+    Returns:
+        List[str]: Выполненные (при dry_run - необходимые) изменения
+    """
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    existing_tables = set(inspector.get_table_names())
+    changes: List[str] = []
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            changes.append(f"CREATE TABLE {table.name}")
+            if not dry_run:
+                table.create(connection)
+            continue
+
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise RuntimeError(f"Столбец {table.name}.{column.name} без NULL и значения по умолчанию нельзя добавить автоматически")
+            statement = (
+                f"ALTER TABLE {preparer.format_table(table)} "
+                f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=connection.dialect)}"
+            )
+            changes.append(statement)
+            if not dry_run:
+                connection.exec_driver_sql(statement)
+
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            changes.append(f"CREATE INDEX {index.name} ON {table.name}")
+            if not dry_run:
+                index.create(connection)
+
+    return changes
+
+
+async def upgrade_schema_on_startup():
+    """Обновление схемы при старте приложения (если включено SQL_SCHEMA_UPGRADE_ON_STARTUP)"""
+    if not SQL_SCHEMA_UPGRADE_ON_STARTUP:
+        return
+    async with async_engine.begin() as connection:
+        changes = await connection.run_sync(upgrade_schema)
+    for change in changes:
+        logger.info(f"Схема SQL обновлена: {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обновление схемы SQL-базы до моделей приложения")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать необходимые изменения")
+    args = parser.parse_args()
+    with engine.begin() as connection:
+        changes = upgrade_schema(connection, dry_run=args.dry_run)
+    if not changes:
+        print("Схема актуальна")
+    for change in changes:
+        print(f"{'требуется' if args.dry_run else 'выполнено'}: {change}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,20 @@
-# Файл очищен для рефакторинга
+from pydantic import BaseModel, Field
+from typing import List
+
+
+class FunnelElementData(BaseModel):
+    """Этап продуктовой воронки"""
+    name: str = Field("", description="Название этапа")
+    description: str = Field("", description="Подробное описание этапа")
+
+
+class BriefingExtraction(BaseModel):
+    """Данные брифинга, которые модель извлекает из сообщения или документа"""
+    utp: str = Field("", description="Уникальное торговое предложение")
+    product_description: str = Field("", description="Описание продукта/услуги")
+    funnel_elements: List[FunnelElementData] = Field(default_factory=list, description="Этапы продуктовой воронки по порядку")
+
+
+class BriefingTurnExtraction(BriefingExtraction):
+    """Результат объединенного хода брифинга: данные и уточняющие вопросы"""
+    follow_up_questions: List[str] = Field(default_factory=list, description="2-3 уточняющих вопроса о недостающей информации")
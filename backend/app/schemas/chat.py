@@ -25,8 +25,11 @@ class ChatMessageResponse(ChatMessageBase):
 
 
 class ChatHistoryResponse(BaseModel):
-    """Схема для ответа с историей чата"""
+    """Схема для ответа со страницей истории чата (см. services/chat_history)"""
     messages: List[ChatMessageResponse]
+    older_cursor: Optional[str] = Field(None, description="Курсор для параметра before: более старые сообщения (null - начало диалога)")
+    newer_cursor: Optional[str] = Field(None, description="Курсор для параметра since: новые сообщения после этой страницы")
+    has_more: bool = Field(False, description="Режим since: новых сообщений больше, чем limit")
 
     class Config:
         orm_mode = True
\ No newline at end of file
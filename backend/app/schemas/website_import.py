@@ -38,10 +38,13 @@ class CompetitorPortraitData(BaseModel):
             return [v] if v.strip() else [] 
         return v # Если это уже список, возвращаем как есть
 
-class WebsiteImportResponse(BaseModel):
-    """Схема для ответа с извлеченными данными."""
+class WebsiteImportExtraction(BaseModel):
+    """Схема данных, которые модель извлекает из текста сайта (она же - схема ответа Gemini)."""
     expert_portrait: ExpertPortraitData = Field(default_factory=ExpertPortraitData)
     target_audience_portrait: AudiencePortraitData = Field(default_factory=AudiencePortraitData)
     competitor_portrait: CompetitorPortraitData = Field(default_factory=CompetitorPortraitData)
+
+class WebsiteImportResponse(WebsiteImportExtraction):
+    """Схема для ответа с извлеченными данными."""
     # Можно добавить исходный URL для справки
     source_url: Optional[HttpUrl] = None
@@ -1,12 +1,14 @@
 from datetime import datetime, timedelta
 from typing import Optional
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.core.llm_context import bind_llm_call_context, route_label
 from app.db import get_sql_db
 from app.db.models import User
 from app.schemas.user import TokenData, UserCreate
@@ -31,15 +33,15 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def get_user(db: Session, email: str):
+async def get_user(db: AsyncSession, email: str):
     """Получение пользователя по email"""
-    return db.query(User).filter(User.email == email).first()
+    return await db.scalar(select(User).where(User.email == email))
 
 
-def create_user(db: Session, user: UserCreate):
+async def create_user(db: AsyncSession, user: UserCreate):
     """Создание нового пользователя"""
     # Проверяем, существует ли пользователь с таким email
-    db_user = get_user(db, email=user.email)
+    db_user = await get_user(db, email=user.email)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -47,7 +49,7 @@ def create_user(db: Session, user: UserCreate):
         )
     
     # Проверяем, существует ли пользователь с таким username
-    db_user_by_username = db.query(User).filter(User.username == user.username).first()
+    db_user_by_username = await db.scalar(select(User).where(User.username == user.username))
     if db_user_by_username:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -62,14 +64,14 @@ def create_user(db: Session, user: UserCreate):
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 
-def authenticate_user(db: Session, email: str, password: str):
+async def authenticate_user(db: AsyncSession, email: str, password: str):
     """Аутентификация пользователя"""
-    user = get_user(db, email)
+    user = await get_user(db, email)
     if not user:
         return False
     if not verify_password(password, user.hashed_password):
@@ -89,24 +91,31 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_sql_db)):
-    """Получение текущего пользователя по токену"""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def get_user_by_token(db: AsyncSession, token: str) -> Optional[User]:
+    """Пользователь по JWT токену; None, если токен недействителен (например, для WebSocket)"""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
-            raise credentials_exception
+            return None
         token_data = TokenData(email=email)
     except JWTError:
-        raise credentials_exception
-    user = get_user(db, email=token_data.email)
+        return None
+    return await get_user(db, email=token_data.email)
+
+
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_sql_db)):
+    """Получение текущего пользователя по токену"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    user = await get_user_by_token(db, token)
     if user is None:
         raise credentials_exception
+    # Привязываем пользователя к контексту запроса для справедливой очереди вызовов LLM
+    bind_llm_call_context(uid=f"user-{user.id}", endpoint=route_label(request))
     return user
 
 
@@ -0,0 +1,144 @@
+"""
+Локальное слияние данных брифинга.
+
+Модель возвращает только изменения (дельту): поля, которые нужно заменить,
+и новые или дополненные этапы воронки. Текущее состояние брифинга собирается
+здесь, детерминированно и без повторного вызова модели:
+
+- utp / product_description: непустое значение из дельты заменяет текущее,
+  пустое означает "без изменений";
+- этапы воронки сопоставляются по нормализованному названию (регистр, пунктуация,
+  "ё"), а затем нечетко (difflib): "Бесплатный вебинар" и "Вебинар (бесплатный)" -
+  один этап;
+- у совпавшего этапа сохраняется текущее название и позиция; описание обновляется
+  по правилам конфликтов (merge_description);
+- новые этапы встают после этапа, за которым они шли в ответе модели, иначе - в конец.
+"""
+import difflib
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Порог похожести названий этапов (0..1) для нечеткого сопоставления
+FUNNEL_MATCH_THRESHOLD = float(os.getenv("FUNNEL_MATCH_THRESHOLD", "0.82"))
+
+_NON_WORD_RE = re.compile(r"[^\w\s]")
+BRIEFING_FIELDS = ("utp", "product_description")
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """Текст для сравнения: без регистра, пунктуации, лишних пробелов, "ё" -> "е" """
+    if not text:
+        return ""
+    text = text.casefold().replace("ё", "е")
+    return " ".join(_NON_WORD_RE.sub(" ", text).split())
+
+
+def stage_similarity(first: str, second: str) -> float:
+    """Похожесть нормализованных названий этапов: максимум из посимвольной и пословной"""
+    if not first or not second:
+        return 0.0
+    if first == second:
+        return 1.0
+    char_ratio = difflib.SequenceMatcher(None, first, second).ratio()
+    first_words, second_words = sorted(first.split()), sorted(second.split())
+    word_ratio = difflib.SequenceMatcher(None, " ".join(first_words), " ".join(second_words)).ratio()
+    return max(char_ratio, word_ratio)
+
+
+def find_matching_stage(name: str, stages: List[Dict[str, str]], threshold: float = FUNNEL_MATCH_THRESHOLD) -> Optional[int]:
+    """Индекс этапа с тем же (или достаточно похожим) названием, иначе None"""
+    key = normalize_text(name)
+    if not key:
+        return None
+    best_index, best_score = None, 0.0
+    for index, stage in enumerate(stages):
+        score = stage_similarity(key, normalize_text(stage.get("name")))
+        if score == 1.0:
+            return index
+        if score > best_score:
+            best_index, best_score = index, score
+    return best_index if best_score >= threshold else None
+
+
+def merge_description(current: str, incoming: str, on_conflict: str = "append") -> str:
+    """
+    Правила конфликтов для описаний:
+    - пустое новое значение не затирает текущее;
+    - если одно описание содержит другое - остается более полное;
+    - иначе on_conflict="replace" берет новое, "append" дописывает его к текущему.
+    """
+    current, incoming = (current or "").strip(), (incoming or "").strip()
+    current_key, incoming_key = normalize_text(current), normalize_text(incoming)
+    if not incoming_key or incoming_key in current_key:
+        return current
+    if not current_key or current_key in incoming_key or on_conflict == "replace":
+        return incoming
+    return f"{current} {incoming}"
+
+
+def merge_funnel_elements(
+    current: List[Dict[str, str]],
+    incoming: List[Dict[str, str]],
+    on_conflict: str = "append",
+) -> List[Dict[str, str]]:
+    """
+    Применяет этапы из дельты к текущему списку этапов воронки (текущий список не изменяется).
+
+    Args:
+        current: Текущие этапы
+        incoming: Новые и дополненные этапы в порядке, предложенном моделью
+        on_conflict: Правило для разных описаний одного этапа (см. merge_description)
+    """
+    stages = [{"name": stage.get("name") or "", "description": stage.get("description") or ""} for stage in current or []]
+    # Позиция, после которой вставляется следующий новый этап (-1 - в конец)
+    insert_after = -1
+    for element in incoming or []:
+        name = (element.get("name") or "").strip()
+        if not name:
+            continue
+        description = (element.get("description") or "").strip()
+        index = find_matching_stage(name, stages)
+        if index is not None:
+            stages[index]["description"] = merge_description(stages[index]["description"], description, on_conflict)
+            insert_after = index
+            continue
+        stage = {"name": name, "description": description}
+        if insert_after == -1 or insert_after == len(stages) - 1:
+            stages.append(stage)
+            insert_after = len(stages) - 1
+        else:
+            insert_after += 1
+            stages.insert(insert_after, stage)
+    return stages
+
+
+def apply_briefing_delta(
+    current_data: Optional[Dict[str, Any]],
+    delta: Dict[str, Any],
+    on_conflict: str = "append",
+) -> Dict[str, Any]:
+    """
+    Применяет дельту от модели к текущим данным брифинга.
+
+    Args:
+        current_data: Текущие данные брифинга (может быть None)
+        delta: Изменения: utp, product_description (пустые - без изменений) и funnel_elements (новые/дополненные этапы)
+        on_conflict: Правило для разных описаний одного этапа воронки
+
+    Returns:
+        Dict: Новые данные брифинга с полями utp, product_description и funnel_elements
+    """
+    current_data = current_data or {}
+    result: Dict[str, Any] = {}
+    for field in BRIEFING_FIELDS:
+        new_value = (delta.get(field) or "").strip()
+        result[field] = new_value or current_data.get(field) or ""
+    current_stages = current_data.get("funnel_elements")
+    if not isinstance(current_stages, list):
+        current_stages = []
+    result["funnel_elements"] = merge_funnel_elements(current_stages, delta.get("funnel_elements") or [], on_conflict)
+    return result
@@ -0,0 +1,245 @@
+"""
+Предварительный расчет уточняющих вопросов и сводки проекта.
+
+Ответы POST /{project_id}/briefing/questions и /{project_id}/summarize зависят только
+от данных проекта (briefing_data, а для сводки - еще название, описание и статус), которые
+меняются в известных точках записи: анализ брифинга, обновление брифинга и проекта, импорт
+с сайта. После такой записи фоновая задача (precompute_briefing_artifacts) заранее считает
+вопросы и сводку и сохраняет их в документ projects/{id}/briefing/precomputed вместе
+с версией - хэшем входных данных, из которых они получены.
+
+Чтение сравнивает версию сохраненного результата с версией текущих данных: совпала -
+ответ возвращается сразу, без обращения к модели; не совпала (данные изменились, а фоновый
+расчет еще не закончился или не запускался) - ответ генерируется как раньше и сохраняется.
+Если фоновый расчет той же версии еще выполняется, live-запрос присоединяется к нему через
+single_flight в gemini.
+
+summarize_projects - сводки нескольких проектов параллельно (не больше SUMMARY_BATCH_CONCURRENCY
+одновременно) с выдачей результатов по мере готовности; ошибка одного проекта не прерывает пакет.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from google.cloud import firestore
+
+from ..core.llm_context import LLM_BACKGROUND_DEADLINE_SECONDS, LLM_REQUEST_DEADLINE_SECONDS, deadline_after, llm_call_context
+from . import firebase_service, gemini
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+# Считать вопросы и сводку в фоне после записи данных брифинга. 0 - только live-генерация
+BRIEFING_PRECOMPUTE_ENABLED = os.getenv("BRIEFING_PRECOMPUTE_ENABLED", "1").lower() not in ("0", "false", "no")
+# Сколько сводок пакетного запроса генерируется одновременно (общий лимит модели задает llm_governor)
+SUMMARY_BATCH_CONCURRENCY = int(os.getenv("SUMMARY_BATCH_CONCURRENCY", "4"))
+
+# Вопросы для проекта без данных брифинга (модель не вызывается)
+DEFAULT_QUESTIONS = [
+    "Расскажите о вашем продукте или услуге",
+    "Что делает ваше предложение уникальным?",
+    "Как клиенты обычно взаимодействуют с вашим продуктом?",
+]
+
+_PRECOMPUTED_DOC = "precomputed"
+_ARTIFACTS = ("questions", "summary")
+
+# Фоновые расчеты одного проекта выполняются последовательно
+_precompute_locks: Dict[str, asyncio.Lock] = {}
+_stats: Dict[str, Dict[str, int]] = {
+    artifact: {"fresh": 0, "stale": 0, "missing": 0, "precomputed": 0, "unchanged": 0, "errors": 0}
+    for artifact in _ARTIFACTS
+}
+
+
+def content_version(payload: Any) -> str:
+    """Версия входных данных: хэш канонического JSON"""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def questions_input(project: Dict[str, Any]) -> Dict[str, Any]:
+    """Данные, от которых зависят уточняющие вопросы"""
+    briefing_data = project.get("briefing_data")
+    return briefing_data if isinstance(briefing_data, dict) else {}
+
+
+def summary_input(project: Dict[str, Any]) -> Dict[str, Any]:
+    """Данные, от которых зависит сводка проекта (формат generate_project_summary)"""
+    return {
+        "id": project.get("id"),
+        "name": project.get("name"),
+        "description": project.get("description"),
+        "status": project.get("status"),
+        "briefing_data": project.get("briefing_data", {}),
+    }
+
+
+async def compute_questions(briefing_data: Dict[str, Any]) -> List[str]:
+    """Уточняющие вопросы по данным брифинга (live-генерация)"""
+    if not briefing_data:
+        return list(DEFAULT_QUESTIONS)
+    return await gemini.generate_follow_up_questions(briefing_data)
+
+
+def _precomputed_ref(db: firestore.AsyncClient, project_id: str):
+    return db.collection("projects").document(project_id).collection("briefing").document(_PRECOMPUTED_DOC)
+
+
+async def _load_precomputed(db: firestore.AsyncClient, project_id: str) -> Dict[str, Any]:
+    try:
+        doc = await _precomputed_ref(db, project_id).get()
+        return (doc.to_dict() or {}) if doc.exists else {}
+    except Exception as e:
+        logger.error(f"Не удалось прочитать предрасчитанные данные проекта {project_id}: {e}")
+        return {}
+
+
+async def _store_precomputed(db: firestore.AsyncClient, project_id: str, artifact: str, version: str, value: Any) -> bool:
+    entry = {"version": version, "value": value, "computed_at": datetime.now()}
+    try:
+        await _precomputed_ref(db, project_id).set({artifact: entry}, merge=True)
+        return True
+    except Exception as e:
+        logger.error(f"Не удалось сохранить предрасчитанное поле {artifact} проекта {project_id}: {e}")
+        return False
+
+
+def _fresh_value(stored: Dict[str, Any], artifact: str, version: str) -> Optional[Any]:
+    """Сохраненное значение, если оно получено из данных той же версии; учитывает исход в статистике"""
+    entry = stored.get(artifact)
+    if not isinstance(entry, dict) or "value" not in entry:
+        _stats[artifact]["missing"] += 1
+        return None
+    if entry.get("version") != version:
+        _stats[artifact]["stale"] += 1
+        return None
+    _stats[artifact]["fresh"] += 1
+    return entry["value"]
+
+
+async def load_fresh_summary(db: firestore.AsyncClient, project: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Предрасчитанная сводка, если она актуальна для текущих данных проекта, иначе None"""
+    stored = await _load_precomputed(db, project["id"])
+    return _fresh_value(stored, "summary", content_version(summary_input(project)))
+
+
+async def get_follow_up_questions(db: firestore.AsyncClient, project: Dict[str, Any]) -> List[str]:
+    """Уточняющие вопросы: предрасчитанные, если актуальны, иначе live-генерация с сохранением результата"""
+    briefing_data = questions_input(project)
+    version = content_version(briefing_data)
+    stored = await _load_precomputed(db, project["id"])
+    questions = _fresh_value(stored, "questions", version)
+    if questions is not None:
+        return questions
+    questions = await compute_questions(briefing_data)
+    if questions:
+        await _store_precomputed(db, project["id"], "questions", version, questions)
+    return questions
+
+
+async def get_project_summary(db: firestore.AsyncClient, project: Dict[str, Any]) -> Dict[str, Any]:
+    """Сводка проекта: предрасчитанная, если актуальна, иначе live-генерация с сохранением результата"""
+    project_data = summary_input(project)
+    version = content_version(project_data)
+    stored = await _load_precomputed(db, project["id"])
+    summary_result = _fresh_value(stored, "summary", version)
+    if summary_result is not None:
+        return summary_result
+    summary_result = await gemini.generate_project_summary(project_data)
+    if summary_result.get("status") == "success":
+        await _store_precomputed(db, project["id"], "summary", version, summary_result)
+    return summary_result
+
+
+async def summarize_projects(
+    db: firestore.AsyncClient,
+    projects: List[Dict[str, Any]],
+    concurrency: int = SUMMARY_BATCH_CONCURRENCY,
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Сводки нескольких проектов: не больше concurrency генераций одновременно, пары
+    (project_id, результат в формате generate_project_summary) отдаются по мере готовности.
+    Исключение при генерации сводки одного проекта превращается в его результат со статусом error.
+    Если потребитель прекратил чтение, незавершенные генерации отменяются.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def summarize(project: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        async with semaphore:
+            try:
+                # Дедлайн отсчитывается для каждой сводки от ее старта, а не от начала пакета;
+                # расход модели учитывается по проекту сводки
+                with llm_call_context(project_id=project["id"], deadline=deadline_after(LLM_REQUEST_DEADLINE_SECONDS)):
+                    return project["id"], await get_project_summary(db, project)
+            except Exception as e:
+                logger.error(f"Ошибка генерации сводки проекта {project['id']} в пакете: {e}")
+                return project["id"], {"status": "error", "message": str(e)}
+
+    tasks = [asyncio.ensure_future(summarize(project)) for project in projects]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def precompute_briefing_artifacts(db: firestore.AsyncClient, project_id: str):
+    """
+    Фоновая задача: пересчитывает вопросы и сводку проекта, если данные изменились.
+    Данные проекта читаются заново, поэтому при нескольких записях подряд последний расчет
+    получает последнюю версию. Ошибки только логируются - чтение в этом случае
+    сгенерирует ответ само.
+    """
+    if not BRIEFING_PRECOMPUTE_ENABLED or db is None:
+        return
+    lock = _precompute_locks.setdefault(project_id, asyncio.Lock())
+    # Фоновая задача наследует контекст запроса - дедлайн запроса к ней не относится
+    with llm_call_context(project_id=project_id, endpoint="background:briefing_precompute", deadline=deadline_after(LLM_BACKGROUND_DEADLINE_SECONDS)):
+        async with lock:
+            await _precompute_locked(db, project_id)
+
+
+async def _precompute_locked(db: firestore.AsyncClient, project_id: str):
+    """Пересчет; вызывается под блокировкой проекта"""
+    try:
+        project = await firebase_service.get_project_by_id(db, project_id)
+        if not project:
+            return
+        stored = await _load_precomputed(db, project_id)
+        briefing_data = questions_input(project)
+        project_data = summary_input(project)
+        jobs = {
+            "questions": (content_version(briefing_data), lambda: compute_questions(briefing_data)),
+            "summary": (content_version(project_data), lambda: gemini.generate_project_summary(project_data)),
+        }
+        for artifact, (version, compute) in jobs.items():
+            if (stored.get(artifact) or {}).get("version") == version:
+                _stats[artifact]["unchanged"] += 1
+                continue
+            try:
+                value = await compute()
+                if not value or (artifact == "summary" and value.get("status") != "success"):
+                    raise ValueError(f"пустой результат или ошибка генерации: {value}")
+                if await _store_precomputed(db, project_id, artifact, version, value):
+                    _stats[artifact]["precomputed"] += 1
+            except Exception as e:
+                _stats[artifact]["errors"] += 1
+                logger.error(f"Не удалось предрасчитать {artifact} для проекта {project_id}: {e}")
+        logger.info(f"Предрасчет вопросов и сводки проекта {project_id} завершен")
+    except Exception as e:
+        logger.error(f"Ошибка фонового предрасчета для проекта {project_id}: {e}")
+
+
+def get_stats() -> Dict[str, Any]:
+    """Попадания в актуальный предрасчет и результаты фоновых расчетов по видам ответов"""
+    result = {"enabled": BRIEFING_PRECOMPUTE_ENABLED}
+    for artifact, stats in _stats.items():
+        reads = stats["fresh"] + stats["stale"] + stats["missing"]
+        result[artifact] = {**stats, "fresh_rate": round(stats["fresh"] / reads, 3) if reads else 0.0}
+    return result
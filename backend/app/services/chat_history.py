@@ -0,0 +1,96 @@
+"""
+Постраничная выдача истории чата проекта.
+
+История читается по ключу (project_id, created_at, id) - keyset-пагинация по составному
+индексу ix_chat_messages_project_created_id, поэтому стоимость страницы не зависит от длины
+диалога и от того, насколько далеко от конца находится страница (в отличие от OFFSET).
+id дополняет created_at: у сообщений, сохраненных в одну секунду, одинаковое время.
+
+Курсор - непрозрачная строка (base64 от JSON с created_at и id сообщения). Режимы:
+- без курсора - последние limit сообщений (хвост диалога, начальная загрузка);
+- before - limit сообщений, предшествующих курсору (подгрузка более старых);
+- since - сообщения после курсора (инкрементальное обновление), не больше limit за раз.
+На любой странице сообщения идут в хронологическом порядке.
+"""
+import base64
+import binascii
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import ChatMessage
+
+# --- Настройки (из переменных окружения) ---
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "50"))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", "200"))
+
+
+class InvalidCursorError(ValueError):
+    """Курсор не удалось разобрать."""
+
+
+def encode_cursor(message: ChatMessage) -> str:
+    """Курсор, указывающий на сообщение"""
+    payload = json.dumps({"c": message.created_at.isoformat(), "i": message.id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """(created_at, id) сообщения, на которое указывает курсор"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        return datetime.fromisoformat(payload["c"]), int(payload["i"])
+    except (binascii.Error, ValueError, TypeError, KeyError, UnicodeDecodeError) as e:
+        raise InvalidCursorError(f"Некорректный курсор: {cursor}") from e
+
+
+async def load_messages_page(
+    db: AsyncSession,
+    project_id: int,
+    limit: int = CHAT_HISTORY_PAGE_SIZE,
+    before: Optional[str] = None,
+    since: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Страница истории чата.
+
+    Returns:
+        Dict: messages - сообщения страницы по возрастанию времени;
+        older_cursor - курсор для before, чтобы загрузить более старые сообщения (None, если их нет);
+        newer_cursor - курсор для since, чтобы позже получить новые сообщения (для before - None);
+        has_more - в режиме since: новых сообщений больше, чем limit, и стоит сразу запросить следующую порцию
+    """
+    if before and since:
+        raise InvalidCursorError("Курсоры before и since нельзя передавать одновременно")
+    limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE_SIZE))
+    key = tuple_(ChatMessage.created_at, ChatMessage.id)
+    query = select(ChatMessage).where(ChatMessage.project_id == project_id)
+
+    if since:
+        rows = (await db.scalars(query.where(key > decode_cursor(since)).order_by(ChatMessage.created_at, ChatMessage.id).limit(limit + 1))).all()
+        messages: List[ChatMessage] = rows[:limit]
+        return {
+            "messages": messages,
+            "older_cursor": None,
+            "newer_cursor": encode_cursor(messages[-1]) if messages else since,
+            "has_more": len(rows) > limit,
+        }
+
+    if before:
+        query = query.where(key < decode_cursor(before))
+    # Страница берется с конца (новые первыми) и разворачивается в хронологический порядок
+    rows = (await db.scalars(query.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit + 1))).all()
+    messages = list(reversed(rows[:limit]))
+    has_older = len(rows) > limit
+    return {
+        "messages": messages,
+        "older_cursor": encode_cursor(messages[0]) if has_older else None,
+        # Курсор обновления нужен после загрузки хвоста; более старые страницы его не меняют
+        "newer_cursor": encode_cursor(messages[-1]) if messages and not before else None,
+        "has_more": False,
+    }
@@ -0,0 +1,272 @@
+"""
+Фоновые задачи ходов чата (режим mode=job эндпоинтов чата).
+
+Ход чата (запись в БД, один-два вызова модели, запись результата) может занимать десятки
+секунд, и медленные клиенты или прокси обрывают удерживаемый HTTP-запрос. В режиме job
+эндпоинт сразу отвечает 202 с id задачи, а ход выполняет пул воркеров:
+
+- не больше CHAT_JOB_WORKERS ходов одновременно (общий лимит вызовов модели задает llm_governor),
+  в очереди не больше CHAT_JOB_QUEUE_SIZE задач - при переполнении submit() бросает ChatJobQueueFull;
+- ходы одного проекта выполняются строго по очереди: данные брифинга следующего хода
+  читаются после записи предыдущего. В общей очереди воркеров не больше одного хода проекта,
+  остальные ждут в очереди проекта - ходы одного проекта не занимают воркеры, нужные другим;
+- задача выполняется в контексте вызова LLM запроса (uid, маршрут) с собственным дедлайном,
+  который отсчитывается от начала выполнения, а не от постановки в очередь;
+- изменения статуса (queued, running, succeeded, failed) с результатом хода публикуются
+  подписчикам канала проекта (WebSocket /chat/{project_id}/ws);
+- завершенные задачи хранятся CHAT_JOB_TTL_SECONDS для опроса (GET /chat/{project_id}/jobs/{job_id}),
+  если клиент не был подключен к каналу.
+
+Задачи и каналы живут в памяти процесса: при нескольких процессах сервера опрос и WebSocket
+должны попадать в тот же процесс, что и исходный запрос.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from app.core.llm_context import LLM_REQUEST_DEADLINE_SECONDS, deadline_after, get_llm_call_context, llm_call_context
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+# Сколько ходов выполняется одновременно
+CHAT_JOB_WORKERS = int(os.getenv("CHAT_JOB_WORKERS", "4"))
+# Максимум задач, ожидающих воркера
+CHAT_JOB_QUEUE_SIZE = int(os.getenv("CHAT_JOB_QUEUE_SIZE", "100"))
+# Сколько секунд хранить завершенную задачу для опроса
+CHAT_JOB_TTL_SECONDS = float(os.getenv("CHAT_JOB_TTL_SECONDS", "3600"))
+
+# Событий в буфере одного подписчика; при переполнении событие для него теряется (остается опрос)
+_SUBSCRIBER_BUFFER = 100
+_FINISHED = ("succeeded", "failed")
+
+
+class ChatJobQueueFull(RuntimeError):
+    """Очередь задач чата заполнена."""
+
+
+class ChatJob:
+    """Ход чата, выполняемый воркером."""
+
+    def __init__(
+        self,
+        project_id: int,
+        kind: str,
+        run: Callable[[], Awaitable[Dict[str, Any]]],
+        deadline_seconds: float,
+        followup: Optional[Callable[[int], Awaitable[Any]]] = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.project_id = project_id
+        self.kind = kind
+        self.run = run
+        self.deadline_seconds = deadline_seconds
+        self.followup = followup
+        # Контекст вызова LLM запроса (uid, маршрут) - воркер выполняет задачу от имени пользователя
+        self.context = dict(get_llm_call_context())
+        self.status = "queued"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "project_id": self.project_id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def _job_event(job: ChatJob) -> Dict[str, Any]:
+    return {"type": "job", **job.to_dict()}
+
+
+class ChatJobManager:
+    """Очередь ходов чата, пул воркеров и каналы событий проектов."""
+
+    def __init__(self, workers: int = CHAT_JOB_WORKERS, queue_size: int = CHAT_JOB_QUEUE_SIZE, ttl_seconds: float = CHAT_JOB_TTL_SECONDS):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.ttl_seconds = ttl_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._jobs: Dict[str, ChatJob] = {}
+        self._queued = 0
+        # Проекты с ходом в общей очереди или у воркера; значение - следующие ходы проекта
+        self._project_backlogs: Dict[int, Deque[ChatJob]] = {}
+        self._subscribers: Dict[int, Set[asyncio.Queue]] = {}
+        self._stats = {"submitted": 0, "rejected": 0, "started": 0, "succeeded": 0, "failed": 0, "dropped_events": 0}
+        self._wait_seconds = 0.0
+
+    def start(self):
+        """Запускает воркеры (при старте приложения или при первой задаче)"""
+        if self._worker_tasks:
+            return
+        # Лимит ожидающих задач проверяет submit(): часть из них ждет в очередях проектов
+        self._queue = asyncio.Queue()
+        # Воркеры создаются в пустом контексте: при ленивом старте из запроса они не должны
+        # унаследовать его контекст вызова LLM - контекст задает каждая задача
+        self._worker_tasks = [contextvars.Context().run(asyncio.ensure_future, self._worker()) for _ in range(self.workers)]
+        logger.info(f"Запущено воркеров задач чата: {self.workers}")
+
+    async def stop(self):
+        """Останавливает воркеры; невыполненные задачи завершаются ошибкой (failed)"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        # Выполнявшиеся задачи помечает _execute; ожидавшие в очередях иначе остались бы queued навсегда
+        unfinished = [job for job in self._jobs.values() if job.status not in _FINISHED]
+        for job in unfinished:
+            job.status, job.error = "failed", "Задача прервана остановкой сервера"
+            job.finished_at = time.time()
+            self._stats["failed"] += 1
+            self._publish(job)
+        if unfinished:
+            logger.warning(f"Остановка воркеров задач чата: не выполнено задач - {len(unfinished)}")
+        self._worker_tasks = []
+        self._queue = None
+        self._queued = 0
+        self._project_backlogs.clear()
+
+    def submit(
+        self,
+        project_id: int,
+        kind: str,
+        run: Callable[[], Awaitable[Dict[str, Any]]],
+        deadline_seconds: float = LLM_REQUEST_DEADLINE_SECONDS,
+        followup: Optional[Callable[[int], Awaitable[Any]]] = None,
+    ) -> ChatJob:
+        """
+        Ставит ход в очередь; ChatJobQueueFull, если очередь заполнена.
+        followup(project_id) выполняется тем же воркером после публикации результата
+        (например, обновление саммари диалога); его ошибки только логируются.
+        """
+        self.start()
+        self._evict_expired()
+        if self._queued >= self.queue_size:
+            self._stats["rejected"] += 1
+            raise ChatJobQueueFull(f"В очереди уже {self._queued} задач чата")
+        job = ChatJob(project_id, kind, run, deadline_seconds, followup)
+        backlog = self._project_backlogs.get(project_id)
+        if backlog is None:
+            self._project_backlogs[project_id] = deque()
+            self._queue.put_nowait(job)
+        else:
+            backlog.append(job)
+        self._queued += 1
+        self._jobs[job.id] = job
+        self._stats["submitted"] += 1
+        self._publish(job)
+        return job
+
+    def get_job(self, job_id: str) -> Optional[ChatJob]:
+        return self._jobs.get(job_id)
+
+    def snapshot(self, project_id: int) -> List[Dict[str, Any]]:
+        """События с текущим состоянием задач проекта (для нового подписчика)"""
+        return [_job_event(job) for job in self._jobs.values() if job.project_id == project_id]
+
+    @asynccontextmanager
+    async def subscribe(self, project_id: int) -> AsyncIterator[asyncio.Queue]:
+        """Очередь событий задач проекта на время подписки"""
+        events: asyncio.Queue = asyncio.Queue(maxsize=_SUBSCRIBER_BUFFER)
+        self._subscribers.setdefault(project_id, set()).add(events)
+        try:
+            yield events
+        finally:
+            subscribers = self._subscribers.get(project_id)
+            if subscribers is not None:
+                subscribers.discard(events)
+                if not subscribers:
+                    del self._subscribers[project_id]
+
+    def _publish(self, job: ChatJob):
+        event = _job_event(job)
+        for events in self._subscribers.get(job.project_id, ()):
+            try:
+                events.put_nowait(event)
+            except asyncio.QueueFull:
+                self._stats["dropped_events"] += 1
+
+    def _evict_expired(self):
+        expired_before = time.time() - self.ttl_seconds
+        for job_id in [job.id for job in self._jobs.values() if job.finished_at is not None and job.finished_at < expired_before]:
+            del self._jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._execute(job)
+            finally:
+                self._queue.task_done()
+
+    def _release_project(self, project_id: int):
+        """Ставит в общую очередь следующий ход проекта (если он есть)"""
+        backlog = self._project_backlogs.get(project_id)
+        if backlog:
+            self._queue.put_nowait(backlog.popleft())
+        else:
+            self._project_backlogs.pop(project_id, None)
+
+    async def _execute(self, job: ChatJob):
+        self._queued -= 1
+        job.status = "running"
+        job.started_at = time.time()
+        self._stats["started"] += 1
+        self._wait_seconds += job.started_at - job.created_at
+        self._publish(job)
+        try:
+            context = {**job.context, "project_id": job.project_id, "deadline": deadline_after(job.deadline_seconds)}
+            with llm_call_context(**context):
+                job.result = await job.run()
+            job.status = "succeeded"
+        except asyncio.CancelledError:
+            job.status, job.error = "failed", "Задача прервана остановкой сервера"
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка задачи чата {job.id} ({job.kind}) проекта {job.project_id}: {e}", exc_info=True)
+            job.status, job.error = "failed", str(e)
+        finally:
+            job.finished_at = time.time()
+            self._stats[job.status] += 1
+            self._publish(job)
+            if self._queue is not None:
+                self._release_project(job.project_id)
+        if job.followup is not None and job.status == "succeeded":
+            try:
+                with llm_call_context(**job.context):
+                    await job.followup(job.project_id)
+            except Exception as e:
+                logger.error(f"Ошибка продолжения задачи чата {job.id} проекта {job.project_id}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Задачи в очереди и выполняемые, итоги и среднее ожидание воркера"""
+        started = self._stats["started"]
+        return {
+            "workers": self.workers,
+            "queued": self._queued,
+            "projects": len(self._project_backlogs),
+            "running": sum(1 for job in self._jobs.values() if job.status == "running"),
+            "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values()),
+            **self._stats,
+            "avg_queue_wait_seconds": round(self._wait_seconds / started, 3) if started else 0.0,
+        }
+
+
+# Общий менеджер задач для процесса
+chat_jobs = ChatJobManager()
@@ -0,0 +1,159 @@
+"""
+Скользящая память чата брифинга.
+
+Промпт хода брифинга строится из краткого содержания ранней части диалога
+(Project.conversation_summary) и нескольких последних сообщений. Из SQL читаются
+только сообщения, еще не вошедшие в саммари, поэтому стоимость хода не растет
+с длиной диалога.
+
+Саммари обновляется инкрементально после каждого хода (фоновая задача вне пути запроса):
+модель получает предыдущее саммари и только новые сообщения, вышедшие за пределы
+"хвоста" диалога. Project.summarized_message_id - id последнего учтенного сообщения.
+
+Все выборки - диапазоны по составному индексу (project_id, created_at, id), читаемые с нужного
+конца с LIMIT, поэтому время чтения не зависит от числа сообщений проекта
+(см. benchmarks/chat_history_load.py).
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.llm_context import LLM_BACKGROUND_DEADLINE_SECONDS, deadline_after, llm_call_context
+from app.db import AsyncSessionLocal
+from app.db.models import ChatMessage, Project
+from app.services import gemini
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+# Сколько последних сообщений всегда передается в промпт дословно
+CHAT_TAIL_MESSAGES = int(os.getenv("CHAT_TAIL_MESSAGES", "8"))
+# Максимум несуммаризированных сообщений, которые читаются для промпта (если саммари отстало)
+CHAT_CONTEXT_MAX_MESSAGES = int(os.getenv("CHAT_CONTEXT_MAX_MESSAGES", "20"))
+# Максимум сообщений, добавляемых в саммари за одно обновление
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "20"))
+
+# Обновления саммари одного проекта выполняются последовательно. Блокировка хранится, пока
+# ее держит или ждет хотя бы одно обновление (число таких обновлений - в _summary_lock_users)
+_summary_locks: Dict[int, asyncio.Lock] = {}
+_summary_lock_users: Dict[int, int] = {}
+
+
+_HISTORY_KEY = tuple_(ChatMessage.created_at, ChatMessage.id)
+
+
+async def _unsummarized_messages(db: AsyncSession, project: Project):
+    """
+    Запрос сообщений проекта, еще не вошедших в саммари. Граница задается ключом (created_at, id)
+    последнего учтенного сообщения: фильтр только по id индекс (project_id, created_at, id)
+    не ограничивает, и чтение "с конца" просматривало бы всю уже суммаризированную историю.
+    """
+    query = select(ChatMessage).where(ChatMessage.project_id == project.id)
+    if not project.summarized_message_id:
+        return query
+    boundary = (await db.execute(
+        select(ChatMessage.created_at, ChatMessage.id)
+        .where(ChatMessage.id == project.summarized_message_id)
+    )).first()
+    if boundary is None:
+        return query.where(ChatMessage.id > project.summarized_message_id)
+    return query.where(_HISTORY_KEY > tuple(boundary))
+
+
+async def load_chat_context(db: AsyncSession, project: Project) -> List[Dict[str, str]]:
+    """
+    Возвращает сообщения, еще не вошедшие в саммари проекта (не больше CHAT_CONTEXT_MAX_MESSAGES),
+    в хронологическом порядке и в формате для Gemini.
+    """
+    query = await _unsummarized_messages(db, project)
+    messages = (await db.scalars(
+        query
+        .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+        .limit(CHAT_CONTEXT_MAX_MESSAGES)
+    )).all()
+    return [{"role": msg.role, "content": msg.content} for msg in reversed(messages)]
+
+
+async def _load_messages_to_summarize(db: AsyncSession, project: Project) -> List[ChatMessage]:
+    """Сообщения старше хвоста диалога, еще не вошедшие в саммари (не больше SUMMARY_BATCH_MESSAGES)"""
+    tail = (await db.execute(
+        select(ChatMessage.created_at, ChatMessage.id)
+        .where(ChatMessage.project_id == project.id)
+        .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+        .offset(CHAT_TAIL_MESSAGES - 1)
+        .limit(1)
+    )).first()
+    if tail is None:
+        # Весь диалог помещается в хвост - суммаризировать нечего
+        return []
+    query = await _unsummarized_messages(db, project)
+    return (await db.scalars(
+        query
+        .where(_HISTORY_KEY < tuple(tail))
+        .order_by(ChatMessage.created_at, ChatMessage.id)
+        .limit(SUMMARY_BATCH_MESSAGES)
+    )).all()
+
+
+@asynccontextmanager
+async def _project_summary_lock(project_id: int) -> AsyncIterator[None]:
+    """Блокировка обновлений саммари проекта; удаляется, когда ее никто не держит и не ждет"""
+    lock = _summary_locks.setdefault(project_id, asyncio.Lock())
+    _summary_lock_users[project_id] = _summary_lock_users.get(project_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        users = _summary_lock_users[project_id] - 1
+        if users:
+            _summary_lock_users[project_id] = users
+        else:
+            del _summary_lock_users[project_id]
+            del _summary_locks[project_id]
+
+
+async def update_conversation_summary(project_id: int) -> Optional[str]:
+    """
+    Фоновая задача: добавляет в саммари проекта сообщения, вышедшие за пределы хвоста диалога.
+    Открывает собственную сессию БД, т.к. выполняется после отправки ответа клиенту.
+    Ошибки только логируются - при следующем ходе обновление будет повторено.
+    """
+    # Фоновая задача наследует контекст запроса - дедлайн запроса к ней не относится
+    with llm_call_context(project_id=project_id, endpoint="background:conversation_summary", deadline=deadline_after(LLM_BACKGROUND_DEADLINE_SECONDS)):
+        async with _project_summary_lock(project_id):
+            return await _update_conversation_summary_locked(project_id)
+
+
+async def _update_conversation_summary_locked(project_id: int) -> Optional[str]:
+    """Обновление саммари; вызывается под блокировкой проекта"""
+    db = AsyncSessionLocal()
+    try:
+        project = await db.get(Project, project_id)
+        if not project:
+            return None
+        messages = await _load_messages_to_summarize(db, project)
+        if not messages:
+            return project.conversation_summary
+        # Соединение возвращается в пул на время генерации саммари
+        await db.commit()
+
+        summary = await gemini.summarize_conversation(
+            project.conversation_summary,
+            [{"role": msg.role, "content": msg.content} for msg in messages],
+        )
+        project.conversation_summary = summary
+        project.summarized_message_id = messages[-1].id
+        await db.commit()
+        logger.info(f"Саммари диалога проекта {project_id} обновлено (+{len(messages)} сообщений, до id {messages[-1].id})")
+        return summary
+    except Exception as e:
+        logger.error(f"Не удалось обновить саммари диалога проекта {project_id}: {e}")
+        await db.rollback()
+        return None
+    finally:
+        await db.close()
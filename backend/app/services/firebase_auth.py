@@ -4,11 +4,13 @@
 import firebase_admin
 from firebase_admin import auth as firebase_auth
 from firebase_admin import credentials
-from fastapi import Depends, HTTPException, status, Header
+from fastapi import Depends, HTTPException, status, Header, Request
 from typing import Dict, Any, Optional
 import logging
 import traceback
 
+from ..core.llm_context import bind_llm_call_context, route_label
+
 logger = logging.getLogger(__name__)
 
 def verify_firebase_token(token: str) -> Dict[str, Any]:
@@ -84,7 +86,7 @@ def verify_firebase_token(token: str) -> Dict[str, Any]:
             detail=f"Ошибка авторизации: {str(e)}"
         )
 
-async def get_current_user(authorization: Optional[str] = Header(None)) -> Dict[str, Any]:
+async def get_current_user(request: Request, authorization: Optional[str] = Header(None)) -> Dict[str, Any]:
     """
     FastAPI зависимость для получения текущего аутентифицированного пользователя
     """
@@ -110,7 +112,11 @@ async def get_current_user(authorization: Optional[str] = Header(None)) -> Dict[
     token = parts[1]
     
     # Проверяем токен и получаем данные пользователя
-    return verify_firebase_token(token)
+    user_data = verify_firebase_token(token)
+    
+    # Привязываем пользователя к контексту запроса: по uid LLM-слой строит справедливую очередь и учет
+    bind_llm_call_context(uid=user_data.get("uid"), endpoint=route_label(request))
+    return user_data
 
 async def get_optional_user(authorization: Optional[str] = Header(None)) -> Optional[Dict[str, Any]]:
     """
@@ -206,6 +206,22 @@ async def get_project_by_id(db: firestore.AsyncClient, project_id: str) -> Optio
     return None
 
 
+async def get_projects_by_ids(db: firestore.AsyncClient, project_ids: List[str]) -> Dict[str, FirebaseProject]:
+    """Получить несколько проектов одним пакетным чтением. Отсутствующие проекты в результат не попадают."""
+    if not project_ids:
+        return {}
+    try:
+        refs = [db.collection("projects").document(project_id) for project_id in project_ids]
+        projects = {}
+        async for doc in db.get_all(refs):
+            if doc.exists:
+                projects[doc.id] = format_project_from_firestore(doc.id, doc.to_dict())
+        return projects
+    except Exception as e:
+        logger.error(f"Ошибка пакетного чтения проектов ({len(project_ids)} шт.): {e}")
+        raise
+
+
 async def get_user_projects(db: firestore.AsyncClient, user_id: str) -> List[FirebaseProject]:
     """Получить все проекты пользователя"""
     try:
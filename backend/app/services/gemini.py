@@ -1,17 +1,50 @@
+import asyncio
 import os
 import google.generativeai as genai
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, AsyncIterator, Tuple
 from fastapi import HTTPException
 import logging
-import json
-import re
 # Импортируем функцию для получения модели из центральной конфигурации
 from ..core.api_setup import get_gemini_model
+from ..core.llm_context import LLMDeadlineExceeded
+# Все вызовы генерации идут через llm_client (кэш ответов и т.д.)
+from . import llm_client
+from .llm_streaming import IncrementalJSONParser
+from .single_flight import single_flight
+from .prompts import (
+    BRIEFING_TURN_INSTRUCTION, DOCUMENT_ANALYSIS_INSTRUCTION, DOCUMENT_CHUNK_INSTRUCTION, EXPERT_INFO_INSTRUCTION,
+    FOLLOW_UP_QUESTIONS_INSTRUCTION,
+)
+from .briefing_merge import BRIEFING_FIELDS, apply_briefing_delta, merge_description, merge_funnel_elements, normalize_text
+from .question_index import QuestionIndex
+from .structured_output import StructuredOutputError, generate_structured, parse_or_reprompt, with_response_schema
+from ..schemas.briefing import BriefingExtraction, BriefingTurnExtraction
+from .prompt_budget import (
+    CHAT_HISTORY_TOKEN_BUDGET, DOCUMENT_CHUNK_OVERLAP_TOKENS, DOCUMENT_CHUNK_TOKENS, DOCUMENT_TOKEN_BUDGET,
+    PromptAssembler, estimate_tokens, split_into_chunks, truncate_to_tokens,
+)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Объединенный ход брифинга (извлечение + уточняющие вопросы за один вызов модели).
+# BRIEFING_TURN_COMBINED=0 возвращает прежний путь из двух последовательных вызовов.
+BRIEFING_TURN_COMBINED = os.getenv("BRIEFING_TURN_COMBINED", "1").lower() not in ("0", "false", "no")
+
+# Анализ больших документов по частям: сколько фрагментов обрабатывается одновременно
+# и максимум фрагментов (вызовов модели) на документ. Для больших документов фрагменты укрупняются
+# до DOCUMENT_TOKEN_BUDGET; текст сверх DOCUMENT_MAX_CHUNKS * DOCUMENT_TOKEN_BUDGET токенов
+# не анализируется (его объем возвращается в skipped_tokens результата)
+DOCUMENT_CHUNK_CONCURRENCY = int(os.getenv("DOCUMENT_CHUNK_CONCURRENCY", "8"))
+DOCUMENT_MAX_CHUNKS = int(os.getenv("DOCUMENT_MAX_CHUNKS", "32"))
+
+# Длина превью описания этапа воронки в контексте промпта
+_STAGE_PREVIEW_CHARS = 80
+
+# Все функции, обращающиеся к Gemini, асинхронные: через llm_client они вызывают generate_content_async,
+# чтобы генерация не блокировала event loop uvicorn и не задерживала остальные запросы воркера.
+
 # Константы - MODEL_NAME больше не нужен для основных функций
 # API_KEY = os.environ.get("GEMINI_API_KEY")
 # MODEL_NAME = "gemini-2.0-flash-exp" # Убираем или оставляем только для теста
@@ -56,8 +89,53 @@ def test_gemini_connection() -> Dict[str, Any]:
         logger.error(f"Ошибка при тестировании подключения к Gemini API: {e}")
         return {"status": "error", "message": str(e)}
 
+def _format_current_briefing_context(current_data: Dict[str, Any] = None) -> str:
+    """Формирует текстовый блок с текущими данными брифинга для промпта"""
+    current_context = ""
+    if current_data:
+        current_context = "\nТекущие данные брифинга:\n"
+        
+        if current_data.get("utp"):
+            current_context += f"УТП: {current_data['utp']}\n"
+        else:
+            current_context += "УТП: Не заполнено\n"
+        
+        if current_data.get("product_description"):
+            current_context += f"Описание продукта: {current_data['product_description']}\n"
+        else:
+            current_context += "Описание продукта: Не заполнено\n"
+        
+        if current_data.get("funnel_elements") and len(current_data["funnel_elements"]) > 0:
+            # Модель возвращает только новые подробности этапов, поэтому полные описания ей не нужны
+            current_context += "Элементы продуктовой воронки (описания сокращены):\n"
+            for i, element in enumerate(current_data["funnel_elements"], 1):
+                current_context += f"  {i}. {element.get('name')}: {_shorten(element.get('description')) or 'описание не заполнено'}\n"
+        else:
+            current_context += "Элементы продуктовой воронки: Не заполнены\n"
+    return current_context
+
+def _shorten(text: Optional[str], limit: int = _STAGE_PREVIEW_CHARS) -> str:
+    """Начало текста до limit символов по границе слова"""
+    text = (text or "").strip()
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+_CHAT_CONTEXT_HEADER = "\nИстория диалога (последние сообщения):\n\n"
+
+def _format_conversation_summary(conversation_summary: Optional[str]) -> str:
+    """Формирует блок промпта с кратким содержанием ранней части диалога"""
+    if not conversation_summary:
+        return ""
+    return f"\nКраткое содержание предыдущей части диалога (факты, которые нужно учитывать):\n{conversation_summary}\n"
+
+def _format_chat_message(msg: Dict[str, str]) -> str:
+    """Форматирует одно сообщение диалога для промпта"""
+    role = "Пользователь" if msg["role"] == "user" else "Ассистент"
+    return f"{role}: {msg['content']}\n\n"
+
 # Анализ информации о пользователе и его продукте
-def analyze_expert_info(text: str, chat_history: List[Dict[str, str]] = None, current_data: Dict[str, Any] = None) -> Dict[str, Any]:
+async def analyze_expert_info(text: str, chat_history: List[Dict[str, str]] = None, current_data: Dict[str, Any] = None, use_cache: bool = True, conversation_summary: Optional[str] = None) -> Dict[str, Any]:
     """
     Анализирует информацию об эксперте и его продукте с учетом контекста чата и текущих данных
     
@@ -65,179 +143,65 @@ def analyze_expert_info(text: str, chat_history: List[Dict[str, str]] = None, cu
         text: Текст сообщения пользователя
         chat_history: История диалога (последние сообщения)
         current_data: Текущие данные брифинга (если есть)
+        use_cache: Использовать кэш ответов LLM (False - всегда обращаться к модели)
+        conversation_summary: Краткое содержание ранней части диалога, не вошедшей в chat_history
     
     Returns:
         Dict: Результат анализа с обновленными данными
     """
     try:
-        # Получаем модель по умолчанию
-        model = get_gemini_model()
-        if not model:
-             logger.error("Не удалось получить модель Gemini для analyze_expert_info.")
-             # Возвращаем ошибку или используем запасной вариант
-             return {"status": "error", "message": "Модель Gemini недоступна"}
-
-        # Преобразуем текущие данные в строку контекста
-        current_context = ""
-        if current_data:
-            current_context = "\nТекущие данные брифинга:\n"
-            
-            if current_data.get("utp"):
-                current_context += f"УТП: {current_data['utp']}\n"
-            else:
-                current_context += "УТП: Не заполнено\n"
-            
-            if current_data.get("product_description"):
-                current_context += f"Описание продукта: {current_data['product_description']}\n"
-            else:
-                current_context += "Описание продукта: Не заполнено\n"
-            
-            if current_data.get("funnel_elements") and len(current_data["funnel_elements"]) > 0:
-                current_context += "Элементы продуктовой воронки:\n"
-                for i, element in enumerate(current_data["funnel_elements"], 1):
-                    current_context += f"  {i}. {element.get('name')}: {element.get('description')}\n"
-            else:
-                current_context += "Элементы продуктовой воронки: Не заполнены\n"
-        
-        # Формируем контекст из истории чата, если она предоставлена
-        chat_context = ""
-        if chat_history and len(chat_history) > 0:
-            chat_context = "\nИстория диалога (последние сообщения):\n\n"
-            # Берем только последние 5-8 сообщений для контекста, чтобы не превышать лимиты
-            recent_messages = chat_history[-8:] if len(chat_history) > 8 else chat_history
-            for msg in recent_messages:
-                role = "Пользователь" if msg["role"] == "user" else "Ассистент"
-                chat_context += f"{role}: {msg['content']}\n\n"
-        
-        prompt = f"""
-        Ты выступаешь в роли ассистента по сбору информации об эксперте, его продукте/услуге и воронке продаж.
-        
+        template = """
         {current_context}
         
+        {conversation_summary}
+        
         {chat_context}
         
         Новое сообщение пользователя:
         {text}
-        
-        Учитывая всю предыдущую историю диалога, текущие данные брифинга и новую информацию, извлеки и структурируй следующие данные:
-        
-        1. Уникальное торговое предложение (УТП) - что делает эксперта уникальным и какую пользу это приносит клиентам.
-           УТП должно быть конкретным, привлекательным и отличающим эксперта от конкурентов.
-        
-        2. Описание продукта/услуги - подробно опиши, что предлагает эксперт, какие проблемы решает его продукт/услуга
-           и какие конкретные выгоды получают клиенты. Включи ключевые характеристики и преимущества.
-        
-        3. Элементы продуктовой воронки - последовательные шаги или этапы, через которые проходит клиент от первого
-           контакта с экспертом до совершения покупки и дальнейшего взаимодействия. Для каждого этапа укажи его название
-           и подробное описание.
-        
-        Важно:
-        - Если в новом сообщении нет информации по какому-то полю, но оно уже заполнено в текущих данных - сохрани существующее значение.
-        - Если новая информация противоречит или дополняет существующую - интегрируй их вместе, сохраняя наиболее важные детали из обоих источников.
-        - Если новое сообщение содержит не всю информацию - заполни только те поля, для которых есть данные.
-        
-        Верни результат ТОЛЬКО в формате JSON с полями:
-        - utp: строка с УТП
-        - product_description: строка с описанием продукта
-        - funnel_elements: массив объектов с полями name (название этапа) и description (описание этапа)
-        
-        Не добавляй никаких пояснений до или после JSON.
         """
         
-        # Настройка параметров генерации для более стабильного JSON
+        # Собираем промпт по бюджету токенов: данные брифинга и новое сообщение важнее старых реплик диалога
+        assembler = PromptAssembler("analyze_expert_info", template, task="extraction", system_instruction=EXPERT_INFO_INSTRUCTION)
+        assembler.add("current_context", _format_current_briefing_context(current_data), priority=100)
+        assembler.add("text", text, priority=90, keep="head_tail")
+        assembler.add("conversation_summary", _format_conversation_summary(conversation_summary), priority=70)
+        assembler.add_messages("chat_context", chat_history, _format_chat_message, header=_CHAT_CONTEXT_HEADER, priority=50, max_tokens=CHAT_HISTORY_TOKEN_BUDGET)
+        prompt = assembler.build()
+        
+        # Настройка параметров генерации для более стабильного JSON (модель и бюджет ответа - из маршрута задачи)
         generation_config = {
             "temperature": 0.2,  # Низкая температура для более предсказуемых ответов
-            "max_output_tokens": 2048,  # Ограничение длины ответа
         }
         
-        response = model.generate_content(prompt, generation_config=generation_config)
-        result = response.text
-        
-        # Обработка ответа и преобразование в структурированный формат
-        # Попытка найти JSON в ответе с помощью регулярного выражения
-        json_match = re.search(r'\{[\s\S]*\}', result)
-        if json_match:
-            json_str = json_match.group(0)
-            try:
-                parsed_result = json.loads(json_str)
-                
-                # Объединение с текущими данными (если они есть)
-                if current_data:
-                    # Для УТП: если не заполнено в новом результате, но есть в текущих данных
-                    if not parsed_result.get("utp") and current_data.get("utp"):
-                        parsed_result["utp"] = current_data["utp"]
-                    
-                    # Для описания продукта: аналогично
-                    if not parsed_result.get("product_description") and current_data.get("product_description"):
-                        parsed_result["product_description"] = current_data["product_description"]
-                    
-                    # Для элементов воронки: объединяем списки, избегая дубликатов
-                    if parsed_result.get("funnel_elements") and current_data.get("funnel_elements"):
-                        # Создаем словарь существующих элементов по имени для быстрого поиска
-                        existing_elements = {elem.get("name", ""): elem for elem in current_data["funnel_elements"]}
-                        
-                        for new_elem in parsed_result["funnel_elements"]:
-                            if new_elem.get("name") in existing_elements:
-                                # Если элемент уже существует, объединяем описания, если новое не пустое
-                                if new_elem.get("description"):
-                                    existing_elem = existing_elements[new_elem["name"]]
-                                    if existing_elem.get("description") and new_elem.get("description") != existing_elem["description"]:
-                                        # Объединяем описания, если они разные
-                                        existing_elements[new_elem["name"]]["description"] = f"{existing_elem['description']} {new_elem['description']}"
-                            else:
-                                # Если это новый элемент, добавляем его
-                                existing_elements[new_elem["name"]] = new_elem
-                        
-                        # Преобразуем обратно в список
-                        parsed_result["funnel_elements"] = list(existing_elements.values())
-                    elif not parsed_result.get("funnel_elements") and current_data.get("funnel_elements"):
-                        parsed_result["funnel_elements"] = current_data["funnel_elements"]
+        try:
+            # Модель получает схему ответа (JSON mode); ответ разбирается и при необходимости ремонтируется локально
+            parsed_result = await generate_structured(
+                prompt, BriefingExtraction, operation="analyze_expert_info",
+                generation_config=generation_config, system_instruction=assembler.system_instruction, use_cache=use_cache,
+                task="extraction",
+            )
+            
+            # Модель вернула только изменения - применяем их к текущим данным локально
+            parsed_result = apply_briefing_delta(current_data, parsed_result)
                 
-                # Проверяем наличие всех необходимых полей
-                if "utp" not in parsed_result:
-                    parsed_result["utp"] = ""
-                    
-                if "product_description" not in parsed_result:
-                    parsed_result["product_description"] = ""
-                    
-                if "funnel_elements" not in parsed_result or not isinstance(parsed_result["funnel_elements"], list):
-                    parsed_result["funnel_elements"] = []
-                    
-                # Если список элементов воронки пуст, но есть хотя бы базовая информация, добавляем примерный элемент
-                if len(parsed_result["funnel_elements"]) == 0 and (parsed_result["utp"] or parsed_result["product_description"]):
-                    parsed_result["funnel_elements"].append({
-                        "name": "Первичный контакт", 
-                        "description": "Первое знакомство клиента с продуктом/услугой"
-                    })
-                    
-            except json.JSONDecodeError:
-                # Если не удалось распарсить JSON, используем запасной вариант
-                logger.error(f"Не удалось распарсить JSON из ответа: {result}")
+            # Если список элементов воронки пуст, но есть хотя бы базовая информация, добавляем примерный элемент
+            if len(parsed_result["funnel_elements"]) == 0 and (parsed_result["utp"] or parsed_result["product_description"]):
+                parsed_result["funnel_elements"].append({
+                    "name": "Первичный контакт", 
+                    "description": "Первое знакомство клиента с продуктом/услугой"
+                })
                 
-                # Если есть текущие данные, используем их как основу
-                if current_data:
-                    parsed_result = current_data.copy()
-                    # Добавляем новую информацию из текста, если текущие данные неполные
-                    if not parsed_result.get("utp"):
-                        parsed_result["utp"] = text[:100] + "..." if len(text) > 100 else text
-                else:
-                    parsed_result = {
-                        "utp": text[:100] + "..." if len(text) > 100 else text,
-                        "product_description": "Требуется дополнительная информация",
-                        "funnel_elements": [
-                            {"name": "Первичный контакт", "description": "Первое знакомство клиента с продуктом/услугой"}
-                        ]
-                    }
-        else:
-            # Если JSON не найден, создаем базовую структуру или используем текущие данные
-            logger.error(f"JSON не найден в ответе: {result}")
+        except StructuredOutputError as e:
+            # Если не удалось получить JSON даже после ремонта, используем запасной вариант
+            logger.error(f"Не удалось получить JSON из ответа: {e}. Ответ: {e.raw_text}")
             
+            # Если есть текущие данные, используем их как основу
             if current_data:
                 parsed_result = current_data.copy()
-                # Если данные были, но не полные, пытаемся добавить новую информацию
-                if not parsed_result.get("utp") or not parsed_result.get("product_description"):
-                    if not parsed_result.get("utp"):
-                        parsed_result["utp"] = text[:100] + "..." if len(text) > 100 else text
+                # Добавляем новую информацию из текста, если текущие данные неполные
+                if not parsed_result.get("utp"):
+                    parsed_result["utp"] = text[:100] + "..." if len(text) > 100 else text
             else:
                 parsed_result = {
                     "utp": text[:100] + "..." if len(text) > 100 else text,
@@ -259,6 +223,9 @@ def analyze_expert_info(text: str, chat_history: List[Dict[str, str]] = None, cu
             "completion_percentage": completion_percentage,
             "stage_summary": stage_summary
         }
+    except LLMDeadlineExceeded:
+        # Дедлайн запроса истек - запасной ответ не нужен, запрос завершится 504
+        raise
     except Exception as e:
         logger.error(f"Ошибка при анализе информации: {e}")
         return {"status": "error", "message": str(e)}
@@ -322,140 +289,199 @@ def generate_stage_summary(briefing_data: Dict[str, Any]) -> str:
     return summary
 
 
-def generate_project_summary(project_data: Dict[str, Any]) -> Dict[str, Any]:
+def _build_project_summary_prompt(project_data: Dict[str, Any]):
+    """Собирает промпт и параметры генерации для саммари проекта"""
+    # Формируем контекст из данных проекта
+    project_context = "Данные проекта:\n"
+    
+    # Добавляем название и описание проекта
+    project_context += f"Название: {project_data.get('name', 'Без названия')}\n"
+    if project_data.get('description'):
+        project_context += f"Описание: {project_data['description']}\n"
+    
+    # Добавляем данные брифинга, если они есть
+    briefing_data = project_data.get('briefing_data', {})
+    if briefing_data:
+        project_context += "\nДанные брифинга:\n"
+        
+        if briefing_data.get("utp"):
+            project_context += f"УТП: {briefing_data['utp']}\n"
+        
+        if briefing_data.get("product_description"):
+            project_context += f"Описание продукта: {briefing_data['product_description']}\n"
+        
+        if briefing_data.get("funnel_elements") and len(briefing_data["funnel_elements"]) > 0:
+            project_context += "Элементы продуктовой воронки:\n"
+            for i, element in enumerate(briefing_data["funnel_elements"], 1):
+                project_context += f"  {i}. {element.get('name')}: {element.get('description', 'Нет описания')}\n"
+    
+    template = """
+    Ты - ассистент, который помогает создать краткое и информативное описание проекта.
+    
+    {project_context}
+    
+    На основе предоставленных данных, создай краткое саммари проекта, которое:
+    1. Описывает основную суть проекта в 2-3 предложениях
+    2. Выделяет ключевые особенности и преимущества
+    3. Кратко описывает целевую аудиторию и ценность для неё
+    4. Имеет профессиональный, но дружелюбный тон
+    
+    Саммари должно быть лаконичным (не более 300 слов) и хорошо структурированным.
+    """
+    
+    assembler = PromptAssembler("project_summary", template, task="summary")
+    assembler.add("project_context", project_context, priority=100)
+    prompt = assembler.build()
+    
+    # Модель и бюджет ответа - из маршрута задачи "summary"
+    generation_config = {
+        "temperature": 0.3,  # Низкая температура для более предсказуемых ответов
+    }
+    
+    return prompt, generation_config
+
+async def generate_project_summary(project_data: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
     """
     Генерирует саммари проекта на основе его данных
     
     Args:
         project_data: Данные проекта, включая briefing_data и другие поля
+        use_cache: Использовать кэш ответов LLM (False - всегда обращаться к модели)
     
     Returns:
         Dict: Результат с саммари проекта
     """
-    try:
-        # Получаем модель по умолчанию
-        model = get_gemini_model()
-        if not model:
-             logger.error("Не удалось получить модель Gemini для generate_project_summary.")
-             return {"status": "error", "message": "Модель Gemini недоступна"}
+    # Повторный запрос сводки того же проекта, пока первый еще выполняется, получает его результат
+    return await single_flight.do(
+        "project_summary",
+        {"project": project_data, "use_cache": use_cache},
+        lambda: _generate_project_summary(project_data, use_cache),
+    )
 
-        # Формируем контекст из данных проекта
-        project_context = "Данные проекта:\n"
-        
-        # Добавляем название и описание проекта
-        project_context += f"Название: {project_data.get('name', 'Без названия')}\n"
-        if project_data.get('description'):
-            project_context += f"Описание: {project_data['description']}\n"
-        
-        # Добавляем данные брифинга, если они есть
-        briefing_data = project_data.get('briefing_data', {})
-        if briefing_data:
-            project_context += "\nДанные брифинга:\n"
-            
-            if briefing_data.get("utp"):
-                project_context += f"УТП: {briefing_data['utp']}\n"
-            
-            if briefing_data.get("product_description"):
-                project_context += f"Описание продукта: {briefing_data['product_description']}\n"
-            
-            if briefing_data.get("funnel_elements") and len(briefing_data["funnel_elements"]) > 0:
-                project_context += "Элементы продуктовой воронки:\n"
-                for i, element in enumerate(briefing_data["funnel_elements"], 1):
-                    project_context += f"  {i}. {element.get('name')}: {element.get('description', 'Нет описания')}\n"
-        
-        prompt = f"""
-        Ты - ассистент, который помогает создать краткое и информативное описание проекта.
-        
-        {project_context}
-        
-        На основе предоставленных данных, создай краткое саммари проекта, которое:
-        1. Описывает основную суть проекта в 2-3 предложениях
-        2. Выделяет ключевые особенности и преимущества
-        3. Кратко описывает целевую аудиторию и ценность для неё
-        4. Имеет профессиональный, но дружелюбный тон
-        
-        Саммари должно быть лаконичным (не более 300 слов) и хорошо структурированным.
-        """
-        
-        generation_config = {
-            "temperature": 0.3,  # Низкая температура для более предсказуемых ответов
-            "max_output_tokens": 1024,  # Ограничение длины ответа
-        }
+async def _generate_project_summary(project_data: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+    try:
+        prompt, generation_config = _build_project_summary_prompt(project_data)
         
-        response = model.generate_content(prompt, generation_config=generation_config)
-        summary = response.text.strip()
+        summary = (await llm_client.generate_text(prompt, generation_config=generation_config, use_cache=use_cache, task="summary")).strip()
         
         return {
             "status": "success", 
             "summary": summary
         }
+    except LLMDeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при генерации саммари проекта: {e}")
         return {"status": "error", "message": str(e)}
 
+async def stream_project_summary(project_data: Dict[str, Any], use_cache: bool = True) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Потоковая версия generate_project_summary.
+    
+    Отдает события {"event": "token", "data": {"text": ...}} по мере генерации и в конце
+    {"event": "result", "data": ...} в том же формате, что возвращает generate_project_summary.
+    """
+    chunks = []
+    try:
+        prompt, generation_config = _build_project_summary_prompt(project_data)
+        async for chunk in llm_client.stream_text(prompt, generation_config=generation_config, use_cache=use_cache, task="summary"):
+            chunks.append(chunk)
+            yield {"event": "token", "data": {"text": chunk}}
+        result = {"status": "success", "summary": "".join(chunks).strip()}
+    except Exception as e:
+        logger.error(f"Ошибка при потоковой генерации саммари проекта: {e}")
+        result = {"status": "error", "message": str(e)}
+    yield {"event": "result", "data": result}
+
+def _find_missing_info(briefing_data: Dict[str, Any]) -> List[str]:
+    """Определяет, какие поля брифинга заполнены недостаточно"""
+    missing_info = []
+    
+    # Проверка УТП
+    if not briefing_data.get("utp") or len(briefing_data["utp"].strip()) < 15:
+        missing_info.append("УТП (Уникальное Торговое Предложение)")
+    
+    # Проверка описания продукта
+    if not briefing_data.get("product_description") or len(briefing_data["product_description"].strip()) < 30:
+        missing_info.append("описание продукта/услуги")
+    
+    # Проверка элементов воронки
+    if not briefing_data.get("funnel_elements") or len(briefing_data["funnel_elements"]) < 2:
+        missing_info.append("элементы продуктовой воронки (нужно минимум 2-3 этапа)")
+    else:
+        # Проверка качества заполнения элементов воронки
+        for element in briefing_data["funnel_elements"]:
+            if not element.get("description") or len(element["description"]) < 15:
+                missing_info.append(f"подробное описание этапа '{element.get('name', 'Неизвестный этап')}'")
+    
+    return missing_info
+
+def _asked_questions_index(chat_history: List[Dict[str, str]] = None, asked_questions: Optional[QuestionIndex] = None) -> QuestionIndex:
+    """Индекс заданных вопросов проекта; без него - временный индекс по сообщениям ассистента из chat_history"""
+    if asked_questions is not None:
+        return asked_questions
+    return QuestionIndex.from_chat_history(chat_history)
+
+def _format_asked_questions_context(already_asked_questions: List[str]) -> str:
+    """Формирует блок промпта со списком уже заданных вопросов"""
+    asked_questions_context = ""
+    if already_asked_questions:
+        asked_questions_context = "Вопросы, которые уже были заданы (не повторять их):\n"
+        for i, q in enumerate(already_asked_questions, 1):
+            asked_questions_context += f"{i}. {q}\n"
+    return asked_questions_context
+
+def _basic_questions(missing_info: List[str]) -> List[str]:
+    """Базовые вопросы на случай, если модель не вернула вопросов"""
+    basic_questions = []
+    if "УТП" in ''.join(missing_info):
+        basic_questions.append("Что делает ваш продукт или услугу уникальными на рынке? Какую конкретную пользу это приносит клиентам?")
+    
+    if "описание продукта" in ''.join(missing_info):
+        basic_questions.append("Расскажите подробнее о вашем продукте или услуге: какие основные функции или особенности он имеет? Какие проблемы клиентов он решает?")
+    
+    if "воронки" in ''.join(missing_info):
+        basic_questions.append("Опишите, пожалуйста, как клиент взаимодействует с вашим продуктом от первого знакомства до покупки? Какие этапы проходит клиент?")
+    
+    if not basic_questions:
+        basic_questions.append("Не могли бы вы рассказать больше о вашем бизнесе, чтобы мы могли лучше понять, как помочь вам?")
+    
+    return basic_questions
+
 # Генерация уточняющих вопросов
-def generate_follow_up_questions(briefing_data: Dict[str, Any], chat_history: List[Dict[str, str]] = None) -> List[str]:
+async def generate_follow_up_questions(briefing_data: Dict[str, Any], chat_history: List[Dict[str, str]] = None, use_cache: bool = True, asked_questions: Optional[QuestionIndex] = None) -> List[str]:
     """
     Генерирует уточняющие вопросы на основе текущих данных брифинга и истории диалога
     
     Args:
         briefing_data: Текущие данные брифинга
         chat_history: История диалога
+        use_cache: Использовать кэш ответов LLM (False - всегда обращаться к модели)
+        asked_questions: Индекс уже заданных вопросов проекта (см. question_index); без него
+            заданные вопросы берутся из сообщений ассистента в chat_history
     
     Returns:
-        List[str]: Список уточняющих вопросов
+        List[str]: Список уточняющих вопросов, не повторяющих уже заданные
     """
-    try:
-        # Получаем модель по умолчанию
-        model = get_gemini_model()
-        if not model:
-             logger.error("Не удалось получить модель Gemini для generate_follow_up_questions.")
-             # Возвращаем стандартные вопросы в случае ошибки
-             return ["Расскажите подробнее о вашем продукте или услуге?",
-                     "Что делает ваше предложение уникальным на рынке?"]
+    asked_questions = _asked_questions_index(chat_history, asked_questions)
+    # Одинаковые одновременные запросы (двойной клик, повтор с фронтенда) выполняются один раз
+    return await single_flight.do(
+        "follow_up_questions",
+        {"briefing_data": briefing_data, "chat_history": chat_history, "use_cache": use_cache, "asked_questions": [len(asked_questions), asked_questions.recent()]},
+        lambda: _generate_follow_up_questions(briefing_data, chat_history, use_cache, asked_questions),
+    )
 
+async def _generate_follow_up_questions(briefing_data: Dict[str, Any], chat_history: List[Dict[str, str]] = None, use_cache: bool = True, asked_questions: Optional[QuestionIndex] = None) -> List[str]:
+    try:
         # Определяем, какие поля заполнены недостаточно
-        missing_info = []
-        
-        # Проверка УТП
-        if not briefing_data.get("utp") or len(briefing_data["utp"].strip()) < 15:
-            missing_info.append("УТП (Уникальное Торговое Предложение)")
-        
-        # Проверка описания продукта
-        if not briefing_data.get("product_description") or len(briefing_data["product_description"].strip()) < 30:
-            missing_info.append("описание продукта/услуги")
-        
-        # Проверка элементов воронки
-        if not briefing_data.get("funnel_elements") or len(briefing_data["funnel_elements"]) < 2:
-            missing_info.append("элементы продуктовой воронки (нужно минимум 2-3 этапа)")
-        else:
-            # Проверка качества заполнения элементов воронки
-            for element in briefing_data["funnel_elements"]:
-                if not element.get("description") or len(element["description"]) < 15:
-                    missing_info.append(f"подробное описание этапа '{element.get('name', 'Неизвестный этап')}'")
+        missing_info = _find_missing_info(briefing_data)
         
         # Если все заполнено достаточно хорошо, возвращаем пустой список
         if not missing_info:
             return ["У вас уже заполнены все необходимые поля! Вы можете перейти к следующему этапу или дополнить существующую информацию."]
         
-        # Формируем контекст из истории чата, если она предоставлена
-        chat_context = ""
-        already_asked_questions = []
-        
-        if chat_history and len(chat_history) > 0:
-            # Собираем последние вопросы ассистента, чтобы не повторяться
-            for msg in chat_history:
-                if msg["role"] == "assistant" and "?" in msg["content"]:
-                    # Извлекаем вопросы из сообщения ассистента
-                    questions = [q.strip() for q in re.findall(r'[^.!?]*\?', msg["content"])]
-                    already_asked_questions.extend(questions)
-            
-            # Добавляем контекст из последних нескольких сообщений
-            recent_messages = chat_history[-5:] if len(chat_history) > 5 else chat_history
-            chat_context = "История диалога (последние сообщения):\n\n"
-            for msg in recent_messages:
-                role = "Пользователь" if msg["role"] == "user" else "Ассистент"
-                chat_context += f"{role}: {msg['content']}\n\n"
+        # Последние заданные вопросы берутся из индекса проекта, чтобы не повторяться
+        asked_questions = _asked_questions_index(chat_history, asked_questions)
         
         # Формируем текущий контекст брифинга
         briefing_context = "Текущие данные брифинга:\n"
@@ -478,65 +504,42 @@ def generate_follow_up_questions(briefing_data: Dict[str, Any], chat_history: Li
             briefing_context += "Элементы продуктовой воронки: Не заполнены\n"
         
         # Список уже заданных вопросов
-        asked_questions_context = ""
-        if already_asked_questions:
-            asked_questions_context = "Вопросы, которые уже были заданы (не повторять их):\n"
-            for i, q in enumerate(already_asked_questions[-10:], 1):  # Берем только последние 10 вопросов
-                asked_questions_context += f"{i}. {q}\n"
-        
-        prompt = f"""
-        Ты - ассистент, который помогает заполнить брифинг эксперта.
+        asked_questions_context = _format_asked_questions_context(asked_questions.recent())
         
+        template = """
         {briefing_context}
         
         {chat_context}
         
         {asked_questions_context}
         
-        Необходимо дополнить информацию о: {', '.join(missing_info)}.
-        
-        Сгенерируй 2-3 уточняющих вопроса, которые помогут получить недостающую информацию.
-        
-        Требования к вопросам:
-        1. Вопросы должны быть конкретными и направленными на получение именно той информации, которой не хватает
-        2. Не повторяй вопросы, которые уже были заданы ранее
-        3. Задавай открытые вопросы, которые требуют развернутого ответа
-        4. Учитывай контекст диалога и уже известную информацию
-        5. Формулируй вопросы дружелюбно и профессионально
-        6. Первый вопрос должен быть самым важным
-        
-        Верни ТОЛЬКО список вопросов, без пояснений и вводных фраз. Каждый вопрос с новой строки.
+        Необходимо дополнить информацию о: {missing_info}.
         """
         
+        # Для вопросов достаточно короткой истории - ей отдается половина бюджета истории хода брифинга
+        assembler = PromptAssembler("follow_up_questions", template, task="follow_up_questions", system_instruction=FOLLOW_UP_QUESTIONS_INSTRUCTION)
+        assembler.add("briefing_context", briefing_context, priority=100)
+        assembler.add("missing_info", ", ".join(missing_info), priority=100)
+        assembler.add("asked_questions_context", asked_questions_context, priority=60)
+        assembler.add_messages("chat_context", chat_history, _format_chat_message, header=_CHAT_CONTEXT_HEADER, priority=50, max_tokens=CHAT_HISTORY_TOKEN_BUDGET // 2)
+        prompt = assembler.build()
+        
         generation_config = {
             "temperature": 0.7,  # Немного повышаем температуру для разнообразия вопросов
-            "max_output_tokens": 1024,
         }
         
-        response = model.generate_content(prompt, generation_config=generation_config)
-        
         # Обрабатываем ответ
-        questions_text = response.text.strip()
+        questions_text = (await llm_client.generate_text(
+            prompt, generation_config=generation_config, system_instruction=assembler.system_instruction, use_cache=use_cache,
+            task="follow_up_questions",
+        )).strip()
         
-        # Разбиваем текст на отдельные вопросы
-        questions = [q.strip() for q in questions_text.split('\n') if q.strip() and '?' in q]
+        # Разбиваем текст на отдельные вопросы и отбрасываем повторы уже заданных
+        questions = asked_questions.filter_new(q.strip() for q in questions_text.split('\n') if q.strip() and '?' in q)
         
         # Если вопросов нет или парсинг не удался, возвращаем базовые вопросы
         if not questions:
-            basic_questions = []
-            if "УТП" in ''.join(missing_info):
-                basic_questions.append("Что делает ваш продукт или услугу уникальными на рынке? Какую конкретную пользу это приносит клиентам?")
-            
-            if "описание продукта" in ''.join(missing_info):
-                basic_questions.append("Расскажите подробнее о вашем продукте или услуге: какие основные функции или особенности он имеет? Какие проблемы клиентов он решает?")
-            
-            if "воронки" in ''.join(missing_info):
-                basic_questions.append("Опишите, пожалуйста, как клиент взаимодействует с вашим продуктом от первого знакомства до покупки? Какие этапы проходит клиент?")
-            
-            if not basic_questions:
-                basic_questions.append("Не могли бы вы рассказать больше о вашем бизнесе, чтобы мы могли лучше понять, как помочь вам?")
-            
-            return basic_questions
+            return _basic_questions(missing_info)
         
         # Ограничиваем количество вопросов до 3, чтобы не перегружать пользователя
         return questions[:3]
@@ -546,187 +549,410 @@ def generate_follow_up_questions(briefing_data: Dict[str, Any], chat_history: Li
         return ["Расскажите подробнее о вашем продукте или услуге?", 
                 "Что делает ваше предложение уникальным на рынке?"]
 
-def analyze_document_content(text: str, current_data: Dict[str, Any] = None) -> Dict[str, Any]:
+def _build_briefing_turn_prompt(text: str, chat_history: List[Dict[str, str]] = None, current_data: Dict[str, Any] = None, conversation_summary: Optional[str] = None, asked_questions: Optional[QuestionIndex] = None):
+    """Собирает промпт, параметры генерации и инструкцию для объединенного хода брифинга"""
+    template = """
+    {current_context}
+    
+    {conversation_summary}
+    
+    {chat_context}
+    
+    {asked_questions_context}
+    
+    Новое сообщение пользователя:
+    {text}
+    """
+    
+    # Собираем промпт по бюджету токенов: данные брифинга и новое сообщение важнее старых реплик диалога
+    assembler = PromptAssembler("briefing_turn", template, task="briefing_turn", system_instruction=BRIEFING_TURN_INSTRUCTION)
+    assembler.add("current_context", _format_current_briefing_context(current_data), priority=100)
+    assembler.add("text", text, priority=90, keep="head_tail")
+    assembler.add("conversation_summary", _format_conversation_summary(conversation_summary), priority=70)
+    assembler.add("asked_questions_context", _format_asked_questions_context(_asked_questions_index(chat_history, asked_questions).recent()), priority=60)
+    assembler.add_messages("chat_context", chat_history, _format_chat_message, header=_CHAT_CONTEXT_HEADER, priority=50, max_tokens=CHAT_HISTORY_TOKEN_BUDGET)
+    prompt = assembler.build()
+    
+    # Модель и бюджет ответа - из маршрута задачи "briefing_turn"
+    generation_config = with_response_schema({
+        "temperature": 0.3,  # Компромисс между стабильным JSON и разнообразием вопросов
+    }, BriefingTurnExtraction)
+    
+    return prompt, generation_config, assembler.system_instruction
+
+async def _finalize_briefing_turn(parsed_result: Dict[str, Any], chat_history: List[Dict[str, str]] = None, current_data: Dict[str, Any] = None, use_cache: bool = True, asked_questions: Optional[QuestionIndex] = None) -> Dict[str, Any]:
+    """
+    Формирует итоговый результат объединенного хода брифинга из разобранного ответа модели (BriefingTurnExtraction).
+    Используется и обычным, и потоковым путем, поэтому итоговые данные у них совпадают.
+    """
+    raw_questions = parsed_result.pop("follow_up_questions", None) or []
+    asked_questions = _asked_questions_index(chat_history, asked_questions)
+    questions = asked_questions.filter_new(q.strip() for q in raw_questions if q.strip() and '?' in q)[:3]
+    
+    parsed_result = apply_briefing_delta(current_data, parsed_result)
+    
+    # Если список элементов воронки пуст, но есть хотя бы базовая информация, добавляем примерный элемент
+    if len(parsed_result["funnel_elements"]) == 0 and (parsed_result["utp"] or parsed_result["product_description"]):
+        parsed_result["funnel_elements"].append({
+            "name": "Первичный контакт", 
+            "description": "Первое знакомство клиента с продуктом/услугой"
+        })
+    
+    completion_percentage = calculate_completion_percentage(parsed_result)
+    
+    # Модель не вернула новых вопросов, хотя брифинг не заполнен - догенерируем их отдельным вызовом
+    if completion_percentage < 100 and not questions:
+        logger.info("Объединенный ход брифинга не вернул новых вопросов, генерируем их отдельно")
+        questions = await generate_follow_up_questions(parsed_result, chat_history, use_cache=use_cache, asked_questions=asked_questions)
+    
+    return {
+        "status": "success",
+        "data": parsed_result,
+        "completion_percentage": completion_percentage,
+        "stage_summary": generate_stage_summary(parsed_result),
+        "questions": questions
+    }
+
+# Ход брифинга: извлечение данных и уточняющие вопросы за один вызов модели
+async def run_briefing_turn(text: str, chat_history: List[Dict[str, str]] = None, current_data: Dict[str, Any] = None, use_cache: bool = True, combined: bool = None, conversation_summary: Optional[str] = None, asked_questions: Optional[QuestionIndex] = None) -> Dict[str, Any]:
+    """
+    Обрабатывает новое сообщение пользователя в чате брифинга: обновляет utp/product_description/funnel_elements
+    и генерирует уточняющие вопросы одним запросом к модели вместо двух.
+    
+    Если объединенный запрос не удался (ошибка модели или некорректный JSON), используется прежний путь:
+    analyze_expert_info, а затем generate_follow_up_questions.
+    
+    Args:
+        text: Текст сообщения пользователя
+        chat_history: История диалога (последние сообщения)
+        current_data: Текущие данные брифинга (если есть)
+        use_cache: Использовать кэш ответов LLM (False - всегда обращаться к модели)
+        combined: False - сразу использовать прежний путь из двух вызовов (по умолчанию BRIEFING_TURN_COMBINED)
+        conversation_summary: Краткое содержание ранней части диалога, не вошедшей в chat_history
+        asked_questions: Индекс уже заданных вопросов проекта (новые вопросы не повторяют их)
+    
+    Returns:
+        Dict: Результат в формате analyze_expert_info, дополненный полем questions (список уточняющих вопросов)
+    """
+    if combined is None:
+        combined = BRIEFING_TURN_COMBINED
+    if not combined:
+        return await _run_briefing_turn_two_calls(text, chat_history, current_data, use_cache, conversation_summary, asked_questions)
+    
+    try:
+        prompt, generation_config, system_instruction = _build_briefing_turn_prompt(text, chat_history, current_data, conversation_summary, asked_questions)
+        result = await llm_client.generate_text(prompt, generation_config=generation_config, system_instruction=system_instruction, use_cache=use_cache, task="briefing_turn")
+        parsed_result = await parse_or_reprompt(
+            result, BriefingTurnExtraction, operation="briefing_turn", prompt=prompt,
+            generation_config=generation_config, system_instruction=system_instruction, task="briefing_turn",
+        )
+        return await _finalize_briefing_turn(parsed_result, chat_history, current_data, use_cache, asked_questions)
+    except LLMDeadlineExceeded:
+        # Раздельные вызовы тоже не уложатся в истекший дедлайн
+        raise
+    except Exception as e:
+        logger.warning(f"Объединенный ход брифинга не удался, используем раздельные вызовы: {e}")
+        return await _run_briefing_turn_two_calls(text, chat_history, current_data, use_cache, conversation_summary, asked_questions)
+
+async def _run_briefing_turn_two_calls(text: str, chat_history: List[Dict[str, str]] = None, current_data: Dict[str, Any] = None, use_cache: bool = True, conversation_summary: Optional[str] = None, asked_questions: Optional[QuestionIndex] = None) -> Dict[str, Any]:
+    """Прежний путь хода брифинга: analyze_expert_info, затем generate_follow_up_questions"""
+    analysis_result = await analyze_expert_info(text=text, chat_history=chat_history, current_data=current_data, use_cache=use_cache, conversation_summary=conversation_summary)
+    analysis_result["questions"] = []
+    if analysis_result["status"] == "success" and analysis_result["completion_percentage"] < 100:
+        analysis_result["questions"] = await generate_follow_up_questions(analysis_result["data"], chat_history, use_cache=use_cache, asked_questions=asked_questions)
+    return analysis_result
+
+async def stream_briefing_turn(text: str, chat_history: List[Dict[str, str]] = None, current_data: Dict[str, Any] = None, use_cache: bool = True, conversation_summary: Optional[str] = None, asked_questions: Optional[QuestionIndex] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Потоковая версия run_briefing_turn.
+    
+    Отдает события по мере генерации ответа моделью:
+    - {"event": "token", "data": {"text": ...}} - очередной фрагмент текста ответа;
+    - {"event": "field" | "item", "data": {...}} - поле брифинга (или этап воронки, вопрос), полученное целиком;
+    - {"event": "result", "data": {...}} - итоговый результат в том же формате, что у run_briefing_turn.
+    
+    Итоговый результат разбирается той же функцией, что и в обычном пути, поэтому сохраняемые данные совпадают.
+    """
+    parser = IncrementalJSONParser()
+    chunks = []
+    try:
+        prompt, generation_config, system_instruction = _build_briefing_turn_prompt(text, chat_history, current_data, conversation_summary, asked_questions)
+        async for chunk in llm_client.stream_text(prompt, generation_config=generation_config, system_instruction=system_instruction, use_cache=use_cache, task="briefing_turn"):
+            chunks.append(chunk)
+            yield {"event": "token", "data": {"text": chunk}}
+            for parsed_event in parser.feed(chunk):
+                yield {"event": parsed_event.pop("type"), "data": parsed_event}
+        parsed_result = await parse_or_reprompt(
+            "".join(chunks), BriefingTurnExtraction, operation="briefing_turn", prompt=prompt,
+            generation_config=generation_config, system_instruction=system_instruction, task="briefing_turn",
+        )
+        result = await _finalize_briefing_turn(parsed_result, chat_history, current_data, use_cache, asked_questions)
+    except LLMDeadlineExceeded as e:
+        # Раздельные вызовы тоже не уложатся в истекший дедлайн
+        logger.warning(f"Потоковый ход брифинга прерван по дедлайну запроса: {e}")
+        result = {"status": "error", "message": str(e), "questions": []}
+    except Exception as e:
+        logger.warning(f"Потоковый ход брифинга не удался, используем раздельные вызовы: {e}")
+        result = await _run_briefing_turn_two_calls(text, chat_history, current_data, use_cache, conversation_summary, asked_questions)
+    yield {"event": "result", "data": result}
+
+# Краткое содержание диалога (скользящая память чата)
+async def summarize_conversation(previous_summary: Optional[str], messages: List[Dict[str, str]], use_cache: bool = True) -> str:
+    """
+    Дополняет краткое содержание диалога новыми сообщениями.
+    
+    Модель получает только предыдущее саммари и сообщения, которые в него еще не вошли,
+    поэтому стоимость обновления не зависит от длины всего диалога.
+    
+    Args:
+        previous_summary: Текущее краткое содержание (пустое для нового диалога)
+        messages: Новые сообщения, которые нужно учесть
+        use_cache: Использовать кэш ответов LLM (False - всегда обращаться к модели)
+    
+    Returns:
+        str: Обновленное краткое содержание
+    """
+    template = """
+    Ты ведешь краткое содержание диалога ассистента с экспертом, который заполняет брифинг о своем продукте/услуге.
+    
+    Текущее краткое содержание:
+    {previous_summary}
+    
+    Новые сообщения диалога:
+    {messages}
+    
+    Обнови краткое содержание с учетом новых сообщений:
+    - Сохрани ВСЕ факты из текущего краткого содержания, если новые сообщения им не противоречат
+      (ниша, продукты и цены, целевая аудитория, УТП, этапы воронки, каналы, ограничения и пожелания эксперта).
+    - Добавь новые факты из новых сообщений, при противоречии оставь более позднюю версию.
+    - Укажи, на какие вопросы ассистента эксперт уже ответил.
+    - Пиши сжато, списком фактов, не более 300 слов.
+    
+    Верни ТОЛЬКО текст краткого содержания, без вводных фраз.
+    """
+    
+    assembler = PromptAssembler("conversation_summary", template, task="conversation_summary")
+    assembler.add("previous_summary", previous_summary or "Пока пусто", priority=100)
+    assembler.add_messages("messages", messages, _format_chat_message, priority=50)
+    prompt = assembler.build()
+    
+    generation_config = {
+        "temperature": 0.2,
+    }
+    
+    summary = (await llm_client.generate_text(prompt, generation_config=generation_config, use_cache=use_cache, task="conversation_summary")).strip()
+    if not summary:
+        raise ValueError("Модель вернула пустое краткое содержание диалога")
+    return summary
+
+async def analyze_document_content(text: str, current_data: Dict[str, Any] = None, use_cache: bool = True) -> Dict[str, Any]:
     """
     Анализирует содержимое загруженного документа для извлечения информации о продукте/услуге
     
     Args:
         text: Текстовое содержимое документа
         current_data: Текущие данные брифинга (если есть)
+        use_cache: Использовать кэш ответов LLM (False - всегда обращаться к модели)
     
     Returns:
         Dict: Результат анализа с обновленными данными
     """
     try:
-        # Получаем модель по умолчанию
-        model = get_gemini_model()
-        if not model:
-             logger.error("Не удалось получить модель Gemini для analyze_document_content.")
-             return {"status": "error", "message": "Модель Gemini недоступна"}
-
-        # Если текст слишком длинный, ограничиваем его размер (модели имеют лимиты)
-        if len(text) > 30000:
-            # Берем начало и конец документа, где обычно содержится самая важная информация
-            truncated_text = text[:15000] + "\n[...]
-" + text[-15000:]
+        # Документ, не помещающийся в один фрагмент, анализируется по частям параллельно (map-reduce).
+        # Разбиение большого текста занимает заметное время, поэтому выполняется в отдельном потоке
+        if len(text) > DOCUMENT_CHUNK_TOKENS * 4:
+            chunks, skipped_tokens = await asyncio.to_thread(_split_document, text)
         else:
-            truncated_text = text
-        
-        # Формируем контекст из текущих данных, если они есть
-        current_context = ""
-        if current_data:
-            current_context = "\nТекущие данные брифинга:\n"
-            
-            if current_data.get("utp"):
-                current_context += f"УТП: {current_data['utp']}\n"
-            else:
-                current_context += "УТП: Не заполнено\n"
-            
-            if current_data.get("product_description"):
-                current_context += f"Описание продукта: {current_data['product_description']}\n"
-            else:
-                current_context += "Описание продукта: Не заполнено\n"
-            
-            if current_data.get("funnel_elements") and len(current_data["funnel_elements"]) > 0:
-                current_context += "Элементы продуктовой воронки:\n"
-                for i, element in enumerate(current_data["funnel_elements"], 1):
-                    current_context += f"  {i}. {element.get('name')}: {element.get('description')}\n"
-            else:
-                current_context += "Элементы продуктовой воронки: Не заполнены\n"
-        
-        prompt = f"""
-        Ты выступаешь в роли ассистента по анализу документов и извлечению информации для брифинга.
+            chunks, skipped_tokens = _split_document(text)
+        if len(chunks) > 1:
+            parsed_result = await _analyze_document_chunks(chunks, current_data, use_cache)
+            return _document_analysis_result(parsed_result, skipped_tokens)
         
+        template = """
         {current_context}
         
-        Из предоставленного документа нужно извлечь и структурировать следующие данные:
-        
-        1. Уникальное торговое предложение (УТП) - что делает продукт/услугу уникальными и какую пользу они приносят клиентам.
-           УТП должно быть конкретным, привлекательным и отличающим от конкурентов.
-        
-        2. Описание продукта/услуги - подробно опиши, что предлагается, какие проблемы решает продукт/услуга
-           и какие конкретные выгоды получают клиенты. Включи ключевые характеристики и преимущества.
-        
-        3. Элементы продуктовой воронки - последовательные шаги или этапы, через которые проходит клиент от первого
-           контакта до совершения покупки и дальнейшего взаимодействия. Для каждого этапа укажи его название
-           и подробное описание.
-        
-        Важно:
-        - Если в документе нет информации по какому-то полю, но оно уже заполнено в текущих данных - сохрани существующее значение.
-        - Если информация в документе дополняет существующую - объедини их, сохраняя наиболее важные детали.
-        - Если не удается найти какую-то информацию в документе - используй то, что уже есть, или оставь поле пустым.
-        
         Содержимое документа для анализа:
-        {truncated_text}
-        
-        Верни результат ТОЛЬКО в формате JSON с полями:
-        - utp: строка с УТП
-        - product_description: строка с описанием продукта
-        - funnel_elements: массив объектов с полями name (название этапа) и description (описание этапа)
-        
-        Не добавляй никаких пояснений до или после JSON.
+        {document_text}
         """
         
-        # Настройка параметров генерации
+        # Документ помещается в один фрагмент (не больше DOCUMENT_TOKEN_BUDGET), поэтому не обрезается
+        assembler = PromptAssembler("analyze_document", template, task="document", system_instruction=DOCUMENT_ANALYSIS_INSTRUCTION)
+        assembler.add("current_context", _format_current_briefing_context(current_data), priority=100)
+        assembler.add("document_text", text, priority=50, max_tokens=DOCUMENT_TOKEN_BUDGET, keep="head_tail")
+        prompt = assembler.build()
+        
+        # Настройка параметров генерации (модель и бюджет ответа - из маршрута задачи)
         generation_config = {
             "temperature": 0.2,  # Низкая температура для более предсказуемых ответов
-            "max_output_tokens": 2048,  # Ограничение длины ответа
         }
         
-        response = model.generate_content(prompt, generation_config=generation_config)
-        result = response.text
-        
-        # Обработка ответа и преобразование в структурированный формат
-        # Попытка найти JSON в ответе с помощью регулярного выражения
-        json_match = re.search(r'\{[\s\S]*\}', result)
-        if json_match:
-            json_str = json_match.group(0)
-            try:
-                parsed_result = json.loads(json_str)
-                
-                # Объединение с текущими данными (если они есть)
-                if current_data:
-                    # Для УТП: если не заполнено в новом результате, но есть в текущих данных
-                    if not parsed_result.get("utp") and current_data.get("utp"):
-                        parsed_result["utp"] = current_data["utp"]
-                    
-                    # Для описания продукта: аналогично
-                    if not parsed_result.get("product_description") and current_data.get("product_description"):
-                        parsed_result["product_description"] = current_data["product_description"]
-                    
-                    # Для элементов воронки: объединяем списки, избегая дубликатов
-                    if parsed_result.get("funnel_elements") and current_data.get("funnel_elements"):
-                        # Создаем словарь существующих элементов по имени для быстрого поиска
-                        existing_elements = {elem.get("name", ""): elem for elem in current_data["funnel_elements"]}
-                        
-                        for new_elem in parsed_result["funnel_elements"]:
-                            if new_elem.get("name") in existing_elements:
-                                # Если элемент уже существует, объединяем описания, если новое не пустое
-                                if new_elem.get("description"):
-                                    existing_elem = existing_elements[new_elem["name"]]
-                                    if existing_elem.get("description") and new_elem.get("description") != existing_elem["description"]:
-                                        # Объединяем описания, если они разные
-                                        existing_elements[new_elem["name"]]["description"] = f"{existing_elem['description']} {new_elem['description']}"
-                            else:
-                                # Если это новый элемент, добавляем его
-                                existing_elements[new_elem["name"]] = new_elem
-                        
-                        # Преобразуем обратно в список
-                        parsed_result["funnel_elements"] = list(existing_elements.values())
-                    elif not parsed_result.get("funnel_elements") and current_data.get("funnel_elements"):
-                        parsed_result["funnel_elements"] = current_data["funnel_elements"]
-                
-                # Проверяем наличие всех необходимых полей
-                if "utp" not in parsed_result:
-                    parsed_result["utp"] = ""
-                    
-                if "product_description" not in parsed_result:
-                    parsed_result["product_description"] = ""
-                    
-                if "funnel_elements" not in parsed_result or not isinstance(parsed_result["funnel_elements"], list):
-                    parsed_result["funnel_elements"] = []
-                
-            except json.JSONDecodeError:
-                # Если не удалось распарсить JSON, используем запасной вариант
-                logger.error(f"Не удалось распарсить JSON из ответа: {result}")
-                
-                # Если есть текущие данные, используем их как основу
-                if current_data:
-                    parsed_result = current_data.copy()
-                    # Если у нас есть текущие данные, но не удалось распарсить новые,
-                    # просто возвращаем текущие данные, чтобы не потерять их
-                else:
-                    # Создаем пустую структуру, которая будет дальше обрабатываться
-                    parsed_result = {
-                        "utp": "",
-                        "product_description": "Не удалось извлечь информацию из документа",
-                        "funnel_elements": []
-                    }
-        else:
-            # Если JSON не найден, создаем базовую структуру или используем текущие данные
-            logger.error(f"JSON не найден в ответе: {result}")
+        try:
+            # Модель получает схему ответа (JSON mode); ответ разбирается и при необходимости ремонтируется локально
+            parsed_result = await generate_structured(
+                prompt, BriefingExtraction, operation="analyze_document",
+                generation_config=generation_config, system_instruction=assembler.system_instruction, use_cache=use_cache,
+                task="document",
+            )
             
-            if current_data:
-                parsed_result = current_data.copy()
-            else:
-                parsed_result = {
-                    "utp": "",
-                    "product_description": "Не удалось извлечь информацию из документа",
-                    "funnel_elements": []
-                }
-        
-        # Рассчитываем процент заполнения
-        completion_percentage = calculate_completion_percentage(parsed_result)
-        
-        # Генерируем саммари этапа (для последующего использования)
-        stage_summary = generate_stage_summary(parsed_result)
+            # Модель вернула только изменения - применяем их к текущим данным локально
+            parsed_result = apply_briefing_delta(current_data, parsed_result)
+            
+        except StructuredOutputError as e:
+            # Если не удалось получить JSON даже после ремонта, используем запасной вариант
+            logger.error(f"Не удалось получить JSON из ответа: {e}. Ответ: {e.raw_text}")
+            
+            parsed_result = _document_fallback_data(current_data)
         
-        return {
-            "status": "success", 
-            "data": parsed_result,
-            "completion_percentage": completion_percentage,
-            "stage_summary": stage_summary
-        }
+        return _document_analysis_result(parsed_result)
+    except LLMDeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при анализе документа: {e}")
         return {"status": "error", "message": str(e)}
+
+def _document_fallback_data(current_data: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Данные брифинга, если из документа ничего не удалось извлечь"""
+    # Если есть текущие данные, используем их как основу, чтобы не потерять их
+    if current_data:
+        return current_data.copy()
+    # Создаем пустую структуру, которая будет дальше обрабатываться
+    return {
+        "utp": "",
+        "product_description": "Не удалось извлечь информацию из документа",
+        "funnel_elements": []
+    }
+
+def _document_analysis_result(parsed_result: Dict[str, Any], skipped_tokens: int = 0) -> Dict[str, Any]:
+    """
+    Итоговый результат анализа документа: данные, процент заполнения и саммари этапа.
+    skipped_tokens - сколько токенов конца документа не анализировалось (лимит на документ).
+    """
+    result = {
+        "status": "success",
+        "data": parsed_result,
+        "completion_percentage": calculate_completion_percentage(parsed_result),
+        "stage_summary": generate_stage_summary(parsed_result)
+    }
+    if skipped_tokens:
+        result["skipped_tokens"] = skipped_tokens
+    return result
+
+def _split_document(text: str) -> Tuple[List[str], int]:
+    """
+    Делит документ на перекрывающиеся фрагменты по DOCUMENT_CHUNK_TOKENS.
+    Если фрагментов получается больше DOCUMENT_MAX_CHUNKS, фрагменты укрупняются (до DOCUMENT_TOKEN_BUDGET).
+    Текст сверх DOCUMENT_MAX_CHUNKS фрагментов отбрасывается.
+
+    Returns:
+        Tuple[List[str], int]: Фрагменты и оценка числа отброшенных токенов
+    """
+    max_chunks = max(DOCUMENT_MAX_CHUNKS, 1)
+    max_tokens = max_chunks * DOCUMENT_TOKEN_BUDGET
+    total_tokens = estimate_tokens(text)
+    skipped_tokens = 0
+    if total_tokens > max_tokens:
+        # Токен занимает не больше 4 символов: обрезка ищется только в начале текста нужной длины
+        text, _ = truncate_to_tokens(text[:max_tokens * 4], max_tokens)
+        skipped_tokens = total_tokens - estimate_tokens(text)
+    chunk_tokens = max(DOCUMENT_CHUNK_TOKENS, estimate_tokens(text) // max_chunks + 1)
+    chunk_tokens = min(chunk_tokens, DOCUMENT_TOKEN_BUDGET)
+    chunks = split_into_chunks(text, chunk_tokens, DOCUMENT_CHUNK_OVERLAP_TOKENS)
+    # Перекрытие и границы предложений могут дать несколько лишних фрагментов
+    if len(chunks) > max_chunks:
+        skipped_tokens += sum(estimate_tokens(chunk) for chunk in chunks[max_chunks:]) - DOCUMENT_CHUNK_OVERLAP_TOKENS * (len(chunks) - max_chunks)
+        chunks = chunks[:max_chunks]
+    if skipped_tokens > 0:
+        logger.warning(f"Документ больше лимита ({max_chunks} фрагментов): не анализируется ~{skipped_tokens} из {total_tokens} токенов")
+    return chunks, max(skipped_tokens, 0)
+
+async def _extract_document_chunk(chunk: str, chunk_number: int, chunk_count: int, use_cache: bool = True) -> Dict[str, Any]:
+    """Map-шаг: извлекает данные брифинга из одного фрагмента документа"""
+    template = """
+    Фрагмент {chunk_number} из {chunk_count}:
+    {document_text}
+    """
+    
+    # Текущие данные брифинга в промпт фрагмента не входят: так фрагменты независимы,
+    # а их ответы кэшируются и переиспользуются при повторной загрузке того же документа
+    assembler = PromptAssembler("analyze_document_chunk", template, task="document_chunk", system_instruction=DOCUMENT_CHUNK_INSTRUCTION)
+    assembler.add("chunk_number", str(chunk_number), priority=100)
+    assembler.add("chunk_count", str(chunk_count), priority=100)
+    assembler.add("document_text", chunk, priority=50, max_tokens=DOCUMENT_TOKEN_BUDGET)
+    prompt = assembler.build()
+    
+    generation_config = {
+        "temperature": 0.2,
+    }
+    return await generate_structured(
+        prompt, BriefingExtraction, operation="analyze_document_chunk",
+        generation_config=generation_config, system_instruction=assembler.system_instruction, use_cache=use_cache,
+        task="document_chunk",
+    )
+
+def _merge_document_chunk_results(partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Reduce-шаг: объединяет результаты фрагментов локально, без обращения к модели.
+    - utp: самое подробное из найденных;
+    - product_description: уникальные описания в порядке документа;
+    - funnel_elements: этапы в порядке первого упоминания, дубликаты (в т.ч. из перекрытия фрагментов)
+      объединяются движком слияния briefing_merge.
+    """
+    utp = max((partial["utp"].strip() for partial in partials), key=len, default="")
+    
+    descriptions: List[str] = []
+    description_keys: List[str] = []
+    for partial in partials:
+        description = partial["product_description"].strip()
+        key = normalize_text(description)
+        if not key or any(key in existing for existing in description_keys):
+            continue
+        # Новое описание полнее уже найденного - заменяет его
+        for index, existing in enumerate(description_keys):
+            if existing in key:
+                descriptions[index], description_keys[index] = description, key
+                break
+        else:
+            descriptions.append(description)
+            description_keys.append(key)
+    
+    funnel_elements: List[Dict[str, str]] = []
+    for partial in partials:
+        funnel_elements = merge_funnel_elements(funnel_elements, partial["funnel_elements"])
+    
+    return {
+        "utp": utp,
+        "product_description": "\n\n".join(descriptions),
+        "funnel_elements": funnel_elements,
+    }
+
+async def _analyze_document_chunks(chunks: List[str], current_data: Dict[str, Any] = None, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Анализ большого документа: фрагменты обрабатываются параллельно (не больше DOCUMENT_CHUNK_CONCURRENCY
+    одновременно), результаты объединяются локально и сливаются с текущими данными брифинга.
+    Ошибка отдельного фрагмента не прерывает анализ - используются остальные фрагменты.
+    """
+    semaphore = asyncio.Semaphore(max(DOCUMENT_CHUNK_CONCURRENCY, 1))
+    
+    async def extract(index: int, chunk: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await _extract_document_chunk(chunk, index + 1, len(chunks), use_cache)
+    
+    results = await asyncio.gather(*(extract(index, chunk) for index, chunk in enumerate(chunks)), return_exceptions=True)
+    partials = [result for result in results if not isinstance(result, BaseException)]
+    for index, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.warning(f"Фрагмент {index + 1}/{len(chunks)} документа не обработан: {result}")
+    logger.info(f"Документ проанализирован по частям: {len(partials)} из {len(chunks)} фрагментов")
+    
+    if not partials:
+        deadline_error = next((result for result in results if isinstance(result, LLMDeadlineExceeded)), None)
+        if deadline_error is not None:
+            raise deadline_error
+        return _document_fallback_data(current_data)
+    # Фрагменты анализировались без текущих данных брифинга, поэтому их результат - не дельта:
+    # utp и описание дополняют текущие значения, собранные в чате, а не заменяют их
+    merged = _merge_document_chunk_results(partials)
+    current = current_data or {}
+    for field in BRIEFING_FIELDS:
+        merged[field] = merge_description(current.get(field) or "", merged[field])
+    return apply_briefing_delta(current_data, merged)
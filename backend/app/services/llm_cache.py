@@ -0,0 +1,282 @@
+"""
+Двухуровневый кэш ответов LLM.
+
+Ключ кэша - хэш от (имя модели, параметры генерации, полностью собранный промпт),
+поэтому одинаковые запросы к Gemini (повторное сообщение, повторный импорт того же сайта,
+повторная сводка неизменившегося проекта) обслуживаются без обращения к API.
+
+Уровни:
+1. In-memory LRU - быстрые попадания внутри процесса.
+2. SQLite на диске - переживает перезапуск воркера и общий для воркеров на одной машине.
+
+Оба уровня поддерживают TTL, дисковый уровень дополнительно ограничен по размеру.
+Размер дискового уровня ведется счетчиком в процессе; полный пересчет (SUM) и удаление истекших
+записей выполняются раз в _DISK_MAINTENANCE_SECONDS - файл могут менять и другие воркеры.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "512"))
+LLM_CACHE_DB_PATH = os.getenv("LLM_CACHE_DB_PATH", "./llm_cache.db")
+LLM_CACHE_MAX_DISK_MB = int(os.getenv("LLM_CACHE_MAX_DISK_MB", "200"))
+
+_DISK_MAINTENANCE_SECONDS = 300
+
+
+def make_cache_key(model_name: str, generation_config: Optional[Dict[str, Any]], prompt: str, safety_settings: Any = None, system_instruction: Optional[str] = None) -> str:
+    """Строит content-addressed ключ для запроса к LLM."""
+    request = {
+        "model": model_name,
+        "generation_config": generation_config or {},
+        "safety_settings": safety_settings or [],
+        "prompt": prompt,
+    }
+    # Инструкция входит в ключ, только если задана: ключи запросов без нее не меняются
+    if system_instruction:
+        request["system_instruction"] = system_instruction
+    payload = json.dumps(
+        request,
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Кэш ответов LLM: LRU в памяти + SQLite на диске."""
+
+    def __init__(
+        self,
+        max_memory_entries: int = LLM_CACHE_MEMORY_ENTRIES,
+        ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+        db_path: Optional[str] = LLM_CACHE_DB_PATH,
+        max_disk_bytes: int = LLM_CACHE_MAX_DISK_MB * 1024 * 1024,
+        enabled: bool = LLM_CACHE_ENABLED,
+    ):
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = enabled
+
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._db_failed = False
+        # Размер записей дискового уровня (байт) и время последнего пересчета по таблице
+        self._disk_bytes = 0
+        self._disk_checked_at = 0.0
+
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "expired": 0,
+        }
+
+    # --- Уровень памяти ---
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        with self._memory_lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._memory[key]
+                self._stats["expired"] += 1
+                return None
+            self._memory.move_to_end(key)
+            return value
+
+    def _memory_set(self, key: str, value: str, expires_at: float):
+        with self._memory_lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+                self._stats["memory_evictions"] += 1
+
+    # --- Уровень SQLite ---
+
+    def _get_db(self) -> Optional[sqlite3.Connection]:
+        """Лениво открывает SQLite. При ошибке дисковый уровень отключается, кэш работает только в памяти."""
+        if self._db is not None or self._db_failed or not self.db_path:
+            return self._db
+        try:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    size INTEGER NOT NULL
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_access ON llm_cache (last_access)")
+            db.commit()
+            self._db = db
+            self._disk_maintenance(db)
+            logger.info(f"Дисковый кэш LLM открыт: {self.db_path}")
+        except Exception as e:
+            logger.error(f"Не удалось открыть дисковый кэш LLM ({self.db_path}): {e}")
+            self._db_failed = True
+        return self._db
+
+    def _disk_get(self, key: str) -> Optional[Tuple[float, str]]:
+        with self._db_lock:
+            db = self._get_db()
+            if db is None:
+                return None
+            row = db.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < time.time():
+                self._delete_row(db, key)
+                db.commit()
+                self._stats["expired"] += 1
+                return None
+            db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            db.commit()
+            return expires_at, value
+
+    def _disk_set(self, key: str, value: str, expires_at: float):
+        with self._db_lock:
+            db = self._get_db()
+            if db is None:
+                return
+            now = time.time()
+            size = len(value.encode("utf-8"))
+            self._delete_row(db, key)
+            db.execute(
+                "INSERT INTO llm_cache (key, value, expires_at, last_access, size) VALUES (?, ?, ?, ?, ?)",
+                (key, value, expires_at, now, size),
+            )
+            self._disk_bytes += size
+            if now - self._disk_checked_at >= _DISK_MAINTENANCE_SECONDS:
+                self._disk_maintenance(db)
+            self._evict_disk(db)
+            db.commit()
+
+    def _disk_delete(self, key: str):
+        with self._db_lock:
+            db = self._get_db()
+            if db is None:
+                return
+            self._delete_row(db, key)
+            db.commit()
+
+    def _delete_row(self, db: sqlite3.Connection, key: str):
+        """Удаляет запись и уменьшает счетчик размера"""
+        row = db.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+        self._disk_bytes = max(0, self._disk_bytes - row[0])
+
+    def _disk_maintenance(self, db: sqlite3.Connection):
+        """Удаляет истекшие записи и пересчитывает размер дискового уровня по таблице"""
+        now = time.time()
+        db.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        self._disk_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        self._disk_checked_at = now
+        db.commit()
+
+    def _evict_disk(self, db: sqlite3.Connection):
+        """Удаляет самые давно использованные записи, пока кэш не уложится в лимит размера."""
+        while self._disk_bytes > self.max_disk_bytes:
+            row = db.execute("SELECT key, size FROM llm_cache ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                self._disk_bytes = 0
+                break
+            db.execute("DELETE FROM llm_cache WHERE key = ?", (row[0],))
+            self._disk_bytes = max(0, self._disk_bytes - row[1])
+            self._stats["disk_evictions"] += 1
+
+    # --- Публичный интерфейс ---
+
+    async def get(self, key: str) -> Optional[str]:
+        """Ищет ответ сначала в памяти, затем на диске."""
+        if not self.enabled:
+            return None
+        value = self._memory_get(key)
+        if value is not None:
+            self._stats["memory_hits"] += 1
+            return value
+        try:
+            disk_entry = await asyncio.to_thread(self._disk_get, key)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения дискового кэша LLM: {e}")
+            disk_entry = None
+        if disk_entry is not None:
+            expires_at, value = disk_entry
+            self._memory_set(key, value, expires_at)
+            self._stats["disk_hits"] += 1
+            return value
+        self._stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[int] = None):
+        """Сохраняет ответ на обоих уровнях."""
+        if not self.enabled or value is None:
+            return
+        expires_at = time.time() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        self._memory_set(key, value, expires_at)
+        self._stats["writes"] += 1
+        try:
+            await asyncio.to_thread(self._disk_set, key, value, expires_at)
+        except Exception as e:
+            logger.warning(f"Ошибка записи в дисковый кэш LLM: {e}")
+
+    async def delete(self, key: str):
+        """Удаляет ответ с обоих уровней (например, если он оказался непригодным)."""
+        if not self.enabled:
+            return
+        with self._memory_lock:
+            self._memory.pop(key, None)
+        try:
+            await asyncio.to_thread(self._disk_delete, key)
+        except Exception as e:
+            logger.warning(f"Ошибка удаления из дискового кэша LLM: {e}")
+
+    def clear_memory(self):
+        with self._memory_lock:
+            self._memory.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий/промахов и текущий размер уровней."""
+        lookups = self._stats["memory_hits"] + self._stats["disk_hits"] + self._stats["misses"]
+        hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+        stats = dict(self._stats)
+        stats["enabled"] = self.enabled
+        stats["memory_entries"] = len(self._memory)
+        stats["disk_bytes"] = self._disk_bytes
+        stats["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# Общий экземпляр кэша для всех вызовов LLM в процессе
+response_cache = LLMResponseCache()
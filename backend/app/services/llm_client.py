@@ -0,0 +1,229 @@
+"""
+Единая точка вызова LLM для сервисов приложения.
+
+gemini.py и WebsiteImporterService не обращаются к модели напрямую, а вызывают
+generate_text() (или stream_text() для потоковой выдачи): здесь запрос проходит
+через кэш ответов и только при промахе уходит в бэкенд LLM (Gemini или локальный
+fake для нагрузочных тестов, см. api_setup.get_llm_backend) - через llm_governor
+(ограничение частоты и параллелизма, справедливая очередь, повторы на 429/503).
+Одинаковые запросы, выполняющиеся одновременно, объединяются в один вызов (single_flight).
+Расход токенов и задержка каждого вызова учитываются в usage_ledger.
+Кэш ответов используется только с бэкендом Gemini.
+
+Вызовы ограничены дедлайном запроса из контекста (core/llm_context.llm_deadline): по его
+истечении вызов модели отменяется с LLMDeadlineExceeded. Объединенный вызов отменяется
+по дедлайну запроса, который его начал; присоединившиеся запросы ждут не дольше своего.
+Медленные generate-вызовы дублируются по p95 задержки модели (llm_hedging).
+
+Вызов с task получает модель и бюджет ответа из маршрута задачи (api_setup.resolve_model_route)
+с учетом размера промпта; задержка, токены и стоимость учитываются по маршруту.
+"""
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from ..core.api_setup import DEFAULT_GEMINI_MODEL, get_llm_backend, record_model_call, record_route_call, resolve_model_route
+from ..core.llm_backends import LLMUnavailableError
+from ..core.llm_context import run_with_deadline
+from .llm_cache import make_cache_key, response_cache
+from .llm_governor import llm_governor
+from .llm_hedging import llm_hedging
+from .prompt_budget import estimate_tokens
+from .single_flight import single_flight
+from .usage_ledger import usage_ledger
+
+logger = logging.getLogger(__name__)
+
+
+def _apply_route(
+    task: Optional[str],
+    model_name: Optional[str],
+    generation_config: Optional[Dict[str, Any]],
+    prompt: str,
+    system_instruction: Optional[str],
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Модель и параметры генерации вызова: по маршруту задачи, если он задан (явная модель важнее маршрута)"""
+    if not task:
+        return model_name or DEFAULT_GEMINI_MODEL, generation_config
+    route = resolve_model_route(task, estimate_tokens(prompt) + estimate_tokens(system_instruction or ""))
+    return model_name or route.model_name, route.generation_config(generation_config)
+
+
+def _caches_responses(backend) -> bool:
+    """
+    Кэш ответов только для Gemini: ответы fake-бэкенда (нагрузочные тесты) не должны попадать
+    в общий дисковый кэш под ключами Gemini и не должны подменять вызовы модели при повторах
+    """
+    return backend.name == "gemini"
+
+
+async def generate_text(
+    prompt: str,
+    *,
+    model_name: Optional[str] = None,
+    generation_config: Optional[Dict[str, Any]] = None,
+    safety_settings: Optional[List[Dict[str, str]]] = None,
+    system_instruction: Optional[str] = None,
+    use_cache: bool = True,
+    task: Optional[str] = None,
+) -> str:
+    """
+    Генерирует текст ответа модели для готового промпта.
+
+    Args:
+        prompt: Полностью собранный промпт (динамическая часть)
+        model_name: Имя модели Gemini (по умолчанию - из маршрута задачи или DEFAULT_GEMINI_MODEL)
+        generation_config: Параметры генерации
+        safety_settings: Настройки безопасности
+        system_instruction: Статическая часть промпта (см. services/prompts.py)
+        use_cache: False - не читать и не записывать кэш ответов для этого вызова
+        task: Задача для маршрутизации по моделям (follow_up_questions, extraction, summary, ...)
+
+    Returns:
+        str: Текст ответа модели
+    """
+    model_name, generation_config = _apply_route(task, model_name, generation_config, prompt, system_instruction)
+    backend = get_llm_backend()
+    cache_key = None
+    if use_cache and _caches_responses(backend):
+        cache_key = make_cache_key(model_name, generation_config, prompt, safety_settings, system_instruction)
+        cached_text = await response_cache.get(cache_key)
+        if cached_text is not None:
+            logger.info(f"Ответ LLM взят из кэша (модель {model_name}, ключ {cache_key[:12]}...)")
+            usage_ledger.record(model_name, cache_hit=True)
+            return cached_text
+
+    if not backend.is_available(model_name, generation_config, safety_settings):
+        raise LLMUnavailableError(f"Модель {model_name} недоступна (бэкенд {backend.name})")
+
+    async def call_model() -> str:
+        # Задержка модели замеряется без учета ожидания в очереди governor
+        started = time.perf_counter()
+        try:
+            result = await backend.generate(model_name, prompt, generation_config, safety_settings, system_instruction)
+        except Exception:
+            latency = time.perf_counter() - started
+            record_model_call(model_name, latency, error=True)
+            if task:
+                record_route_call(task, model_name, latency, error=True)
+            usage_ledger.record(model_name, latency_seconds=latency, error=True)
+            raise
+        latency = time.perf_counter() - started
+        record_model_call(model_name, latency)
+        if task:
+            record_route_call(task, model_name, latency, result.input_tokens, result.output_tokens)
+        llm_hedging.observe(model_name, latency)
+        usage_ledger.record(
+            model_name,
+            input_tokens=result.input_tokens,
+            cached_tokens=result.cached_tokens,
+            output_tokens=result.output_tokens,
+            latency_seconds=latency,
+        )
+        return result.text
+
+    # Одинаковый запрос, который уже выполняется, не отправляется в модель повторно
+    flight_key = cache_key or make_cache_key(model_name, generation_config, prompt, safety_settings, system_instruction)
+    # Внутренний run_with_deadline выполняется в задаче single_flight и отменяет сам вызов модели,
+    # внешний ограничивает ожидание запроса, присоединившегося к чужому вызову
+    text = await run_with_deadline(single_flight.do(
+        "llm.generate",
+        flight_key,
+        lambda: run_with_deadline(llm_governor.run(
+            # Hedge отсчитывается после допуска: ожидание в очереди и backoff не считаются задержкой модели
+            lambda: llm_hedging.run(model_name, call_model, hedge_call=lambda: llm_governor.run(call_model))
+        )),
+    ))
+
+    if cache_key is not None:
+        await response_cache.set(cache_key, text)
+    return text
+
+
+async def invalidate_cached(
+    prompt: str,
+    *,
+    model_name: Optional[str] = None,
+    generation_config: Optional[Dict[str, Any]] = None,
+    safety_settings: Optional[List[Dict[str, str]]] = None,
+    system_instruction: Optional[str] = None,
+    task: Optional[str] = None,
+):
+    """Удаляет из кэша ответ на этот запрос (ответ оказался непригодным, например неразборчивый JSON)"""
+    model_name, generation_config = _apply_route(task, model_name, generation_config, prompt, system_instruction)
+    await response_cache.delete(make_cache_key(model_name, generation_config, prompt, safety_settings, system_instruction))
+
+
+async def stream_text(
+    prompt: str,
+    *,
+    model_name: Optional[str] = None,
+    generation_config: Optional[Dict[str, Any]] = None,
+    safety_settings: Optional[List[Dict[str, str]]] = None,
+    system_instruction: Optional[str] = None,
+    use_cache: bool = True,
+    task: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    Потоковая версия generate_text: отдает фрагменты ответа по мере генерации.
+
+    При попадании в кэш весь ответ отдается одним фрагментом. Полный ответ после
+    завершения потока сохраняется в кэш под тем же ключом, что и у generate_text.
+    """
+    model_name, generation_config = _apply_route(task, model_name, generation_config, prompt, system_instruction)
+    backend = get_llm_backend()
+    cache_key = None
+    if use_cache and _caches_responses(backend):
+        cache_key = make_cache_key(model_name, generation_config, prompt, safety_settings, system_instruction)
+        cached_text = await response_cache.get(cache_key)
+        if cached_text is not None:
+            logger.info(f"Ответ LLM (поток) взят из кэша (модель {model_name}, ключ {cache_key[:12]}...)")
+            usage_ledger.record(model_name, cache_hit=True)
+            yield cached_text
+            return
+
+    if not backend.is_available(model_name, generation_config, safety_settings):
+        raise LLMUnavailableError(f"Модель {model_name} недоступна (бэкенд {backend.name})")
+
+    async def open_stream():
+        return await backend.stream(model_name, prompt, generation_config, safety_settings, system_instruction)
+
+    started = time.perf_counter()
+    chunks = []
+    stream = llm_governor.stream(open_stream)
+    try:
+        while True:
+            # Каждый фрагмент ждем не дольше, чем осталось до дедлайна запроса
+            try:
+                text = await run_with_deadline(stream.__anext__())
+            except StopAsyncIteration:
+                break
+            if text:
+                chunks.append(text)
+                yield text
+    except Exception:
+        latency = time.perf_counter() - started
+        record_model_call(model_name, latency, error=True)
+        if task:
+            record_route_call(task, model_name, latency, error=True)
+        usage_ledger.record(model_name, latency_seconds=latency, error=True)
+        raise
+    finally:
+        await stream.aclose()
+    latency = time.perf_counter() - started
+    record_model_call(model_name, latency)
+    # Потоковый бэкенд не сообщает расход - оцениваем по длине промпта и ответа
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(system_instruction or "")
+    output_tokens = estimate_tokens("".join(chunks))
+    if task:
+        record_route_call(task, model_name, latency, input_tokens, output_tokens)
+    usage_ledger.record(
+        model_name,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        latency_seconds=latency,
+        estimated=True,
+    )
+
+    if cache_key is not None:
+        await response_cache.set(cache_key, "".join(chunks))
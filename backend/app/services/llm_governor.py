@@ -0,0 +1,279 @@
+"""
+Единая точка допуска вызовов Gemini (governor).
+
+Все вызовы модели из llm_client проходят через LLMGovernor:
+- token bucket ограничивает частоту запросов квотой API (LLM_REQUESTS_PER_MINUTE, всплеск LLM_BURST);
+- не больше LLM_MAX_CONCURRENCY вызовов выполняются одновременно;
+- ожидающие вызовы стоят в очередях по ключу справедливости (Firebase uid, иначе проект)
+  и допускаются по кругу, поэтому пачка импортов одного пользователя не блокирует остальных;
+- на 429/503 вызов повторяется с экспоненциальной задержкой и jitter, а весь bucket
+  приостанавливается на время задержки, чтобы остальные вызовы не добивали исчерпанную квоту.
+
+Метрики (глубина очереди, время ожидания, повторы) доступны через get_stats() и /llm/stats.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from ..core.llm_context import get_fairness_key
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# --- Настройки (из переменных окружения) ---
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "60"))
+LLM_BURST = int(os.getenv("LLM_BURST", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "1.0"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "30"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "120"))
+
+_RETRYABLE_STATUS_CODES = (429, 503)
+_RETRYABLE_ERROR_NAMES = ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable")
+_WAIT_SAMPLES = 1000
+
+
+class LLMOverloadedError(RuntimeError):
+    """Вызов не дождался допуска к модели за LLM_QUEUE_TIMEOUT_SECONDS."""
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """429 (квота) и 503 (модель перегружена) - временные ошибки, которые имеет смысл повторить"""
+    code = getattr(error, "code", None)
+    try:
+        if code is not None and int(code) in _RETRYABLE_STATUS_CODES:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return type(error).__name__ in _RETRYABLE_ERROR_NAMES
+
+
+class LLMGovernor:
+    """Token bucket + ограничение параллелизма + справедливые очереди по пользователям."""
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+        burst: int = LLM_BURST,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE_SECONDS,
+        backoff_max: float = LLM_BACKOFF_MAX_SECONDS,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT_SECONDS,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_per_second = requests_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_timeout = queue_timeout
+
+        # Очереди ожидающих по ключу справедливости; порядок ключей - порядок обхода по кругу
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._in_flight = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._wakeup_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._waits: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+        self._stats = {
+            "admitted": 0,
+            "max_queue_depth": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "rate_limited": 0,
+            "retries": 0,
+            "failed_after_retries": 0,
+            "queue_timeouts": 0,
+        }
+
+    # --- Допуск ---
+
+    def _queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _refill(self, now: float):
+        self._tokens = min(float(self.burst), self._tokens + (now - self._refilled_at) * self.rate_per_second)
+        self._refilled_at = now
+
+    def _schedule_wakeup(self, delay: float):
+        loop = asyncio.get_running_loop()
+        if self._wakeup is not None and self._wakeup_loop is loop:
+            return
+        self._wakeup_loop = loop
+        self._wakeup = loop.call_later(max(delay, 0.001), self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def _dispatch(self):
+        """Допускает ожидающих по кругу, пока есть свободные слоты и токены"""
+        now = time.monotonic()
+        self._refill(now)
+        while self._queues and self._in_flight < self.max_concurrency:
+            if now < self._paused_until:
+                self._schedule_wakeup(self._paused_until - now)
+                return
+            if self._tokens < 1:
+                self._schedule_wakeup((1 - self._tokens) / self.rate_per_second if self.rate_per_second > 0 else 1.0)
+                return
+            key, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if future.done():
+                # Ожидающий уже ушел (отмена или таймаут)
+                continue
+            self._tokens -= 1
+            self._in_flight += 1
+            future.set_result(None)
+
+    def _remove_waiter(self, key: str, future: asyncio.Future):
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            return
+        if not queue:
+            del self._queues[key]
+
+    async def acquire(self, key: Optional[str] = None) -> float:
+        """Ждет допуска к модели. Возвращает время ожидания в секундах."""
+        key = key or get_fairness_key()
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue_depth())
+        started = time.monotonic()
+        self._dispatch()
+        try:
+            if self.queue_timeout > 0:
+                await asyncio.wait_for(future, self.queue_timeout)
+            else:
+                await future
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий уходит - возвращаем слот
+                self.release()
+            else:
+                future.cancel()
+                self._remove_waiter(key, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self._stats["queue_timeouts"] += 1
+                raise LLMOverloadedError(f"Очередь к модели переполнена: ожидание дольше {self.queue_timeout:g} с") from e
+            raise
+
+        waited = time.monotonic() - started
+        self._stats["admitted"] += 1
+        self._stats["total_wait_seconds"] += waited
+        self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+        self._waits.append(waited)
+        if waited > 1:
+            logger.info(f"Вызов LLM ({key}) ждал допуска {waited:.2f} с, в очереди {self._queue_depth()}")
+        return waited
+
+    def release(self):
+        """Освобождает слот и допускает следующих ожидающих"""
+        self._in_flight = max(0, self._in_flight - 1)
+        self._dispatch()
+
+    # --- Повторы ---
+
+    def _backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с jitter; на время задержки приостанавливает весь bucket"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + delay)
+        self._tokens = 0.0
+        self._stats["rate_limited"] += 1
+        return delay
+
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        if not is_retryable_error(error):
+            return False
+        if attempt >= self.max_retries:
+            self._stats["failed_after_retries"] += 1
+            self._stats["rate_limited"] += 1
+            return False
+        return True
+
+    async def run(self, call: Callable[[], Awaitable[T]], key: Optional[str] = None) -> T:
+        """Выполняет вызов модели под управлением governor, повторяя его на 429/503"""
+        key = key or get_fairness_key()
+        attempt = 0
+        while True:
+            await self.acquire(key)
+            try:
+                return await call()
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Модель ответила {type(e).__name__}, повтор {attempt + 1}/{self.max_retries} через {delay:.1f} с: {e}")
+            finally:
+                self.release()
+            attempt += 1
+            self._stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def stream(self, open_stream: Callable[[], Awaitable[AsyncIterator[T]]], key: Optional[str] = None) -> AsyncIterator[T]:
+        """
+        Потоковый вызов под управлением governor: слот занят, пока поток читается.
+        Повтор возможен, только если ошибка случилась до первого фрагмента.
+        """
+        key = key or get_fairness_key()
+        attempt = 0
+        while True:
+            await self.acquire(key)
+            started_streaming = False
+            try:
+                async for item in await open_stream():
+                    started_streaming = True
+                    yield item
+                return
+            except Exception as e:
+                if started_streaming or not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Поток модели прерван {type(e).__name__}, повтор {attempt + 1}/{self.max_retries} через {delay:.1f} с: {e}")
+            finally:
+                self.release()
+            attempt += 1
+            self._stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Глубина очереди, параллелизм, время ожидания допуска и счетчики повторов"""
+        waits = sorted(self._waits)
+        stats = dict(self._stats)
+        stats["queue_depth"] = self._queue_depth()
+        stats["queued_keys"] = len(self._queues)
+        stats["in_flight"] = self._in_flight
+        stats["tokens_available"] = round(min(float(self.burst), self._tokens), 2)
+        stats["avg_wait_seconds"] = round(stats.pop("total_wait_seconds") / stats["admitted"], 4) if stats["admitted"] else 0.0
+        stats["p95_wait_seconds"] = round(waits[int(len(waits) * 0.95) - 1 if len(waits) > 1 else 0], 4) if waits else 0.0
+        stats["max_wait_seconds"] = round(stats["max_wait_seconds"], 4)
+        stats["limits"] = {
+            "max_concurrency": self.max_concurrency,
+            "requests_per_minute": round(self.rate_per_second * 60, 2),
+            "burst": self.burst,
+        }
+        return stats
+
+
+# Общий governor для всех вызовов Gemini в процессе
+llm_governor = LLMGovernor()
@@ -0,0 +1,131 @@
+"""
+Hedged requests для вызовов модели.
+
+Хвост задержки Gemini длинный: большая часть ответов приходит за секунды, но отдельные
+генерации "зависают" в несколько раз дольше. Вызовы generate_text идемпотентны (нет
+побочных эффектов, результат - только текст), поэтому их можно дублировать:
+HedgePolicy.run() запускает основной вызов и, если он не ответил за наблюдаемый p95
+задержки модели (но не раньше LLM_HEDGE_MIN_DELAY_SECONDS), отправляет один дубликат.
+Побеждает первый успешный ответ, проигравший вызов отменяется.
+
+HedgePolicy.run() вызывается уже после допуска governor (внутри llm_governor.run), поэтому
+отсчет задержки начинается с начала самого вызова модели: ожидание в очереди и паузы backoff
+не приводят к дублям, а p95 сравнивается с тем же, что и замеряется, - задержкой модели.
+Дубликат проходит через governor как обычный вызов (hedge_call), а доля дублей ограничена
+LLM_HEDGE_MAX_RATIO от числа вызовов, поэтому при деградации модели (когда медленные
+все вызовы) hedging не удваивает нагрузку. Пока по модели меньше LLM_HEDGE_MIN_SAMPLES
+замеров, p95 неизвестен и дубли не отправляются. Потоковые вызовы не дублируются.
+"""
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# --- Настройки (из переменных окружения) ---
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1").lower() not in ("0", "false", "no")
+# Дубль не отправляется раньше этой задержки, даже если p95 меньше
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "1.0"))
+# Максимальная доля дублей от числа вызовов
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+_LATENCY_SAMPLES = 200
+_HEDGE_QUANTILE = 0.95
+
+
+class HedgePolicy:
+    """Задержка hedge по наблюдаемому p95 модели и запуск дублирующего вызова."""
+
+    def __init__(
+        self,
+        enabled: bool = LLM_HEDGE_ENABLED,
+        min_delay: float = LLM_HEDGE_MIN_DELAY_SECONDS,
+        max_ratio: float = LLM_HEDGE_MAX_RATIO,
+        min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+    ):
+        self.enabled = enabled
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "skipped_by_ratio": 0}
+
+    def observe(self, model_name: str, latency_seconds: float):
+        """Учитывает задержку успешного вызова модели"""
+        self._latencies.setdefault(model_name, deque(maxlen=_LATENCY_SAMPLES)).append(latency_seconds)
+
+    def hedge_delay(self, model_name: str) -> Optional[float]:
+        """Через сколько секунд отправлять дубль; None - замеров пока недостаточно"""
+        samples = self._latencies.get(model_name)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return max(self.min_delay, ordered[int(len(ordered) * _HEDGE_QUANTILE) - 1])
+
+    def _hedge_allowed(self) -> bool:
+        if self._stats["hedged"] + 1 > self._stats["calls"] * self.max_ratio:
+            self._stats["skipped_by_ratio"] += 1
+            return False
+        return True
+
+    async def run(
+        self,
+        model_name: str,
+        call: Callable[[], Awaitable[T]],
+        hedge_call: Optional[Callable[[], Awaitable[T]]] = None,
+    ) -> T:
+        """
+        Выполняет call(); если ответ задерживается дольше p95, параллельно запускает дубль hedge_call()
+        (по умолчанию - тот же call). Вызывается после допуска к модели: задержка отсчитывается от начала call.
+        Возвращает первый успешный результат; если оба вызова завершились ошибкой - ошибку основного.
+        """
+        self._stats["calls"] += 1
+        delay = self.hedge_delay(model_name) if self.enabled else None
+        if delay is None:
+            return await call()
+
+        primary = asyncio.ensure_future(call())
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                if not self._hedge_allowed():
+                    return await primary
+                self._stats["hedged"] += 1
+                logger.info(f"Вызов {model_name} не ответил за {delay:.1f} с (p95), отправлен дублирующий запрос")
+                tasks.append(asyncio.ensure_future((hedge_call or call)()))
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is None:
+                        if task is not primary:
+                            self._stats["hedge_wins"] += 1
+                        return task.result()
+            # Оба вызова завершились ошибкой
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Число дублей, победы дублей и текущая задержка hedge по моделям"""
+        stats: Dict[str, Any] = {"enabled": self.enabled, **self._stats}
+        stats["hedge_rate"] = round(self._stats["hedged"] / self._stats["calls"], 4) if self._stats["calls"] else 0.0
+        stats["hedge_delay_seconds"] = {
+            model_name: round(delay, 3)
+            for model_name in self._latencies
+            if (delay := self.hedge_delay(model_name)) is not None
+        }
+        return stats
+
+
+# Общая политика для процесса
+llm_hedging = HedgePolicy()
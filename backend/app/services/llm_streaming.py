@@ -0,0 +1,154 @@
+"""
+Вспомогательные средства для потоковой выдачи ответов LLM клиенту.
+
+- IncrementalJSONParser разбирает JSON-ответ модели по мере поступления фрагментов
+  и сообщает о полях верхнего уровня (и элементах массивов) сразу, как только они получены целиком.
+- format_sse_event упаковывает событие в формат server-sent events.
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+
+def format_sse_event(event: str, data: Any) -> str:
+    """Форматирует одно событие SSE"""
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+class IncrementalJSONParser:
+    """
+    Инкрементальный парсер JSON-объекта, который приходит от модели по частям.
+
+    Текст до первой '{' (например, ```json) пропускается. feed() возвращает список событий:
+    - {"type": "field", "key": ..., "value": ...} - значение поля верхнего уровня получено целиком;
+    - {"type": "item", "key": ..., "index": ..., "value": ...} - получен очередной элемент
+      массива верхнего уровня (например, этап воронки), до закрытия самого массива.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+        # Состояние на верхнем уровне объекта
+        self._expect = "key"  # key | colon | value | comma
+        self._key: Optional[str] = None
+        self._key_start: Optional[int] = None
+        self._value_start: Optional[int] = None
+        self._value_kind: Optional[str] = None  # string | scalar | object | array
+
+        # Состояние элементов массива верхнего уровня
+        self._item_start: Optional[int] = None
+        self._item_kind: Optional[str] = None
+        self._item_index = 0
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Добавляет очередной фрагмент текста и возвращает новые события"""
+        events: List[Dict[str, Any]] = []
+        if self.done or not chunk:
+            return events
+        self._text += chunk
+        text = self._text
+
+        while self._pos < len(text) and not self.done:
+            pos = self._pos
+            char = text[pos]
+            self._pos += 1
+
+            if not self._started:
+                if char == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._on_string_closed(pos, events)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    if self._expect == "key":
+                        self._key_start = pos
+                    elif self._expect == "value":
+                        self._value_start, self._value_kind = pos, "string"
+                elif self._depth == 2 and self._value_kind == "array" and self._item_start is None:
+                    self._item_start, self._item_kind = pos, "string"
+            elif char in "{[":
+                if self._depth == 1 and self._expect == "value":
+                    self._value_start = pos
+                    self._value_kind = "array" if char == "[" else "object"
+                    self._item_index = 0
+                elif self._depth == 2 and self._value_kind == "array" and self._item_start is None:
+                    self._item_start, self._item_kind = pos, "container"
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 2 and self._value_kind == "array" and self._item_kind == "scalar":
+                    self._emit_item(pos, events)
+                if self._depth == 1 and self._value_kind == "scalar":
+                    self._emit_field(pos, events)
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+                elif self._depth == 1 and self._value_kind in ("array", "object"):
+                    self._emit_field(pos + 1, events)
+                elif self._depth == 2 and self._value_kind == "array" and self._item_kind == "container":
+                    self._emit_item(pos + 1, events)
+            elif char == ":" and self._depth == 1:
+                self._expect = "value"
+            elif char == ",":
+                if self._depth == 1:
+                    if self._value_kind == "scalar":
+                        self._emit_field(pos, events)
+                    self._expect = "key"
+                elif self._depth == 2 and self._value_kind == "array" and self._item_kind == "scalar":
+                    self._emit_item(pos, events)
+            elif not char.isspace():
+                if self._depth == 1 and self._expect == "value" and self._value_start is None:
+                    self._value_start, self._value_kind = pos, "scalar"
+                elif self._depth == 2 and self._value_kind == "array" and self._item_start is None:
+                    self._item_start, self._item_kind = pos, "scalar"
+
+        return events
+
+    def _on_string_closed(self, pos: int, events: List[Dict[str, Any]]):
+        if self._depth == 1:
+            if self._expect == "key" and self._key_start is not None:
+                self._key = self._loads(self._text[self._key_start:pos + 1])
+                self._key_start = None
+                self._expect = "colon"
+            elif self._value_kind == "string":
+                self._emit_field(pos + 1, events)
+        elif self._depth == 2 and self._value_kind == "array" and self._item_kind == "string":
+            self._emit_item(pos + 1, events)
+
+    def _emit_field(self, end: int, events: List[Dict[str, Any]]):
+        value = self._loads(self._text[self._value_start:end].strip())
+        events.append({"type": "field", "key": self._key, "value": value})
+        self._value_start = None
+        self._value_kind = None
+        self._expect = "comma"
+
+    def _emit_item(self, end: int, events: List[Dict[str, Any]]):
+        value = self._loads(self._text[self._item_start:end].strip())
+        events.append({"type": "item", "key": self._key, "index": self._item_index, "value": value})
+        self._item_index += 1
+        self._item_start = None
+        self._item_kind = None
+
+    @staticmethod
+    def _loads(raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except (json.JSONDecodeError, ValueError):
+            return raw
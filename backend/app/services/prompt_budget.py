@@ -0,0 +1,336 @@
+"""
+Сборка промптов по бюджету токенов.
+
+Вместо фиксированных срезов истории ([-8:], [-5:]) и обрезки текста по символам
+каждый промпт собирается из секций в рамках бюджета токенов модели:
+- токены оцениваются локально (без обращения к API) по составу символов;
+- секции заполняются по приоритету: состояние брифинга и сообщение пользователя
+  раньше старых реплик диалога;
+- история диалога добавляется от новых сообщений к старым, пока помещается;
+- длинные документы обрезаются по границе предложения
+  или делятся на перекрывающиеся фрагменты (split_into_chunks).
+
+По каждой сборке формируется отчет о расходе токенов по секциям
+(пишется в лог и агрегируется в статистику для /llm/stats).
+"""
+import logging
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..core.api_setup import DEFAULT_GEMINI_MODEL, resolve_model_route
+
+logger = logging.getLogger(__name__)
+
+# --- Бюджеты (из переменных окружения) ---
+# Бюджет входного контекста на один промпт. Он намеренно много меньше окна модели:
+# ограничение держит задержку предсказуемой, а не только защищает от переполнения контекста.
+_MODEL_TOKEN_BUDGETS = {
+    "models/gemini-2.0-flash-001": 32000,
+    "models/gemini-2.5-flash": 64000,
+    "models/gemini-1.5-flash-latest": 32000,
+    "models/gemini-1.5-pro-latest": 64000,
+}
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "0"))  # 0 - использовать бюджет модели
+PROMPT_DEFAULT_TOKEN_BUDGET = 32000
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4000"))
+DOCUMENT_TOKEN_BUDGET = int(os.getenv("DOCUMENT_TOKEN_BUDGET", "16000"))
+# Документы длиннее одного фрагмента анализируются по частям (map-reduce), см. gemini.analyze_document_content
+DOCUMENT_CHUNK_TOKENS = int(os.getenv("DOCUMENT_CHUNK_TOKENS", "8000"))
+DOCUMENT_CHUNK_OVERLAP_TOKENS = int(os.getenv("DOCUMENT_CHUNK_OVERLAP_TOKENS", "300"))
+
+# Граница предложения: знак конца предложения с пробелом или перевод строки
+_SENTENCE_END_RE = re.compile(r"[.!?…](?=\s)|\n")
+_TRUNCATION_MARK = "\n[...]\n"
+
+_prompt_stats: Dict[str, Dict[str, Any]] = {}
+_prompt_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Локальная оценка количества токенов.
+
+    Латиница и цифры - около 4 символов на токен, кириллица и прочие не-ASCII
+    символы - около 2.5 символа на токен (оценка с запасом).
+    """
+    if not text:
+        return 0
+    length = len(text)
+    # В UTF-8 ASCII занимает 1 байт, кириллица - 2, поэтому разница длин дает число не-ASCII символов
+    non_ascii = len(text.encode("utf-8", errors="ignore")) - length
+    non_ascii = min(max(non_ascii, 0), length)
+    return int((length - non_ascii) / 4 + non_ascii / 2.5) + 1
+
+
+def get_model_token_budget(model_name: str = DEFAULT_GEMINI_MODEL) -> int:
+    """Бюджет входных токенов на промпт для модели"""
+    if PROMPT_TOKEN_BUDGET > 0:
+        return PROMPT_TOKEN_BUDGET
+    return _MODEL_TOKEN_BUDGETS.get(model_name, PROMPT_DEFAULT_TOKEN_BUDGET)
+
+
+def get_task_token_budget(task: str) -> int:
+    """
+    Бюджет входных токенов для задачи по ее маршруту (api_setup.resolve_model_route).
+    Модель маршрута выбирается по размеру готового промпта: если промпт больше бюджета базовой
+    модели уходит в heavy-модель, бюджет расширяется до бюджета heavy-модели.
+    """
+    budget = get_model_token_budget(resolve_model_route(task).model_name)
+    oversized_route = resolve_model_route(task, budget + 1)
+    if oversized_route.tier == "heavy":
+        budget = max(budget, get_model_token_budget(oversized_route.model_name))
+    return budget
+
+
+def _fit_prefix(text: str, max_tokens: int) -> int:
+    """Максимальная длина префикса, который укладывается в max_tokens (бинарный поиск)"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _cut_head(text: str, max_tokens: int) -> str:
+    """Начало текста в пределах бюджета, обрезанное по последней границе предложения"""
+    end = _fit_prefix(text, max_tokens)
+    head = text[:end]
+    boundaries = [match.end() for match in _SENTENCE_END_RE.finditer(head)]
+    # Не теряем больше трети текста ради ровной границы - иначе режем по пробелу
+    if boundaries and boundaries[-1] >= end * 2 // 3:
+        return head[:boundaries[-1]].rstrip()
+    space = head.rfind(" ")
+    if space >= end * 2 // 3:
+        return head[:space].rstrip()
+    return head
+
+
+def _cut_tail(text: str, max_tokens: int) -> str:
+    """Конец текста в пределах бюджета, начинающийся с новой фразы"""
+    reversed_start = _fit_prefix(text[::-1], max_tokens)
+    tail = text[len(text) - reversed_start:]
+    match = _SENTENCE_END_RE.search(tail)
+    if match and match.end() <= len(tail) // 3:
+        return tail[match.end():].lstrip()
+    return tail
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "head") -> Tuple[str, bool]:
+    """
+    Обрезает текст до бюджета токенов по границам предложений.
+
+    Args:
+        text: Исходный текст
+        max_tokens: Бюджет токенов
+        keep: "head" - сохранить начало, "head_tail" - начало и конец
+              (в документах там обычно самая важная информация)
+
+    Returns:
+        Tuple[str, bool]: Текст и признак того, что он был обрезан
+    """
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text, False
+    if max_tokens <= 0:
+        return "", True
+    if keep == "head_tail":
+        half = max(max_tokens - estimate_tokens(_TRUNCATION_MARK), 0) // 2
+        return _cut_head(text, half) + _TRUNCATION_MARK + _cut_tail(text, half), True
+    return _cut_head(text, max_tokens), True
+
+
+def split_into_chunks(text: str, max_tokens: int, overlap_tokens: int = 0) -> List[str]:
+    """
+    Делит текст на фрагменты не больше max_tokens по границам предложений.
+    Каждый следующий фрагмент начинается с последних ~overlap_tokens предыдущего,
+    чтобы факты на стыке фрагментов не терялись.
+    """
+    if not text:
+        return []
+    if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+        return [text]
+    overlap_tokens = max(0, min(overlap_tokens, max_tokens // 4))
+    # Токен занимает не больше 4 символов, поэтому фрагмент ищется в окне из 4 * max_tokens символов
+    window = max_tokens * 4 + 1
+    chunks: List[str] = []
+    rest = text
+    while rest:
+        if estimate_tokens(rest[:window + 1]) <= max_tokens:
+            chunks.append(rest)
+            break
+        chunk = _cut_head(rest[:window], max_tokens) or rest[:max(1, _fit_prefix(rest[:window], max_tokens))]
+        chunks.append(chunk)
+        rest = rest[len(chunk):].lstrip()
+        if rest and overlap_tokens:
+            rest = _cut_tail(chunk, overlap_tokens) + "\n" + rest
+    return chunks
+
+
+class PromptAssembler:
+    """
+    Собирает промпт из шаблона (str.format с плейсхолдерами секций) и секций
+    в рамках бюджета токенов.
+
+    Статическая часть (system_instruction, см. services/prompts.py) учитывается в бюджете
+    и в отчете отдельно от динамической: ее передают модели как инструкцию, а не в тексте промпта.
+
+    Бюджет берется из модели, которой уйдет промпт: явной model_name или маршрута задачи task
+    (тот же task передается в llm_client), иначе - из DEFAULT_GEMINI_MODEL.
+
+    Пример:
+        assembler = PromptAssembler("briefing_turn", template, task="briefing_turn", system_instruction=BRIEFING_TURN_INSTRUCTION)
+        assembler.add("current_context", current_context, priority=100)
+        assembler.add_messages("chat_context", chat_history, format_message, header="История:\\n", priority=50)
+        prompt = assembler.build()
+    """
+
+    def __init__(
+        self,
+        name: str,
+        template: str,
+        model_name: Optional[str] = None,
+        budget: Optional[int] = None,
+        system_instruction: str = "",
+        task: Optional[str] = None,
+    ):
+        self.name = name
+        self.template = template
+        self.system_instruction = system_instruction
+        self.task = task
+        self.model_name = model_name or (resolve_model_route(task).model_name if task else DEFAULT_GEMINI_MODEL)
+        # Без явной модели модель маршрута зависит от размера промпта и уточняется в build()
+        self.budget_from_route = bool(task) and not model_name
+        if budget is None:
+            budget = get_task_token_budget(task) if self.budget_from_route else get_model_token_budget(self.model_name)
+        self.budget = budget
+        self._sections: List[Dict[str, Any]] = []
+        self.report: Dict[str, Any] = {}
+
+    def add(self, name: str, text: str, priority: int = 0, max_tokens: Optional[int] = None, keep: str = "head"):
+        """Текстовая секция. Если не помещается в остаток бюджета - обрезается по границе предложения."""
+        self._sections.append({
+            "name": name, "kind": "text", "text": text or "",
+            "priority": priority, "max_tokens": max_tokens, "keep": keep,
+        })
+
+    def add_messages(
+        self,
+        name: str,
+        messages: Optional[List[Dict[str, str]]],
+        formatter: Callable[[Dict[str, str]], str],
+        header: str = "",
+        priority: int = 0,
+        max_tokens: Optional[int] = None,
+    ):
+        """Секция истории: сообщения добавляются от новых к старым, пока помещаются в бюджет."""
+        self._sections.append({
+            "name": name, "kind": "messages", "messages": messages or [], "formatter": formatter,
+            "header": header, "priority": priority, "max_tokens": max_tokens,
+        })
+
+    def _render_messages(self, section: Dict[str, Any], available: int) -> Tuple[str, Dict[str, Any]]:
+        messages = section["messages"]
+        if not messages:
+            return "", {"messages": 0, "messages_total": 0}
+        header = section["header"]
+        remaining = available - estimate_tokens(header)
+        parts: List[str] = []
+        for message in reversed(messages):
+            formatted = section["formatter"](message)
+            cost = estimate_tokens(formatted)
+            if cost <= remaining:
+                parts.append(formatted)
+                remaining -= cost
+                continue
+            if not parts and remaining > 0:
+                # Даже последнее сообщение не помещается целиком - берем его начало
+                parts.append(truncate_to_tokens(formatted, remaining)[0])
+            break
+        info = {"messages": len(parts), "messages_total": len(messages)}
+        if not parts:
+            return "", info
+        return header + "".join(reversed(parts)), info
+
+    def build(self) -> str:
+        """Собирает промпт и заполняет self.report"""
+        template_tokens = estimate_tokens(self.template.format(**{section["name"]: "" for section in self._sections}))
+        static_tokens = estimate_tokens(self.system_instruction)
+        available = self.budget - template_tokens - static_tokens
+        rendered: Dict[str, str] = {}
+        sections_report: Dict[str, Dict[str, Any]] = {}
+        truncated_any = False
+
+        # Сортировка устойчивая: при равном приоритете сохраняется порядок добавления
+        for section in sorted(self._sections, key=lambda item: -item["priority"]):
+            limit = max(available, 0)
+            if section["max_tokens"] is not None:
+                limit = min(limit, section["max_tokens"])
+            if section["kind"] == "messages":
+                text, info = self._render_messages(section, limit)
+                truncated = info["messages"] < info["messages_total"]
+            else:
+                text, truncated = truncate_to_tokens(section["text"], limit, keep=section["keep"])
+                info = {}
+            tokens = estimate_tokens(text)
+            available -= tokens
+            truncated_any = truncated_any or truncated
+            rendered[section["name"]] = text
+            sections_report[section["name"]] = {"tokens": tokens, "truncated": truncated, **info}
+
+        prompt = self.template.format(**rendered)
+        dynamic_tokens = estimate_tokens(prompt)
+        if self.task and self.budget_from_route:
+            # Модель, которую llm_client выберет по маршруту для промпта такого размера
+            self.model_name = resolve_model_route(self.task, static_tokens + dynamic_tokens).model_name
+        self.report = {
+            "prompt": self.name,
+            "model": self.model_name,
+            "budget": self.budget,
+            "template_tokens": template_tokens,
+            "static_tokens": static_tokens,
+            "dynamic_tokens": dynamic_tokens,
+            "total_tokens": static_tokens + dynamic_tokens,
+            "truncated": truncated_any,
+            "sections": sections_report,
+        }
+        _record_report(self.report)
+        logger.info(
+            f"Промпт '{self.name}': ~{self.report['total_tokens']} из {self.budget} токенов "
+            f"(инструкция {static_tokens}, шаблон {template_tokens}, секции: "
+            + ", ".join(f"{name}={item['tokens']}" for name, item in sections_report.items())
+            + (", есть обрезка" if truncated_any else "") + ")"
+        )
+        return prompt
+
+
+def _record_report(report: Dict[str, Any]):
+    with _prompt_stats_lock:
+        stats = _prompt_stats.setdefault(report["prompt"], {"builds": 0, "truncated": 0, "total_tokens": 0, "static_tokens": 0, "max_tokens": 0})
+        stats["builds"] += 1
+        stats["total_tokens"] += report["total_tokens"]
+        stats["static_tokens"] += report["static_tokens"]
+        stats["max_tokens"] = max(stats["max_tokens"], report["total_tokens"])
+        if report["truncated"]:
+            stats["truncated"] += 1
+        stats["last"] = report
+
+
+def get_prompt_stats() -> Dict[str, Any]:
+    """Статистика сборки промптов: средний и максимальный размер, число обрезок, последний отчет по секциям"""
+    with _prompt_stats_lock:
+        return {
+            name: {
+                "builds": stats["builds"],
+                "truncated": stats["truncated"],
+                "avg_tokens": round(stats["total_tokens"] / stats["builds"]) if stats["builds"] else 0,
+                "avg_static_tokens": round(stats["static_tokens"] / stats["builds"]) if stats["builds"] else 0,
+                "avg_dynamic_tokens": round((stats["total_tokens"] - stats["static_tokens"]) / stats["builds"]) if stats["builds"] else 0,
+                "max_tokens": stats["max_tokens"],
+                "last_sections": stats["last"]["sections"],
+            }
+            for name, stats in _prompt_stats.items()
+        }
@@ -0,0 +1,254 @@
+"""
+Индекс уже заданных уточняющих вопросов проекта.
+
+Раньше вопросы ассистента извлекались регулярным выражением из всей истории диалога
+при каждом вызове (квадратично за жизнь диалога) и отсеивались только точные повторы.
+Теперь вопросы извлекаются один раз - при сохранении сообщения ассистента
+(record_asked_questions) - и хранятся в таблице asked_questions. В памяти процесса
+для каждого проекта держится QuestionIndex:
+
+- recent() - последние вопросы для промпта, без сканирования истории;
+- find_duplicate() - поиск почти повторов: вопросы нормализуются (briefing_merge.normalize_text),
+  режутся на символьные шинглы, кандидаты ищутся через MinHash LSH (корзины по полосам
+  сигнатуры), а решение принимается по точному коэффициенту Жаккара шинглов кандидата;
+- filter_new() - отсев сгенерированных вопросов, которые повторяют уже заданные (или друг друга).
+
+Индекс догружает из БД только строки, добавленные после последней загрузки (в том числе
+другими воркерами). При первой загрузке проекта без сохраненных вопросов они однократно
+извлекаются из истории сообщений ассистента.
+"""
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import AskedQuestion, ChatMessage
+from app.services.briefing_merge import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+# Порог похожести (Жаккар символьных шинглов), начиная с которого вопрос считается повтором
+QUESTION_DUPLICATE_THRESHOLD = float(os.getenv("QUESTION_DUPLICATE_THRESHOLD", "0.55"))
+# Сколько последних вопросов передается в промпт
+QUESTION_PROMPT_LIMIT = int(os.getenv("QUESTION_PROMPT_LIMIT", "10"))
+# Сколько проектов держать в памяти процесса
+QUESTION_INDEX_MAX_PROJECTS = int(os.getenv("QUESTION_INDEX_MAX_PROJECTS", "1000"))
+
+_QUESTION_RE = re.compile(r"[^.!?\n]*\?")
+# Догрузка перечитывает столько id ниже последнего загруженного: при конкурентных записях
+# (PostgreSQL) строка с меньшим id может закоммититься позже строки с большим
+_RESCAN_IDS = 50
+_SHINGLE_SIZE = 4
+# 32 полосы по 2 строки: пара с похожестью 0.5 попадает в общую корзину с вероятностью > 0.99
+_MINHASH_BANDS = 32
+_MINHASH_ROWS = 2
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20240611)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(_MINHASH_BANDS * _MINHASH_ROWS)
+]
+
+_indexes: "OrderedDict[int, QuestionIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def extract_questions(text: Optional[str]) -> List[str]:
+    """Вопросы из текста сообщения (предложения, заканчивающиеся на "?")"""
+    questions = []
+    for match in _QUESTION_RE.findall(text or ""):
+        # Убираем нумерацию и маркеры списков в начале вопроса
+        question = re.sub(r"^[\s\d.)*•-]+", "", match).strip()
+        if normalize_text(question):
+            questions.append(question)
+    return questions
+
+
+def question_shingles(question: str) -> FrozenSet[str]:
+    """Символьные шинглы нормализованного вопроса (устойчивы к словоформам)"""
+    text = f" {normalize_text(question)} "
+    if len(text) <= _SHINGLE_SIZE:
+        return frozenset([text])
+    return frozenset(text[pos:pos + _SHINGLE_SIZE] for pos in range(len(text) - _SHINGLE_SIZE + 1))
+
+
+def minhash_signature(shingles: Iterable[str]) -> Tuple[int, ...]:
+    """MinHash-сигнатура множества шинглов"""
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles]
+    if not hashes:
+        return tuple(0 for _ in _PERMUTATIONS)
+    return tuple(min((a * value + b) % _MERSENNE_PRIME for value in hashes) for a, b in _PERMUTATIONS)
+
+
+def _band_keys(signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+    return [(band, signature[band * _MINHASH_ROWS:(band + 1) * _MINHASH_ROWS]) for band in range(_MINHASH_BANDS)]
+
+
+def jaccard(first: FrozenSet[str], second: FrozenSet[str]) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+class QuestionIndex:
+    """Заданные вопросы одного проекта с поиском почти повторов."""
+
+    def __init__(self, questions: Iterable[str] = (), threshold: float = QUESTION_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.last_id = 0
+        self._questions: List[str] = []
+        self._shingles: List[FrozenSet[str]] = []
+        self._normalized: Dict[str, int] = {}
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = defaultdict(list)
+        for question in questions:
+            self.add(question)
+
+    @classmethod
+    def from_chat_history(cls, chat_history: Optional[List[Dict[str, str]]]) -> "QuestionIndex":
+        """Временный индекс по сообщениям ассистента (для вызовов без сохраненного индекса проекта)"""
+        index = cls()
+        for message in chat_history or []:
+            if message.get("role") == "assistant":
+                for question in extract_questions(message.get("content")):
+                    index.add(question)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._questions)
+
+    def _find_duplicate(self, normalized: str, shingles: FrozenSet[str], band_keys: List[Tuple[int, Tuple[int, ...]]]) -> Optional[int]:
+        if normalized in self._normalized:
+            return self._normalized[normalized]
+        candidates = set()
+        for band_key in band_keys:
+            candidates.update(self._buckets.get(band_key, ()))
+        best_position, best_score = None, 0.0
+        for position in candidates:
+            score = jaccard(shingles, self._shingles[position])
+            if score > best_score:
+                best_position, best_score = position, score
+        return best_position if best_score >= self.threshold else None
+
+    def find_duplicate(self, question: str) -> Optional[str]:
+        """Уже заданный вопрос, который повторяет question (точно или почти), иначе None"""
+        normalized = normalize_text(question)
+        if not normalized:
+            return None
+        if normalized in self._normalized:
+            return self._questions[self._normalized[normalized]]
+        shingles = question_shingles(question)
+        position = self._find_duplicate(normalized, shingles, _band_keys(minhash_signature(shingles)))
+        return self._questions[position] if position is not None else None
+
+    def add(self, question: str) -> bool:
+        """Добавляет вопрос; False, если он повторяет уже заданный"""
+        question = question.strip()
+        normalized = normalize_text(question)
+        if not normalized or normalized in self._normalized:
+            return False
+        shingles = question_shingles(question)
+        band_keys = _band_keys(minhash_signature(shingles))
+        if self._find_duplicate(normalized, shingles, band_keys) is not None:
+            return False
+        position = len(self._questions)
+        self._questions.append(question)
+        self._shingles.append(shingles)
+        self._normalized[normalized] = position
+        for band_key in band_keys:
+            self._buckets[band_key].append(position)
+        return True
+
+    def recent(self, limit: int = QUESTION_PROMPT_LIMIT) -> List[str]:
+        """Последние заданные вопросы (для промпта)"""
+        return self._questions[-limit:] if limit > 0 else []
+
+    def filter_new(self, questions: Iterable[str]) -> List[str]:
+        """Вопросы, которые не повторяют уже заданные и друг друга (индекс не изменяется)"""
+        batch = QuestionIndex(threshold=self.threshold)
+        result = []
+        for question in questions:
+            duplicate = self.find_duplicate(question)
+            if duplicate is not None:
+                logger.info(f"Вопрос '{question}' отброшен как повтор уже заданного '{duplicate}'")
+                continue
+            if batch.add(question):
+                result.append(question.strip())
+        return result
+
+
+async def _load_new_rows(db: AsyncSession, project_id: int, index: QuestionIndex):
+    """
+    Догружает в индекс вопросы, сохраненные после последней загрузки.
+    Последние _RESCAN_IDS id перечитываются: уже загруженные вопросы индекс отбрасывает как повторы.
+    """
+    rows = await db.execute(
+        select(AskedQuestion.id, AskedQuestion.text)
+        .where(AskedQuestion.project_id == project_id, AskedQuestion.id > index.last_id - _RESCAN_IDS)
+        .order_by(AskedQuestion.id)
+    )
+    for row in rows:
+        index.add(row.text)
+        index.last_id = max(index.last_id, row.id)
+
+
+async def _backfill_from_history(db: AsyncSession, project_id: int, index: QuestionIndex):
+    """
+    Однократно извлекает вопросы из истории проекта, начатой до появления индекса.
+    Строки сохраняются в отдельной сессии (тот же движок): commit не затрагивает несохраненные
+    изменения вызывающего кода, а в индекс вопросы попадают только после успешного commit.
+    """
+    async with AsyncSession(db.bind, autoflush=False, expire_on_commit=False) as backfill_db:
+        messages = await backfill_db.scalars(
+            select(ChatMessage.content)
+            .where(ChatMessage.project_id == project_id, ChatMessage.role == "assistant")
+            .order_by(ChatMessage.id)
+        )
+        questions = QuestionIndex(threshold=index.threshold).filter_new(
+            question for content in messages for question in extract_questions(content)
+        )
+        if not questions:
+            return
+        rows = [AskedQuestion(project_id=project_id, text=question) for question in questions]
+        backfill_db.add_all(rows)
+        await backfill_db.commit()
+    await _load_new_rows(db, project_id, index)
+    logger.info(f"Индекс вопросов проекта {project_id} заполнен из истории ({len(rows)} вопросов)")
+
+
+async def get_question_index(db: AsyncSession, project_id: int) -> QuestionIndex:
+    """Индекс заданных вопросов проекта (из памяти процесса, с догрузкой новых строк из БД)"""
+    with _indexes_lock:
+        index = _indexes.get(project_id)
+        is_new = index is None
+        if is_new:
+            index = QuestionIndex()
+            _indexes[project_id] = index
+            while len(_indexes) > QUESTION_INDEX_MAX_PROJECTS:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(project_id)
+    await _load_new_rows(db, project_id, index)
+    if is_new and not len(index):
+        await _backfill_from_history(db, project_id, index)
+    return index
+
+
+async def record_asked_questions(db: AsyncSession, project_id: int, content: str) -> List[str]:
+    """
+    Сохраняет вопросы из нового сообщения ассистента (повторы уже заданных пропускаются).
+    Строки добавляются в сессию; commit выполняет вызывающий код вместе с самим сообщением.
+    Индекс процесса здесь не меняется: вопросы попадают в него из БД (_load_new_rows) после commit,
+    поэтому при откате в индексе не остается несохраненных вопросов.
+    """
+    index = await get_question_index(db, project_id)
+    new_questions = index.filter_new(extract_questions(content))
+    db.add_all([AskedQuestion(project_id=project_id, text=question) for question in new_questions])
+    return new_questions
@@ -0,0 +1,84 @@
+"""
+Single-flight: объединение одинаковых операций, выполняющихся одновременно.
+
+Двойной клик или повтор запроса с фронтенда запускают ту же дорогую работу
+(сводка проекта, импорт сайта, уточняющие вопросы, скачивание страницы) параллельно.
+SingleFlight.do() по ключу (операция + хэш входных данных) отдает всем одновременным
+вызовам одну общую задачу: вызов Gemini или загрузку страницы выполняет только первый.
+
+Общая задача защищена от отмены (asyncio.shield): если первый клиент отключился,
+остальные все равно получат результат. Каждый вызывающий, включая первого, получает свою
+копию результата, чтобы изменения на стороне одного не влияли на остальных.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def make_flight_key(operation: str, key_data: Any) -> str:
+    """Ключ операции: имя + sha256 от входных данных"""
+    payload = json.dumps(key_data, sort_keys=True, ensure_ascii=False, default=str)
+    return f"{operation}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+class SingleFlight:
+    """Реестр выполняющихся операций и счетчики объединенных вызовов."""
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _operation_stats(self, operation: str) -> Dict[str, int]:
+        return self._stats.setdefault(operation, {"executed": 0, "coalesced": 0})
+
+    def _forget(self, key: str, task: asyncio.Future):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Забираем исключение, чтобы asyncio не ругался на "never retrieved", если ожидающих не осталось
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, operation: str, key_data: Any, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполняет func() или присоединяется к уже выполняющейся операции с тем же ключом.
+
+        Args:
+            operation: Имя операции (для метрик и ключа)
+            key_data: Входные данные, однозначно определяющие результат
+            func: Фабрика корутины, выполняющей операцию
+        """
+        key = make_flight_key(operation, key_data)
+        task = self._in_flight.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self._operation_stats(operation)["coalesced"] += 1
+            logger.info(f"Запрос '{operation}' присоединен к уже выполняющейся операции")
+            return copy.deepcopy(await asyncio.shield(task))
+
+        task = asyncio.ensure_future(func())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        self._operation_stats(operation)["executed"] += 1
+        # Копия и первому: присоединившиеся копируют результат позже, уже после его изменений первым
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Количество выполненных и объединенных вызовов по операциям"""
+        return {
+            "in_flight": len(self._in_flight),
+            "operations": {name: dict(stats) for name, stats in self._stats.items()},
+            "coalesced_total": sum(stats["coalesced"] for stats in self._stats.values()),
+        }
+
+
+# Общий экземпляр для процесса
+single_flight = SingleFlight()
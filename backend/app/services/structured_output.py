@@ -0,0 +1,431 @@
+"""
+Структурированные (JSON) ответы модели.
+
+- Схема ответа Gemini (response_schema + response_mime_type=application/json) строится
+  из Pydantic-схем приложения, поэтому модель сразу возвращает JSON нужной структуры.
+- Ответ разбирается локально: json.loads, затем выделение JSON-объекта из текста
+  (код-блоки ```json, текст до/после объекта), затем ремонт "почти JSON"
+  (висячие запятые, комментарии, одинарные кавычки, True/False/None, переводы строк
+  внутри строк, ответ, оборванный по max_output_tokens).
+- Повторный запрос к модели (просьба исправить JSON) - только последнее средство.
+
+Статистика по операциям (сколько ответов разобрано сразу, отремонтировано,
+потребовало повторного запроса или потеряно) доступна через get_stats() и /llm/stats.
+"""
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+
+from . import llm_client
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+# Передавать модели схему ответа (JSON mode). 0 - только локальный разбор и ремонт
+LLM_RESPONSE_SCHEMA_ENABLED = os.getenv("LLM_RESPONSE_SCHEMA_ENABLED", "1").lower() not in ("0", "false", "no")
+# Разрешить повторный запрос к модели, если ответ не удалось ни разобрать, ни отремонтировать
+LLM_JSON_REPROMPT_ENABLED = os.getenv("LLM_JSON_REPROMPT_ENABLED", "1").lower() not in ("0", "false", "no")
+
+_CODE_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_MAX_REPAIR_CUTS = 5
+
+_REPROMPT_TEMPLATE = """
+Следующий текст должен быть JSON-объектом по схеме, но он поврежден или не соответствует схеме.
+Исправь его и верни ТОЛЬКО корректный JSON-объект без пояснений. Сохрани все данные из исходного текста.
+
+Схема:
+{schema}
+
+Исходный текст:
+{text}
+"""
+
+_schema_cache: Dict[type, Dict[str, Any]] = {}
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+class StructuredOutputError(ValueError):
+    """Ответ модели не удалось привести к JSON нужной схемы."""
+
+    def __init__(self, message: str, raw_text: str = ""):
+        super().__init__(message)
+        self.raw_text = raw_text
+
+
+# --- Схема ответа для Gemini ---
+
+def _nullable_fields(schema_model: Type[BaseModel], collected: Optional[Dict[str, Set[str]]] = None) -> Dict[str, Set[str]]:
+    """
+    Поля, допускающие None (Optional[...]), по названиям моделей в схеме, включая вложенные модели.
+    По JSON Schema Pydantic 1.x их не отличить: default опускается и у Optional[...] = None,
+    и у полей с default_factory.
+    """
+    collected = {} if collected is None else collected
+    title = schema_model.__config__.title or schema_model.__name__
+    if title in collected:
+        return collected
+    collected[title] = {field.alias for field in schema_model.__fields__.values() if field.allow_none}
+    for field in schema_model.__fields__.values():
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            _nullable_fields(field.type_, collected)
+    return collected
+
+
+def _convert_schema_node(node: Dict[str, Any], definitions: Dict[str, Any], nullable_fields: Dict[str, Set[str]]) -> Dict[str, Any]:
+    """Переводит узел JSON Schema (Pydantic) в подмножество OpenAPI, которое понимает Gemini"""
+    description = node.get("description")
+    if "$ref" in node:
+        node = definitions[node["$ref"].split("/")[-1]]
+    elif "allOf" in node and len(node["allOf"]) == 1:
+        node = _convert_schema_node(node["allOf"][0], definitions, nullable_fields)
+    nullable = False
+    if "anyOf" in node:
+        variants = [variant for variant in node["anyOf"] if variant.get("type") != "null"]
+        nullable = len(variants) < len(node["anyOf"])
+        # Из вариантов Union берем самый структурированный (валидаторы схем нормализуют остальные)
+        variants.sort(key=lambda variant: {"array": 0, "object": 1}.get(variant.get("type"), 2))
+        node = _convert_schema_node(variants[0], definitions, nullable_fields)
+
+    result: Dict[str, Any] = {"type": node.get("type", "string")}
+    if description or node.get("description"):
+        result["description"] = description or node["description"]
+    if "enum" in node:
+        result["enum"] = [str(value) for value in node["enum"]]
+    if nullable or node.get("nullable"):
+        result["nullable"] = True
+    if result["type"] == "object" and "properties" in node:
+        required = set(node.get("required", []))
+        optional = nullable_fields.get(node.get("title"), set())
+        properties = {}
+        for name, prop in node["properties"].items():
+            converted = _convert_schema_node(prop, definitions, nullable_fields)
+            # null допустим только для Optional[...]: поле с default_factory валидатор с null не примет
+            if name in optional:
+                converted["nullable"] = True
+            properties[name] = converted
+        result["properties"] = properties
+        if required:
+            result["required"] = sorted(required)
+    if result["type"] == "array":
+        result["items"] = _convert_schema_node(node.get("items", {"type": "string"}), definitions, nullable_fields)
+    return result
+
+
+def gemini_response_schema(schema_model: Type[BaseModel]) -> Dict[str, Any]:
+    """Схема ответа Gemini для Pydantic-модели (кэшируется на модель)"""
+    if schema_model not in _schema_cache:
+        schema = schema_model.schema()
+        _schema_cache[schema_model] = _convert_schema_node(schema, schema.get("definitions", {}), _nullable_fields(schema_model))
+    return _schema_cache[schema_model]
+
+
+def with_response_schema(generation_config: Optional[Dict[str, Any]], schema_model: Type[BaseModel]) -> Dict[str, Any]:
+    """Дополняет параметры генерации JSON-режимом и схемой ответа"""
+    config = dict(generation_config or {})
+    if LLM_RESPONSE_SCHEMA_ENABLED:
+        config["response_mime_type"] = "application/json"
+        config["response_schema"] = gemini_response_schema(schema_model)
+    return config
+
+
+# --- Локальный разбор и ремонт ---
+
+def _extract_json_candidate(text: str) -> Optional[str]:
+    """Выделяет JSON-объект из текста: содержимое код-блока, от первой '{' до парной ей '}'"""
+    fence = _CODE_FENCE_RE.search(text)
+    if fence and "{" in fence.group(1):
+        text = fence.group(1)
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escape = False
+    for pos in range(start, len(text)):
+        char = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:pos + 1]
+    # Объект не закрыт (ответ оборван) - отдаем остаток на ремонт
+    return text[start:]
+
+
+def _close_structure(out: List[str], stack: List[str], in_string: bool) -> str:
+    """Закрывает оборванную строку и незакрытые скобки"""
+    text = "".join(out)
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(",")
+    return text + "".join("}" if opener == "{" else "]" for opener in reversed(stack))
+
+
+def repair_json(candidate: str) -> str:
+    """
+    Ремонтирует "почти JSON" за один проход по символам.
+    Если ремонт дал невалидный JSON, обрезает оборванный хвост до последнего целого элемента.
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    # Точки отката: после целого элемента (запятая) и после открывающей скобки
+    comma_cuts: List[Tuple[int, List[str]]] = []
+    bracket_cuts: List[Tuple[int, List[str]]] = []
+    in_string = False
+    quote = '"'
+    escape = False
+    pos = 0
+    length = len(candidate)
+
+    while pos < length:
+        char = candidate[pos]
+        if in_string:
+            if escape:
+                escape = False
+                out.append(char)
+            elif char == "\\":
+                escape = True
+                out.append(char)
+            elif char == quote:
+                in_string = False
+                out.append('"')
+            elif char == '"':
+                # Двойная кавычка внутри строки в одинарных кавычках
+                out.append('\\"')
+            elif char == "\n":
+                out.append("\\n")
+            elif char == "\r":
+                pass
+            elif char == "\t":
+                out.append("\\t")
+            else:
+                out.append(char)
+            pos += 1
+            continue
+
+        if char in "\"'":
+            in_string = True
+            quote = char
+            out.append('"')
+        elif candidate.startswith("//", pos):
+            newline = candidate.find("\n", pos)
+            pos = length if newline == -1 else newline
+            continue
+        elif candidate.startswith("/*", pos):
+            end = candidate.find("*/", pos + 2)
+            pos = length if end == -1 else end + 2
+            continue
+        elif char in "{[":
+            stack.append(char)
+            out.append(char)
+            bracket_cuts.append((len(out), list(stack)))
+        elif char in "}]":
+            # Висячая запятая перед закрывающей скобкой
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+            out.append(char)
+        elif char == ",":
+            comma_cuts.append((len(out), list(stack)))
+            out.append(char)
+        elif char.isalpha():
+            word_end = pos
+            while word_end < length and (candidate[word_end].isalnum() or candidate[word_end] == "_"):
+                word_end += 1
+            word = candidate[pos:word_end]
+            out.append(_PYTHON_LITERALS.get(word, word))
+            pos = word_end
+            continue
+        else:
+            out.append(char)
+        pos += 1
+
+    repaired = _close_structure(out, stack, in_string)
+    try:
+        json.loads(repaired)
+        return repaired
+    except json.JSONDecodeError:
+        pass
+    # Оборванный хвост (например, ключ без значения): откатываемся к последним целым элементам,
+    # а если их нет - к пустому вложенному объекту/массиву. К пустому объекту верхнего уровня
+    # не откатываемся: он прошел бы проверку схемы со значениями по умолчанию вместо ошибки
+    nested_cuts = [(cut, cut_stack) for cut, cut_stack in bracket_cuts if len(cut_stack) > 1]
+    for cut, cut_stack in list(reversed(comma_cuts[-_MAX_REPAIR_CUTS:])) + list(reversed(nested_cuts[-_MAX_REPAIR_CUTS:])):
+        attempt = _close_structure(out[:cut], cut_stack, False)
+        try:
+            json.loads(attempt)
+            return attempt
+        except json.JSONDecodeError:
+            continue
+    return repaired
+
+
+def parse_structured_text(text: str, schema_model: Optional[Type[BaseModel]] = None) -> Tuple[Any, str]:
+    """
+    Разбирает ответ модели в JSON (и проверяет схему, если она задана).
+
+    Returns:
+        Tuple[Any, str]: Данные и способ разбора: "direct" | "extracted" | "repaired"
+
+    Raises:
+        StructuredOutputError: Ответ не удалось разобрать или он не соответствует схеме
+    """
+    text = (text or "").strip()
+    method = "direct"
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        candidate = _extract_json_candidate(text)
+        if candidate is None:
+            raise StructuredOutputError("JSON не найден в ответе модели", text)
+        try:
+            data = json.loads(candidate)
+            method = "extracted"
+        except json.JSONDecodeError:
+            try:
+                data = json.loads(repair_json(candidate))
+                method = "repaired"
+            except json.JSONDecodeError as e:
+                raise StructuredOutputError(f"Не удалось отремонтировать JSON: {e}", text)
+
+    if schema_model is not None:
+        if not isinstance(data, dict):
+            raise StructuredOutputError(f"Ожидался JSON-объект, получено: {type(data).__name__}", text)
+        try:
+            data = schema_model.parse_obj(data).dict()
+        except ValidationError as e:
+            raise StructuredOutputError(f"Ответ не соответствует схеме {schema_model.__name__}: {e}", text)
+    return data, method
+
+
+# --- Метрики ---
+
+def record_parse(operation: str, outcome: str):
+    """Учитывает исход разбора: direct | extracted | repaired | reprompted | failed"""
+    stats = _stats.setdefault(operation, {"responses": 0, "direct": 0, "extracted": 0, "repaired": 0, "reprompted": 0, "failed": 0})
+    stats["responses"] += 1
+    stats[outcome] += 1
+
+
+def get_stats() -> Dict[str, Any]:
+    """Доли ответов, разобранных сразу, отремонтированных локально, потребовавших повторного запроса и потерянных"""
+    result = {}
+    for operation, stats in _stats.items():
+        responses = stats["responses"] or 1
+        result[operation] = {
+            **stats,
+            "parse_failure_rate": round((stats["responses"] - stats["direct"]) / responses, 4),
+            "repair_rate": round((stats["extracted"] + stats["repaired"]) / responses, 4),
+            "wasted_call_rate": round((stats["reprompted"] + stats["failed"]) / responses, 4),
+        }
+    return result
+
+
+# --- Генерация ---
+
+async def generate_structured(
+    prompt: str,
+    schema_model: Type[BaseModel],
+    *,
+    operation: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    model_name: Optional[str] = None,
+    safety_settings: Optional[List[Dict[str, str]]] = None,
+    system_instruction: Optional[str] = None,
+    use_cache: bool = True,
+    reprompt: Optional[bool] = None,
+    task: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Запрашивает у модели JSON по схеме schema_model и возвращает провалидированные данные.
+
+    Args:
+        prompt: Промпт
+        schema_model: Pydantic-схема ответа
+        operation: Имя операции для метрик
+        generation_config: Параметры генерации (схема ответа добавляется автоматически)
+        model_name: Имя модели (по умолчанию - из маршрута задачи)
+        safety_settings: Настройки безопасности
+        system_instruction: Статическая часть промпта
+        use_cache: Использовать кэш ответов LLM
+        reprompt: Разрешить повторный запрос при неразборчивом ответе (по умолчанию LLM_JSON_REPROMPT_ENABLED)
+        task: Задача для маршрутизации по моделям (см. api_setup.resolve_model_route)
+
+    Raises:
+        StructuredOutputError: Ответ не удалось разобрать даже после повторного запроса
+    """
+    config = with_response_schema(generation_config, schema_model)
+    text = await llm_client.generate_text(
+        prompt, model_name=model_name, generation_config=config, safety_settings=safety_settings,
+        system_instruction=system_instruction, use_cache=use_cache, task=task,
+    )
+    return await parse_or_reprompt(
+        text, schema_model, operation=operation, prompt=prompt, generation_config=config,
+        model_name=model_name, safety_settings=safety_settings, system_instruction=system_instruction, reprompt=reprompt, task=task,
+    )
+
+
+async def parse_or_reprompt(
+    text: str,
+    schema_model: Type[BaseModel],
+    *,
+    operation: str,
+    prompt: str,
+    generation_config: Dict[str, Any],
+    model_name: Optional[str] = None,
+    safety_settings: Optional[List[Dict[str, str]]] = None,
+    system_instruction: Optional[str] = None,
+    reprompt: Optional[bool] = None,
+    task: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Разбирает уже полученный ответ (в т.ч. собранный из потока); при неудаче - повторный запрос"""
+    try:
+        data, method = parse_structured_text(text, schema_model)
+        record_parse(operation, method)
+        if method != "direct":
+            logger.info(f"Ответ модели для '{operation}' разобран способом '{method}'")
+        return data
+    except StructuredOutputError as parse_error:
+        # Неразборчивый ответ не должен обслуживаться из кэша при следующем запросе
+        await llm_client.invalidate_cached(
+            prompt, model_name=model_name, generation_config=generation_config,
+            safety_settings=safety_settings, system_instruction=system_instruction, task=task,
+        )
+        if not (LLM_JSON_REPROMPT_ENABLED if reprompt is None else reprompt):
+            record_parse(operation, "failed")
+            raise
+        logger.warning(f"Ответ модели для '{operation}' не разобран ({parse_error}), повторный запрос на исправление JSON")
+
+    repair_prompt = _REPROMPT_TEMPLATE.format(
+        schema=json.dumps(gemini_response_schema(schema_model), ensure_ascii=False),
+        text=text,
+    )
+    repair_config = dict(generation_config, temperature=0)
+    repaired_text = await llm_client.generate_text(
+        repair_prompt, model_name=model_name, generation_config=repair_config, safety_settings=safety_settings, use_cache=False, task=task,
+    )
+    try:
+        data, _ = parse_structured_text(repaired_text, schema_model)
+    except StructuredOutputError:
+        record_parse(operation, "failed")
+        raise
+    record_parse(operation, "reprompted")
+    return data
@@ -0,0 +1,172 @@
+"""
+Потоковый прием загружаемых файлов (multipart/form-data).
+
+Тело запроса читается по частям (request.stream()) и разбирается push-парсером python-multipart,
+без предварительной буферизации всего тела. Содержимое поля файла пишется в SpooledTemporaryFile:
+до UPLOAD_SPOOL_BYTES - в памяти, дальше - во временный файл на диске. Одновременно считаются
+размер и sha256 содержимого (по хэшу распознаются повторные загрузки того же файла).
+
+Лимит UPLOAD_MAX_BYTES проверяется по ходу приема: запрос с большим Content-Length отклоняется
+до чтения тела, а при превышении лимита во время приема чтение прекращается (UploadTooLarge).
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Dict, Optional
+
+from starlette.requests import Request
+
+try:
+    from python_multipart.exceptions import MultipartParseError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    from multipart.exceptions import MultipartParseError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+# Максимальный размер загружаемого файла
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# До этого размера файл держится в памяти, больше - во временном файле на диске
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+
+# Служебная часть multipart-тела (boundary, заголовки частей, прочие поля) сверх размера файла
+_MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class InvalidUpload(ValueError):
+    """Тело запроса не является multipart/form-data с файлом."""
+
+
+class UploadTooLarge(ValueError):
+    """Файл или тело запроса больше допустимого размера."""
+
+
+class SpooledUpload:
+    """Принятый файл: содержимое во временном хранилище, размер и sha256."""
+
+    def __init__(self, filename: str, content_type: str, spool_bytes: int = UPLOAD_SPOOL_BYTES):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self._hash = hashlib.sha256()
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def spooled_to_disk(self) -> bool:
+        return bool(getattr(self.file, "_rolled", False))
+
+    def write(self, data: bytes, max_bytes: int):
+        self.size += len(data)
+        if self.size > max_bytes:
+            raise UploadTooLarge(f"Файл больше {max_bytes} байт")
+        self._hash.update(data)
+        self.file.write(data)
+
+    def read_text(self) -> str:
+        """
+        Содержимое файла как текст (UTF-8, недекодируемые байты пропускаются).
+        Чтение синхронное (до UPLOAD_MAX_BYTES, возможно с диска): из async-кода - через asyncio.to_thread
+        """
+        self.file.seek(0)
+        return self.file.read().decode("utf-8", errors="ignore")
+
+    def close(self):
+        self.file.close()
+
+
+async def receive_upload(
+    request: Request,
+    field_name: str = "file",
+    max_bytes: int = UPLOAD_MAX_BYTES,
+    spool_bytes: int = UPLOAD_SPOOL_BYTES,
+) -> SpooledUpload:
+    """
+    Принимает файл из поля field_name multipart-тела запроса. Остальные поля пропускаются.
+    Вызывающий код закрывает результат (close()).
+    Raises:
+        InvalidUpload: не multipart/form-data, тело повреждено или в нем нет поля файла
+        UploadTooLarge: файл больше max_bytes (или тело заведомо больше)
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise InvalidUpload("Ожидается multipart/form-data")
+    body_limit = max_bytes + _MULTIPART_OVERHEAD_BYTES
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > body_limit:
+        raise UploadTooLarge(f"Файл больше {max_bytes} байт")
+
+    upload: Optional[SpooledUpload] = None
+    part: Dict[str, bytes] = {}
+    receiving = False
+
+    def on_part_begin():
+        nonlocal receiving
+        part.clear()
+        receiving = False
+
+    def on_header_field(data: bytes, start: int, end: int):
+        part["field"] = part.get("field", b"") + data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        part["value"] = part.get("value", b"") + data[start:end]
+
+    def on_header_end():
+        header = part.pop("field", b"").lower()
+        value = part.pop("value", b"")
+        if header == b"content-disposition":
+            part["disposition"] = value
+        elif header == b"content-type":
+            part["content_type"] = value
+
+    def on_headers_finished():
+        nonlocal upload, receiving
+        _, options = parse_options_header(part.get("disposition", b""))
+        if options.get(b"name", b"").decode("utf-8", errors="replace") != field_name or upload is not None:
+            return
+        filename = options.get(b"filename", b"").decode("utf-8", errors="replace")
+        upload = SpooledUpload(filename or "document", part.get("content_type", b"").decode("latin-1"), spool_bytes)
+        receiving = True
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if receiving:
+            upload.write(data[start:end], max_bytes)
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+    })
+    body_size = 0
+    try:
+        async for chunk in request.stream():
+            body_size += len(chunk)
+            if body_size > body_limit:
+                raise UploadTooLarge(f"Файл больше {max_bytes} байт")
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError as e:
+        if upload is not None:
+            upload.close()
+        raise InvalidUpload(f"Некорректное multipart-тело: {e}") from e
+    except Exception:
+        if upload is not None:
+            upload.close()
+        raise
+
+    if upload is None:
+        raise InvalidUpload(f"В запросе нет поля {field_name} с файлом")
+    logger.info(
+        f"Принят файл {upload.filename} ({upload.size} байт, sha256 {upload.sha256[:12]}, "
+        f"{'на диске' if upload.spooled_to_disk else 'в памяти'})"
+    )
+    return upload
@@ -0,0 +1,268 @@
+"""
+Учет расхода токенов LLM по пользователям, проектам и эндпоинтам.
+
+Каждый вызов модели из llm_client (и каждое попадание в кэш ответов) учитывается
+в UsageLedger: токены промпта, из context cache и ответа, задержка и модель. Метки
+(uid, project_id, endpoint) берутся из контекста вызова (core/llm_context).
+
+Записи не пишутся в Firestore по одной: счетчики агрегируются в памяти по ключу
+(день UTC, uid, проект, эндпоинт, модель) и сбрасываются пачкой (batch с
+firestore.Increment) раз в USAGE_FLUSH_INTERVAL_SECONDS или когда накопилось
+USAGE_FLUSH_MAX_KEYS ключей. Один документ коллекции llm_usage - один ключ агрегации,
+поэтому число записей зависит от разнообразия ключей, а не от числа вызовов.
+Если сброс не удался, дельты возвращаются в буфер и уходят со следующей пачкой.
+
+Для потоковых ответов бэкенд не сообщает расход, и токены оцениваются по длине текста
+(счетчик estimated_calls).
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from google.cloud import firestore
+
+from ..core.llm_context import get_llm_call_context
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (из переменных окружения) ---
+USAGE_LEDGER_ENABLED = os.getenv("USAGE_LEDGER_ENABLED", "1").lower() not in ("0", "false", "no")
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "30"))
+USAGE_FLUSH_MAX_KEYS = int(os.getenv("USAGE_FLUSH_MAX_KEYS", "200"))
+USAGE_COLLECTION = os.getenv("USAGE_COLLECTION", "llm_usage")
+
+# Ограничение Firestore на число операций в одной пачке
+_FIRESTORE_BATCH_LIMIT = 500
+_DIMENSIONS = ("day", "uid", "project_id", "endpoint", "model")
+_COUNTERS = ("calls", "errors", "cache_hits", "estimated_calls", "input_tokens", "cached_tokens", "output_tokens", "latency_ms")
+GROUP_BY_FIELDS = ("day", "project_id", "endpoint", "model")
+
+UsageKey = Tuple[str, str, str, str, str]
+
+
+def _empty_counters() -> Dict[str, int]:
+    return {counter: 0 for counter in _COUNTERS}
+
+
+def usage_doc_id(key: UsageKey) -> str:
+    """id документа агрегата (эндпоинт содержит "/", поэтому ключ хэшируется)"""
+    return hashlib.sha1("|".join(key).encode("utf-8")).hexdigest()
+
+
+class UsageLedger:
+    """Агрегированные в памяти счетчики расхода LLM с пакетным сбросом в Firestore."""
+
+    def __init__(
+        self,
+        enabled: bool = USAGE_LEDGER_ENABLED,
+        flush_interval: float = USAGE_FLUSH_INTERVAL_SECONDS,
+        flush_max_keys: int = USAGE_FLUSH_MAX_KEYS,
+        collection: str = USAGE_COLLECTION,
+    ):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.flush_max_keys = flush_max_keys
+        self.collection = collection
+        # Запись идет из event loop, а сброс может забирать буфер параллельно - защищаем блокировкой
+        self._lock = threading.Lock()
+        self._pending: Dict[UsageKey, Dict[str, int]] = {}
+        self._db_provider: Optional[Callable[[], Any]] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_scheduled = False
+        self._stats = {"records": 0, "flushes": 0, "flushed_keys": 0, "flush_errors": 0, "last_flush_seconds": 0.0}
+
+    def _key(self, model_name: str) -> UsageKey:
+        context = get_llm_call_context()
+        return (
+            datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+            str(context.get("uid") or ""),
+            str(context.get("project_id") or ""),
+            str(context.get("endpoint") or "unknown"),
+            model_name,
+        )
+
+    def record(
+        self,
+        model_name: str,
+        *,
+        input_tokens: int = 0,
+        cached_tokens: int = 0,
+        output_tokens: int = 0,
+        latency_seconds: float = 0.0,
+        error: bool = False,
+        cache_hit: bool = False,
+        estimated: bool = False,
+    ):
+        """Учитывает один вызов модели (или попадание в кэш ответов) в текущем контексте"""
+        if not self.enabled:
+            return
+        key = self._key(model_name)
+        with self._lock:
+            counters = self._pending.setdefault(key, _empty_counters())
+            counters["calls"] += 1
+            counters["errors"] += int(error)
+            counters["cache_hits"] += int(cache_hit)
+            counters["estimated_calls"] += int(estimated)
+            counters["input_tokens"] += input_tokens
+            counters["cached_tokens"] += cached_tokens
+            counters["output_tokens"] += output_tokens
+            counters["latency_ms"] += int(latency_seconds * 1000)
+            self._stats["records"] += 1
+            pending_keys = len(self._pending)
+        if pending_keys >= self.flush_max_keys:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        """Сброс вне очереди, если буфер разросся (не больше одного запланированного сброса)"""
+        if self._db_provider is None or self._flush_scheduled:
+            return
+        try:
+            asyncio.get_running_loop().create_task(self._scheduled_flush())
+            self._flush_scheduled = True
+        except RuntimeError:
+            # Нет работающего event loop - буфер сбросит периодическая задача
+            pass
+
+    async def _scheduled_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка внеочередного сброса учета расхода LLM: {e}")
+        finally:
+            self._flush_scheduled = False
+
+    def _take_pending(self) -> Dict[UsageKey, Dict[str, int]]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def _restore_pending(self, pending: Dict[UsageKey, Dict[str, int]]):
+        """Возвращает в буфер дельты, которые не удалось записать"""
+        with self._lock:
+            for key, counters in pending.items():
+                current = self._pending.setdefault(key, _empty_counters())
+                for counter, value in counters.items():
+                    current[counter] += value
+
+    def _resolve_db(self) -> Any:
+        """Клиент Firestore из провайдера; None, если база еще не инициализирована"""
+        if self._db_provider is None:
+            return None
+        try:
+            return self._db_provider()
+        except Exception:
+            return None
+
+    async def flush(self, db: Any = None) -> int:
+        """Записывает накопленные дельты в Firestore. Возвращает число записанных ключей."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            db = db or self._resolve_db()
+            if db is None:
+                return 0
+            pending = self._take_pending()
+            if not pending:
+                return 0
+            started = time.perf_counter()
+            items = list(pending.items())
+            written = 0
+            try:
+                for start in range(0, len(items), _FIRESTORE_BATCH_LIMIT):
+                    batch = db.batch()
+                    for key, counters in items[start:start + _FIRESTORE_BATCH_LIMIT]:
+                        data: Dict[str, Any] = dict(zip(_DIMENSIONS, key))
+                        data.update({counter: firestore.Increment(value) for counter, value in counters.items() if value})
+                        data["updated_at"] = datetime.now(timezone.utc)
+                        batch.set(db.collection(self.collection).document(usage_doc_id(key)), data, merge=True)
+                    await batch.commit()
+                    written = start + _FIRESTORE_BATCH_LIMIT
+            except Exception as e:
+                self._stats["flush_errors"] += 1
+                # Пачки до ошибки уже записаны, остальное вернется в буфер
+                self._restore_pending(dict(items[written:]))
+                logger.error(f"Не удалось сбросить учет расхода LLM в Firestore ({len(items) - written} ключей отложено): {e}")
+                return min(written, len(items))
+            self._stats["flushes"] += 1
+            self._stats["flushed_keys"] += len(items)
+            self._stats["last_flush_seconds"] = round(time.perf_counter() - started, 4)
+            return len(items)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка периодического сброса учета расхода LLM: {e}")
+
+    def start(self, db_provider: Callable[[], Any]):
+        """Запускает периодический сброс (вызывается при старте приложения)"""
+        self._db_provider = db_provider
+        if self.enabled and self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает периодический сброс и записывает остаток буфера"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def pending_rows(self, uid: str) -> List[Dict[str, Any]]:
+        """Еще не сброшенные агрегаты пользователя (в формате документов llm_usage)"""
+        with self._lock:
+            return [{**dict(zip(_DIMENSIONS, key)), **counters} for key, counters in self._pending.items() if key[1] == uid]
+
+    async def query(
+        self,
+        db: firestore.AsyncClient,
+        uid: str,
+        day_from: str,
+        day_to: str,
+        project_id: Optional[str] = None,
+        group_by: str = "day",
+    ) -> Dict[str, Any]:
+        """
+        Агрегаты расхода пользователя за период (дни UTC в формате YYYY-MM-DD, включительно),
+        сгруппированные по group_by (day | project_id | endpoint | model), с учетом еще не сброшенного буфера.
+        Запрос использует составной индекс llm_usage (uid ASC, day ASC).
+        """
+        query = db.collection(self.collection).where("uid", "==", uid).where("day", ">=", day_from).where("day", "<=", day_to)
+        rows = [doc.to_dict() for doc in await query.get()]
+        rows += [row for row in self.pending_rows(uid) if day_from <= row["day"] <= day_to]
+
+        totals = _empty_counters()
+        groups: Dict[str, Dict[str, int]] = {}
+        for row in rows:
+            if project_id and row.get("project_id") != project_id:
+                continue
+            group = groups.setdefault(str(row.get(group_by) or ""), _empty_counters())
+            for counter in _COUNTERS:
+                value = int(row.get(counter) or 0)
+                group[counter] += value
+                totals[counter] += value
+        return {
+            "uid": uid,
+            "from": day_from,
+            "to": day_to,
+            "project_id": project_id,
+            "group_by": group_by,
+            "totals": totals,
+            "groups": [{group_by: name, **counters} for name, counters in sorted(groups.items())],
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Размер буфера и счетчики сбросов"""
+        with self._lock:
+            pending_keys = len(self._pending)
+        return {"enabled": self.enabled, "pending_keys": pending_keys, **self._stats}
+
+
+usage_ledger = UsageLedger()
@@ -1,31 +1,33 @@
 # backend/app/services/website_importer_service.py
+import asyncio
 import os
-import json
-import re
 import requests
 import traceback
 from bs4 import BeautifulSoup
 from typing import Dict, Any, Optional
-import google.generativeai as genai
-from google.generativeai import types
 from fastapi import HTTPException, Depends # Добавляем Depends
 from dotenv import load_dotenv
 from google.cloud import firestore as google_firestore # Добавляем импорт Firestore
 
 # Импортируем новые схемы для ответа
-from ..schemas.website_import import WebsiteImportResponse
+from ..schemas.website_import import WebsiteImportExtraction, WebsiteImportResponse
 # Импортируем зависимость для БД
 from ..dependencies import get_db
+from . import llm_client
+from ..core.api_setup import DEFAULT_GEMINI_MODEL, get_llm_backend
+from ..core.llm_context import LLMDeadlineExceeded, bind_llm_call_context, run_with_deadline
+from .prompt_budget import DOCUMENT_TOKEN_BUDGET, PromptAssembler
+from .single_flight import single_flight
+from .structured_output import StructuredOutputError, parse_or_reprompt, with_response_schema
 
 load_dotenv()
 
-# Конфигурация Gemini (глобальная)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Конфигурация Gemini (глобальная). Модель и бюджет ответа (max_output_tokens) задает
+# маршрут задачи "website_import" (api_setup.resolve_model_route) - ответ небольшой JSON
 generation_config = {
     "temperature": 0.2, # Изменено на 0.2
     "top_p": 0.95,
     "top_k": 40,
-    "max_output_tokens": 65535, # Изменено на 65535
 }
 safety_settings = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
@@ -34,35 +36,38 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
 ]
 
-# Промпт для извлечения данных
-EXTRACTION_PROMPT_TEMPLATE = """
-Проанализируй следующий текст, извлеченный с веб-сайта. Твоя задача — извлечь как можно больше информации об эксперте (владельце сайта), его целевой аудитории и конкурентах, и структурировать ее в JSON-объект ТОЧНО следующего формата. Не добавляй никаких комментариев, пояснений или приветствий. Верни ТОЛЬКО JSON-объект или слово "ERROR", если извлечь данные невозможно.
+# Статическая инструкция для извлечения данных (передается как system_instruction, см. services/prompts.py)
+EXTRACTION_SYSTEM_INSTRUCTION = """
+Проанализируй текст, извлеченный с веб-сайта. Твоя задача — извлечь как можно больше информации об эксперте (владельце сайта), его целевой аудитории и конкурентах, и структурировать ее в JSON-объект ТОЧНО следующего формата. Не добавляй никаких комментариев, пояснений или приветствий. Верни ТОЛЬКО JSON-объект или слово "ERROR", если извлечь данные невозможно.
 
 Структура JSON:
 ```json
-{{
-  "expert_portrait": {{
+{
+  "expert_portrait": {
     "who_is": null,
     "sells": null,
     "usp": null,
     "solves_problem": null
-  }},
-  "target_audience_portrait": {{
+  },
+  "target_audience_portrait": {
     "soc_dem": null,
     "interests": null,
     "pains_desires": null,
     "content_consumed": null,
     "fears_objections": null
-  }},
-  "competitor_portrait": {{
+  },
+  "competitor_portrait": {
     "direct_competitors": null,
     "indirect_competitors": null
-  }}
-}}
+  }
+}
 ```
 Заполняй значения ключей извлеченной информацией из текста.
 **Важно:** Если информация для какого-либо ключа (особенно для `direct_competitors` и `indirect_competitors`) отсутствует в тексте, **не оставляй значение `null`**, а **сгенерируй наиболее вероятные предположения**, основываясь на сфере деятельности эксперта, его продуктах/услугах и целевой аудитории. Например, для клиники инфузионной терапии в Москве предположи другие подобные клиники или смежные услуги.
+""".strip()
 
+# Динамическая часть промпта: только текст сайта
+EXTRACTION_PROMPT_TEMPLATE = """
 Текст для анализа:
 ---
 {website_text}
@@ -77,83 +82,73 @@ class WebsiteImporterService:
     """
     def __init__(self, db: google_firestore.AsyncClient): # Принимаем db
         self.db = db # Сохраняем db
-        self.model = None
-        if not GEMINI_API_KEY:
-            print("Ошибка: GEMINI_API_KEY не установлен для WebsiteImporterService.")
-            return # Выходим, если ключа нет
-        try:
-            genai.configure(api_key=GEMINI_API_KEY)
-            # Используем модель по умолчанию из api_setup или указываем явно
-            from ..core.api_setup import get_gemini_model
-            self.model = get_gemini_model() # Получаем модель (например, 'gemini-1.5-flash-latest')
-            if not self.model:
-                 raise ValueError("Не удалось получить модель Gemini из api_setup")
-            print("WebsiteImporterService initialized with Gemini model.")
-        except Exception as e:
-            print(f"Ошибка инициализации модели Gemini в WebsiteImporterService: {e}")
-            self.model = None
+        # Бэкенд LLM общий для процесса (Gemini из реестра api_setup или локальный fake),
+        # поэтому создание сервиса на каждый запрос не переконфигурирует модель
+        self.llm_available = get_llm_backend().is_available(DEFAULT_GEMINI_MODEL, generation_config, safety_settings)
+        if not self.llm_available:
+            print("Ошибка: модель Gemini недоступна для WebsiteImporterService.")
 
-    async def _extract_data_with_gemini(self, text_input: str) -> Optional[Dict[str, Any]]:
+    async def _extract_data_with_gemini(self, text_input: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
         """
         Внутренний метод для вызова Gemini и парсинга JSON ответа.
+        use_cache=False отключает кэш ответов LLM для этого вызова.
         """
-        if not self.model:
+        if not self.llm_available:
             error_message = "Gemini model not initialized in WebsiteImporterService."
             print(error_message)
             raise HTTPException(status_code=500, detail=error_message)
 
         print("Attempting to generate brief from text using Gemini...")
-        extraction_prompt = EXTRACTION_PROMPT_TEMPLATE.format(website_text=text_input)
+        # Текст сайта обрезается по границе предложения до бюджета токенов, чтобы огромные страницы не переполняли контекст
+        assembler = PromptAssembler("website_import", EXTRACTION_PROMPT_TEMPLATE, task="website_import", system_instruction=EXTRACTION_SYSTEM_INSTRUCTION)
+        assembler.add("website_text", text_input, max_tokens=DOCUMENT_TOKEN_BUDGET)
+        extraction_prompt = assembler.build()
+
+        # JSON mode: модель получает схему ответа и возвращает JSON-объект этой структуры
+        extraction_config = with_response_schema(generation_config, WebsiteImportExtraction)
 
         try:
-            # Создаем объект types.GenerationConfig из глобального словаря
-            try:
-                gen_config_object = types.GenerationConfig(**generation_config)
-            except Exception as config_error:
-                 error_message = f"Failed to create GenerationConfig object: {config_error}"
-                 print(error_message)
-                 raise HTTPException(status_code=500, detail=error_message)
-
-            # Вызов API
-            response = await self.model.generate_content_async(
+            # Вызов API через общий клиент (с кэшем ответов)
+            response_text = await llm_client.generate_text(
                 extraction_prompt,
-                generation_config=gen_config_object,
-                safety_settings=safety_settings
+                generation_config=extraction_config,
+                safety_settings=safety_settings,
+                system_instruction=assembler.system_instruction,
+                use_cache=use_cache,
+                task="website_import",
             )
-            response_text = response.text.strip()
+            response_text = response_text.strip()
             print(f"Raw response from Gemini: {response_text[:500]}...") # Логируем начало ответа
 
-            if response_text.upper() == "ERROR":
+            # В JSON mode слово ERROR приходит строкой JSON ("ERROR")
+            if response_text.strip('"').upper() == "ERROR":
                 print("LLM indicated ERROR during extraction.")
                 raise HTTPException(status_code=400, detail="LLM indicated it could not extract data (returned ERROR).")
 
-            # Попытка парсинга JSON
-            json_match = re.search(r"```json\s*(\{.*?\})\s*```", response_text, re.DOTALL)
-            json_string_to_parse = ""
-            if json_match:
-                json_string_to_parse = json_match.group(1)
-            elif response_text.startswith("{") and response_text.endswith("}"):
-                 json_string_to_parse = response_text
-            else:
-                 print(f"Gemini response is not JSON or ERROR. Raw response: {response_text}")
-                 raise HTTPException(status_code=500, detail=f"LLM response was not in the expected JSON format or ERROR. Raw response: {response_text}")
-
+            # Разбор JSON (код-блоки, оборванный или "почти JSON" ремонтируются локально) и проверка структуры
             try:
-                print(f"Attempting to parse JSON string: {json_string_to_parse}")
-                extracted_data = json.loads(json_string_to_parse)
-                print(f"Successfully parsed JSON from Gemini: {extracted_data}")
-
-                # Проверка базовой структуры
-                if not isinstance(extracted_data, dict) or "expert_portrait" not in extracted_data:
-                     print(f"Extracted data structure mismatch (expected 'expert_portrait'): {extracted_data}")
-                     raise HTTPException(status_code=500, detail=f"LLM response structure mismatch. Expected 'expert_portrait' key. Got: {extracted_data}")
-
-                return extracted_data
-
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON from Gemini response: {e}. String was: {json_string_to_parse}")
-                raise HTTPException(status_code=500, detail=f"Failed to decode JSON from LLM response. Raw response: {json_string_to_parse}")
-
+                extracted_data = await parse_or_reprompt(
+                    response_text,
+                    WebsiteImportExtraction,
+                    operation="website_import",
+                    prompt=extraction_prompt,
+                    generation_config=extraction_config,
+                    safety_settings=safety_settings,
+                    system_instruction=assembler.system_instruction,
+                    task="website_import",
+                )
+            except StructuredOutputError as e:
+                print(f"Error parsing JSON from Gemini response: {e}")
+                raise HTTPException(status_code=500, detail=f"LLM response was not in the expected JSON format or ERROR. Raw response: {response_text}")
+
+            print(f"Successfully parsed JSON from Gemini: {extracted_data}")
+            return extracted_data
+
+        except HTTPException:
+            raise
+        except LLMDeadlineExceeded as e:
+            print(f"Gemini extraction exceeded the request deadline: {e}")
+            raise HTTPException(status_code=504, detail=f"LLM did not respond within the request deadline: {e}")
         except Exception as e:
             error_message = f"Error calling Gemini API for extraction: {e}"
             print(error_message)
@@ -162,22 +157,49 @@ class WebsiteImporterService:
             raise HTTPException(status_code=500, detail=error_message)
 
 
-    async def import_from_url(self, url: str, project_id: str) -> WebsiteImportResponse:
+    async def import_from_url(self, url: str, project_id: str, use_cache: bool = True) -> WebsiteImportResponse:
         """
         Основной метод: скачивает URL, извлекает текст, вызывает Gemini,
         сохраняет результат в Firestore и возвращает структурированные данные.
+        use_cache=False заставляет заново обратиться к Gemini, даже если такой текст уже анализировался.
+        Повторный импорт того же URL в тот же проект, пока первый еще выполняется, получает его результат.
         """
-        print(f"Starting website import for URL: {url}, Project ID: {project_id}")
+        # Присоединившийся запрос ждет общий импорт не дольше своего дедлайна
         try:
-            # 1. Скачивание и парсинг текста
+            return await run_with_deadline(single_flight.do(
+                "website_import",
+                {"url": str(url), "project_id": project_id, "use_cache": use_cache},
+                lambda: self._import_from_url(url, project_id, use_cache),
+            ))
+        except LLMDeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=f"Website import did not finish within the request deadline: {e}")
+
+    async def _fetch_page_text(self, url: str) -> str:
+        """Скачивает страницу (в отдельном потоке, чтобы не блокировать event loop) и извлекает текст"""
+        def fetch() -> str:
             headers = {'User-Agent': 'Mozilla/5.0'}
-            response = requests.get(str(url), headers=headers, timeout=15)
+            response = requests.get(url, headers=headers, timeout=15)
             response.raise_for_status()
 
             soup = BeautifulSoup(response.content, 'html.parser')
             for script_or_style in soup(["script", "style", "nav", "footer", "header"]):
                 script_or_style.decompose()
-            text_content = ' '.join(soup.stripped_strings)
+            return ' '.join(soup.stripped_strings)
+
+        # Одна и та же страница, запрошенная одновременно (например, для разных проектов), скачивается один раз.
+        # Поток со скачиванием не прерывается, но запрос перестает его ждать по дедлайну (requests ограничен timeout=15)
+        try:
+            return await run_with_deadline(single_flight.do("page_fetch", {"url": url}, lambda: asyncio.to_thread(fetch)))
+        except LLMDeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=f"Page download did not finish within the request deadline: {e}")
+
+    async def _import_from_url(self, url: str, project_id: str, use_cache: bool = True) -> WebsiteImportResponse:
+        print(f"Starting website import for URL: {url}, Project ID: {project_id}")
+        # Эндпоинт импорта не требует аутентификации, поэтому очередь к модели ведется по проекту
+        bind_llm_call_context(project_id=project_id)
+        try:
+            # 1. Скачивание и парсинг текста
+            text_content = await self._fetch_page_text(str(url))
 
             if not text_content:
                 print("Could not extract text content from the URL.")
@@ -186,7 +208,7 @@ class WebsiteImporterService:
             print(f"Extracted text (first 500 chars): {text_content[:500]}...")
 
             # 2. Извлечение данных с помощью Gemini
-            extracted_data = await self._extract_data_with_gemini(text_content)
+            extracted_data = await self._extract_data_with_gemini(text_content, use_cache=use_cache)
 
             if not extracted_data:
                  raise HTTPException(status_code=500, detail="Extraction process failed unexpectedly after Gemini call.")
@@ -0,0 +1,112 @@
+"""
+Бенчмарк чтения истории чата в ходе брифинга.
+
+Для проектов с разной длиной диалога (по умолчанию 10, 100, 1000 и 10000 сообщений) выполняет
+SQL-часть хода send_message без вызова модели: поиск проекта, сохранение сообщения пользователя,
+load_chat_context, индекс заданных вопросов, сохранение ответа ассистента. Для сравнения
+замеряется прежняя загрузка всей истории (order_by(created_at).all() и преобразование в dict).
+Время хода должно оставаться примерно постоянным, а полная загрузка - расти с длиной диалога.
+
+База - временный файл SQLite со схемой из app.db.models, запросы идут через асинхронный
+движок (aiosqlite), как в эндпоинтах.
+
+Запуск из директории backend:
+    python -m benchmarks.chat_history_load --sizes 10,100,1000,10000 --turns 30
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.db import Base
+from app.db.models import ChatMessage, Project, User
+from app.services.conversation_memory import CHAT_TAIL_MESSAGES, load_chat_context
+from app.services.question_index import get_question_index, record_asked_questions
+
+_ASSISTANT_REPLY = "Спасибо! Какую главную проблему клиента решает ваш продукт?\nСколько стоит базовый тариф?"
+
+
+async def _seed_project(db, project_id: int, messages: int):
+    """Проект с историей из messages сообщений; саммари покрывает все, кроме хвоста"""
+    db.add(Project(id=project_id, name=f"Проект {project_id}", owner_id=1, status="briefing", briefing_data={}))
+    await db.commit()
+    await db.execute(insert(ChatMessage), [
+        {
+            "project_id": project_id,
+            "role": "user" if index % 2 == 0 else "assistant",
+            "content": f"Сообщение {index}: " + ("Как вы привлекаете клиентов? " if index % 2 else "Мы продаем онлайн-курсы. ") * 5,
+        }
+        for index in range(messages)
+    ])
+    await db.commit()
+    # Фоновое обновление саммари держит несуммаризированными только последние сообщения
+    ids = (await db.scalars(select(ChatMessage.id).where(ChatMessage.project_id == project_id).order_by(ChatMessage.id))).all()
+    project = await db.get(Project, project_id)
+    if len(ids) > CHAT_TAIL_MESSAGES:
+        project.summarized_message_id = ids[-CHAT_TAIL_MESSAGES - 1]
+        project.conversation_summary = "Эксперт продает онлайн-курсы."
+    await db.commit()
+
+
+async def _turn(db, project_id: int, turn: int) -> float:
+    """SQL-часть одного хода send_message; возвращает время в секундах"""
+    started = time.perf_counter()
+    project = await db.scalar(select(Project).where(Project.id == project_id, Project.owner_id == 1))
+    db.add(ChatMessage(project_id=project_id, role="user", content=f"Ответ пользователя {turn}"))
+    await db.commit()
+    await load_chat_context(db, project)
+    (await get_question_index(db, project_id)).recent()
+    await db.commit()
+    db.add(ChatMessage(project_id=project_id, role="assistant", content=_ASSISTANT_REPLY))
+    await record_asked_questions(db, project_id, _ASSISTANT_REPLY)
+    await db.commit()
+    return time.perf_counter() - started
+
+
+async def _full_history_load(db, project_id: int) -> float:
+    """Прежний способ: вся история проекта в виде списка dict"""
+    started = time.perf_counter()
+    messages = (await db.scalars(select(ChatMessage).where(ChatMessage.project_id == project_id).order_by(ChatMessage.created_at))).all()
+    [{"role": msg.role, "content": msg.content} for msg in messages]
+    return time.perf_counter() - started
+
+
+async def _run(sizes, turns: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        async with async_sessionmaker(engine, autoflush=False, expire_on_commit=False)() as db:
+            db.add(User(id=1, email="bench@example.com", username="bench", hashed_password=""))
+            await db.commit()
+
+            print(f"{'сообщений':>10} | {'ход, мс (медиана)':>18} | {'ход, мс (p95)':>14} | {'вся история, мс':>16}")
+            for project_id, size in enumerate(sizes, start=1):
+                await _seed_project(db, project_id, size)
+                # Первый ход загружает индекс вопросов (однократное заполнение из истории) - не замеряем
+                await _turn(db, project_id, 0)
+                timings = sorted([await _turn(db, project_id, turn) for turn in range(1, turns + 1)])
+                full_load = statistics.median([await _full_history_load(db, project_id) for _ in range(5)])
+                print(
+                    f"{size:>10} | {statistics.median(timings) * 1000:>18.2f} | "
+                    f"{timings[max(int(len(timings) * 0.95) - 1, 0)] * 1000:>14.2f} | {full_load * 1000:>16.2f}"
+                )
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время SQL-части хода чата в зависимости от длины истории")
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="Длины истории через запятую")
+    parser.add_argument("--turns", type=int, default=30, help="Количество замеряемых ходов на проект")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    asyncio.run(_run(sizes, args.turns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Нагрузочный тест асинхронного пути Gemini.
+
+Запускает N параллельных вызовов analyze_expert_info с локальным fake-бэкендом LLM,
+который имитирует сетевую задержку генерации, и измеряет:
+- общее время выполнения пачки (при последовательном выполнении оно равно N * задержка);
+- максимальную задержку event loop (насколько "замерзает" воркер для остальных запросов).
+
+Запуск из директории backend:
+    python -m benchmarks.gemini_concurrency --requests 20 --latency 1.5
+"""
+import argparse
+import asyncio
+import time
+
+from app.core.api_setup import set_llm_backend
+from app.core.llm_backends import FakeLLMBackend
+from app.services import gemini, llm_client
+from app.services.llm_cache import response_cache
+from app.services.llm_governor import LLMGovernor
+
+
+async def _measure_loop_lag(stop: asyncio.Event, interval: float = 0.05) -> float:
+    """Возвращает максимальное опоздание тика event loop за время работы."""
+    max_lag = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - started - interval)
+    return max_lag
+
+
+async def _run_batch(backend: FakeLLMBackend, requests: int) -> dict:
+    set_llm_backend(backend)
+    # Кэш ответов отключаем, иначе повторные прогоны не доходят до модели
+    response_cache.enabled = False
+    # Лимиты governor не должны искажать замер: пропускаем всю пачку сразу
+    llm_client.llm_governor = LLMGovernor(max_concurrency=requests, requests_per_minute=requests * 60, burst=requests)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(_measure_loop_lag(stop))
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[
+        gemini.analyze_expert_info(f"Сообщение пользователя №{i}", chat_history=[], current_data={})
+        for i in range(requests)
+    ])
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    max_lag = await lag_task
+    errors = sum(1 for result in results if result.get("status") != "success")
+    return {"elapsed": elapsed, "max_loop_lag": max_lag, "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест параллельных вызовов Gemini")
+    parser.add_argument("--requests", type=int, default=20, help="Количество параллельных запросов")
+    parser.add_argument("--latency", type=float, default=1.0, help="Имитируемая задержка генерации, сек")
+    args = parser.parse_args()
+
+    for title, backend in (
+        ("Блокирующий вызов (старое поведение)", FakeLLMBackend(latency=f"fixed:{args.latency}", error_rate=0, blocking=True)),
+        ("generate_content_async", FakeLLMBackend(latency=f"fixed:{args.latency}", error_rate=0)),
+    ):
+        stats = asyncio.run(_run_batch(backend, args.requests))
+        print(
+            f"{title}: {args.requests} запросов за {stats['elapsed']:.2f} с "
+            f"(последовательно было бы {args.requests * args.latency:.2f} с), "
+            f"макс. задержка event loop {stats['max_loop_lag'] * 1000:.0f} мс, ошибок: {stats['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
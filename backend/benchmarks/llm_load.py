@@ -0,0 +1,134 @@
+"""
+Нагрузочный тест LLM-путей приложения без сети и квоты.
+
+Все вызовы модели обслуживает локальный fake-бэкенд (app.core.llm_backends.FakeLLMBackend)
+с заданным распределением задержки и долей ошибок, поэтому замер показывает пропускную
+способность и хвостовые задержки остального стека: сборка промптов, кэш, governor,
+single-flight, разбор JSON и слияние данных брифинга.
+
+Сценарии:
+- chat - ход брифинга (то, что делает chat.send_message);
+- summarize - сводка проекта;
+- website-import - извлечение данных из текста сайта (WebsiteImporterService).
+
+Запуск из директории backend:
+    python -m benchmarks.llm_load --scenario chat --requests 200 --concurrency 50 --latency lognormal:0.8,0.5 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import time
+
+from app.core.api_setup import set_llm_backend
+from app.core.llm_backends import FakeLLMBackend
+from app.services import gemini, llm_client
+from app.services.llm_cache import response_cache
+from app.services.llm_governor import LLMGovernor
+
+SITE_TEXT = "Онлайн-школа иностранных языков. Индивидуальные занятия с преподавателем, разговорные клубы, подготовка к экзаменам. " * 20
+
+
+async def _chat(index: int):
+    result = await gemini.run_briefing_turn(
+        f"Сообщение пользователя №{index}: я провожу курсы по маркетингу для экспертов",
+        chat_history=[{"role": "user", "content": "Привет"}, {"role": "assistant", "content": "Расскажите о продукте?"}],
+        current_data={"utp": "", "product_description": "", "funnel_elements": []},
+    )
+    if result.get("status") != "success":
+        raise RuntimeError(result.get("message"))
+
+
+async def _summarize(index: int):
+    result = await gemini.generate_project_summary({"name": f"Проект {index}", "briefing_data": {"utp": "Курсы маркетинга"}})
+    if result.get("status") != "success":
+        raise RuntimeError(result.get("message"))
+
+
+async def _website_import(index: int):
+    # Импорт здесь: сервис тянет клиент Firestore, который нужен только этому сценарию
+    from app.services.website_importer_service import WebsiteImporterService
+
+    await WebsiteImporterService(db=None)._extract_data_with_gemini(f"{SITE_TEXT} Страница {index}.")
+
+
+SCENARIOS = {"chat": _chat, "summarize": _summarize, "website-import": _website_import}
+
+
+def _percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+async def _run(args) -> dict:
+    backend = FakeLLMBackend(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    set_llm_backend(backend)
+    # Кэш ответов отключаем, иначе одинаковые промпты не доходят до модели
+    response_cache.enabled = False
+    llm_client.llm_governor = LLMGovernor(
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.rpm,
+        burst=args.burst,
+        backoff_base=args.backoff_base,
+    )
+
+    scenario = SCENARIOS[args.scenario]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, errors = [], 0
+
+    async def one(index: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await scenario(index)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "errors": errors,
+        "model_calls": backend.get_stats()["calls"],
+        "governor": llm_client.llm_governor.get_stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест LLM-путей на локальном fake-бэкенде")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="chat")
+    parser.add_argument("--requests", type=int, default=100, help="Всего запросов")
+    parser.add_argument("--concurrency", type=int, default=20, help="Одновременных запросов")
+    parser.add_argument("--latency", default="lognormal:0.8,0.5", help="Распределение задержки модели (см. FAKE_LLM_LATENCY)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля вызовов модели с ошибкой 429/503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-concurrency", type=int, default=8, help="LLM_MAX_CONCURRENCY governor")
+    parser.add_argument("--rpm", type=float, default=600, help="LLM_REQUESTS_PER_MINUTE governor")
+    parser.add_argument("--burst", type=int, default=20, help="LLM_BURST governor")
+    parser.add_argument("--backoff-base", type=float, default=0.2, help="LLM_BACKOFF_BASE_SECONDS governor")
+    args = parser.parse_args()
+
+    stats = asyncio.run(_run(args))
+    latencies = stats["latencies"]
+    governor = stats["governor"]
+    print(
+        f"{args.scenario}: {args.requests} запросов за {stats['elapsed']:.2f} с "
+        f"({len(latencies) / stats['elapsed']:.1f} успешных/с), ошибок: {stats['errors']}, вызовов модели: {stats['model_calls']}"
+    )
+    print(
+        f"задержка p50 {_percentile(latencies, 0.5):.2f} с, p95 {_percentile(latencies, 0.95):.2f} с, "
+        f"p99 {_percentile(latencies, 0.99):.2f} с, max {max(latencies, default=0):.2f} с"
+    )
+    print(
+        f"governor: ожидание p95 {governor['p95_wait_seconds']:.2f} с, повторов {governor['retries']}, "
+        f"429/503 {governor['rate_limited']}, макс. очередь {governor['max_queue_depth']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
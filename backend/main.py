@@ -19,8 +19,14 @@ from app.youtube_parser.router import router as youtube_parser_router
 
 # Импортируем новую функцию инициализации и зависимости
 from app.dependencies import initialize_firestore_on_startup, get_db
+from app.db import close_sql_engine # Пул соединений асинхронного SQL-движка
+from app.db.schema_upgrade import upgrade_schema_on_startup # Обновление схемы SQL-базы (опционально при старте)
+from app.core.llm_context import LLMDeadlineExceeded # Дедлайн вызовов модели (504)
+from app.core.api_setup import get_llm_backend # Бэкенд LLM (Gemini или fake для нагрузочных тестов)
 from app.services.firebase_auth import get_current_user # Импортируем зависимость пользователя
 from app.services import firebase_service # Импортируем сервис
+from app.services.usage_ledger import usage_ledger # Учет расхода токенов LLM (пакетный сброс в Firestore)
+from app.services.chat_jobs import chat_jobs # Фоновые ходы чата (режим mode=job)
 from typing import Dict, Any # Импортируем типы
 # Убираем импорт Body, если он больше не нужен напрямую в main.py
 
@@ -76,6 +82,14 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content={"detail": exc.errors()},
     )
 
+@app.exception_handler(LLMDeadlineExceeded)
+async def llm_deadline_exception_handler(request: Request, exc: LLMDeadlineExceeded):
+    logger.error(f"LLM deadline exceeded: {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        content={"detail": "Модель не ответила за отведенное время, попробуйте еще раз"},
+    )
+
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
     logger.exception(f"Unhandled Exception: {exc}", exc_info=True)
@@ -157,6 +171,25 @@ async def startup_event():
         # Логгируем ошибку, но не останавливаем запуск
         logger.critical(f"***** КРИТИЧЕСКАЯ ОШИБКА во время startup_event при вызове initialize_firestore_on_startup: {e} *****", exc_info=True)
         # get_db вернет 503 при запросах
+    # Прогреваем бэкенд LLM (реестр моделей Gemini), чтобы первый запрос не создавал клиента
+    try:
+        get_llm_backend().warm()
+    except Exception as e:
+        logger.error(f"Ошибка прогрева моделей Gemini при старте: {e}", exc_info=True)
+    # Новые таблицы, столбцы и индексы SQL-базы (по SQL_SCHEMA_UPGRADE_ON_STARTUP, см. app/db/schema_upgrade.py)
+    await upgrade_schema_on_startup()
+    # Периодический сброс агрегированного учета расхода LLM в Firestore
+    usage_ledger.start(get_db)
+    # Воркеры фоновых ходов чата
+    chat_jobs.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Записываем накопленный, но еще не сброшенный учет расхода LLM
+    await usage_ledger.stop()
+    await chat_jobs.stop()
+    await close_sql_engine()
 
 # --- Точка входа для Uvicorn ---
 if __name__ == "__main__":
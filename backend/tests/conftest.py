@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.db import Base
+from app.db.models import Project, User
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """Фабрика AsyncSession для временной базы SQLite со схемой приложения и проектом 1"""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    factory = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    async def prepare():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        async with factory() as db:
+            db.add(User(id=1, email="expert@example.com", username="expert", hashed_password=""))
+            db.add(Project(id=1, name="Проект", owner_id=1, briefing_data={}))
+            await db.commit()
+
+    asyncio.run(prepare())
+    yield factory
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def fake_backend():
+    """Подменяет бэкенд LLM на FakeLLMBackend (без сети); тест задает задержку через latency_spec"""
+    from app.core import api_setup
+    from app.core.llm_backends import FakeLLMBackend
+
+    previous = api_setup._llm_backend
+    backend = FakeLLMBackend(latency="0")
+    api_setup.set_llm_backend(backend)
+    yield backend
+    api_setup._llm_backend = previous
+
+
+@pytest.fixture
+def chat_client(session_factory):
+    """TestClient с роутером чата: база - session_factory, пользователь - владелец проекта 1"""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from app.api.endpoints import chat
+    from app.db import get_sql_db
+    from app.services import auth
+
+    async def override_db():
+        async with session_factory() as db:
+            yield db
+
+    app = FastAPI()
+    app.include_router(chat.router, prefix="/chat")
+    app.dependency_overrides[get_sql_db] = override_db
+    app.dependency_overrides[auth.get_current_user] = lambda: User(id=1, email="expert@example.com", username="expert")
+    with TestClient(app) as client:
+        yield client
@@ -0,0 +1,98 @@
+import pytest
+
+from app.services.briefing_merge import apply_briefing_delta
+
+CURRENT = {
+    "utp": "Быстрый запуск воронки",
+    "product_description": "Онлайн-курс по маркетингу",
+    "funnel_elements": [
+        {"name": "Бесплатный вебинар", "description": "Знакомство с автором"},
+        {"name": "Трипваер", "description": "Мини-курс за 490 рублей"},
+        {"name": "Основной продукт", "description": "Курс на 8 недель"},
+    ],
+}
+
+
+def _names(result):
+    return [stage["name"] for stage in result["funnel_elements"]]
+
+
+@pytest.mark.parametrize("incoming_name", [
+    "Вебинар (бесплатный)",
+    "бесплатный вебинар!",
+    "Бесплатный  Вебинар",
+    "Бесплатный вебинaр",
+])
+def test_near_duplicate_stage_is_merged_into_existing(incoming_name):
+    delta = {"funnel_elements": [{"name": incoming_name, "description": "Запись доступна сутки"}]}
+
+    result = apply_briefing_delta(CURRENT, delta)
+
+    assert _names(result) == ["Бесплатный вебинар", "Трипваер", "Основной продукт"]
+    assert result["funnel_elements"][0]["description"] == "Знакомство с автором Запись доступна сутки"
+
+
+@pytest.mark.parametrize("delta", [
+    {},
+    {"utp": "", "product_description": "", "funnel_elements": []},
+    {"utp": "   ", "product_description": None, "funnel_elements": None},
+    {"funnel_elements": [{"name": "", "description": "без названия"}]},
+])
+def test_empty_delta_keeps_current_briefing(delta):
+    assert apply_briefing_delta(CURRENT, delta) == CURRENT
+
+
+@pytest.mark.parametrize("delta, expected_utp, expected_description", [
+    # Пустое значение - без изменений
+    ({"utp": "", "product_description": "Курс с наставником"}, "Быстрый запуск воронки", "Курс с наставником"),
+    ({"utp": "Запуск за неделю", "product_description": ""}, "Запуск за неделю", "Онлайн-курс по маркетингу"),
+    ({"utp": None}, "Быстрый запуск воронки", "Онлайн-курс по маркетингу"),
+    ({"utp": "  Запуск за неделю  "}, "Запуск за неделю", "Онлайн-курс по маркетингу"),
+])
+def test_text_fields_are_not_erased(delta, expected_utp, expected_description):
+    result = apply_briefing_delta(CURRENT, delta)
+
+    assert result["utp"] == expected_utp
+    assert result["product_description"] == expected_description
+
+
+@pytest.mark.parametrize("current_description, incoming_description, expected", [
+    ("Знакомство с автором", "", "Знакомство с автором"),
+    ("Знакомство с автором", "знакомство с автором", "Знакомство с автором"),
+    ("Знакомство с автором", "Знакомство с автором и разбор кейсов", "Знакомство с автором и разбор кейсов"),
+    ("", "Разбор кейсов", "Разбор кейсов"),
+])
+def test_stage_description_is_not_erased(current_description, incoming_description, expected):
+    current = {"funnel_elements": [{"name": "Вебинар", "description": current_description}]}
+    delta = {"funnel_elements": [{"name": "Вебинар", "description": incoming_description}]}
+
+    assert apply_briefing_delta(current, delta)["funnel_elements"] == [{"name": "Вебинар", "description": expected}]
+
+
+def test_new_stage_is_inserted_after_preceding_stage():
+    delta = {"funnel_elements": [
+        {"name": "Трипваер", "description": ""},
+        {"name": "Консультация", "description": "Созвон 30 минут"},
+    ]}
+
+    result = apply_briefing_delta(CURRENT, delta)
+
+    assert _names(result) == ["Бесплатный вебинар", "Трипваер", "Консультация", "Основной продукт"]
+
+
+def test_delta_for_empty_briefing():
+    delta = {"utp": "УТП", "funnel_elements": [{"name": "Лид-магнит", "description": "Чек-лист"}]}
+
+    assert apply_briefing_delta(None, delta) == {
+        "utp": "УТП",
+        "product_description": "",
+        "funnel_elements": [{"name": "Лид-магнит", "description": "Чек-лист"}],
+    }
+
+
+def test_current_data_is_not_mutated():
+    before = {"funnel_elements": [dict(stage) for stage in CURRENT["funnel_elements"]], "utp": CURRENT["utp"]}
+    apply_briefing_delta(CURRENT, {"utp": "Другое", "funnel_elements": [{"name": "Трипваер", "description": "Скидка"}]})
+
+    assert CURRENT["funnel_elements"] == before["funnel_elements"]
+    assert CURRENT["utp"] == before["utp"]
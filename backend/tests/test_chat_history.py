@@ -0,0 +1,121 @@
+import asyncio
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.db.models import ChatMessage
+from app.services.chat_history import InvalidCursorError, decode_cursor, encode_cursor, load_messages_page
+
+START = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def _seed(session_factory, times, first=0):
+    """Сообщения проекта 1 с заданными created_at (в порядке id)"""
+    async def seed():
+        async with session_factory() as db:
+            db.add_all([
+                ChatMessage(project_id=1, role="user", content=f"сообщение {index}", created_at=created_at)
+                for index, created_at in enumerate(times, start=first)
+            ])
+            await db.commit()
+
+    asyncio.run(seed())
+
+
+def _page(session_factory, **kwargs):
+    async def load():
+        async with session_factory() as db:
+            page = await load_messages_page(db, 1, **kwargs)
+            page["messages"] = [message.content for message in page["messages"]]
+            return page
+
+    return asyncio.run(load())
+
+
+def test_cursor_round_trip():
+    message = ChatMessage(id=42, created_at=START)
+
+    assert decode_cursor(encode_cursor(message)) == (START, 42)
+
+
+@pytest.mark.parametrize("cursor", [
+    "не-base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(b'{"c": "2026-01-01T12:00:00"}').decode(),
+    base64.urlsafe_b64encode(b'{"c": "yesterday", "i": 1}').decode(),
+    base64.urlsafe_b64encode(b'[1, 2]').decode(),
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(InvalidCursorError):
+        decode_cursor(cursor)
+
+
+def test_tail_then_before_pages_cover_history_in_order(session_factory):
+    _seed(session_factory, [START + timedelta(seconds=index) for index in range(7)])
+
+    tail = _page(session_factory, limit=3)
+    assert tail["messages"] == ["сообщение 4", "сообщение 5", "сообщение 6"]
+    assert tail["newer_cursor"] is not None
+
+    older = _page(session_factory, limit=3, before=tail["older_cursor"])
+    assert older["messages"] == ["сообщение 1", "сообщение 2", "сообщение 3"]
+    assert older["newer_cursor"] is None
+
+    oldest = _page(session_factory, limit=3, before=older["older_cursor"])
+    assert oldest["messages"] == ["сообщение 0"]
+    assert oldest["older_cursor"] is None
+
+
+def test_pages_split_messages_with_equal_created_at(session_factory):
+    # Все сообщения сохранены в одну секунду: порядок и границы страниц задает id
+    _seed(session_factory, [START] * 5)
+
+    tail = _page(session_factory, limit=2)
+    older = _page(session_factory, limit=2, before=tail["older_cursor"])
+    oldest = _page(session_factory, limit=2, before=older["older_cursor"])
+
+    assert oldest["messages"] + older["messages"] + tail["messages"] == [f"сообщение {index}" for index in range(5)]
+    assert oldest["older_cursor"] is None
+
+
+def test_since_returns_new_messages_in_batches(session_factory):
+    _seed(session_factory, [START] * 2)
+    tail = _page(session_factory, limit=10)
+    _seed(session_factory, [START, START + timedelta(seconds=1), START + timedelta(seconds=2)], first=2)
+
+    first = _page(session_factory, limit=2, since=tail["newer_cursor"])
+    assert first["messages"] == ["сообщение 2", "сообщение 3"]
+    assert first["has_more"] is True
+
+    second = _page(session_factory, limit=2, since=first["newer_cursor"])
+    assert second["messages"] == ["сообщение 4"]
+    assert second["has_more"] is False
+
+    empty = _page(session_factory, limit=2, since=second["newer_cursor"])
+    assert empty["messages"] == []
+    assert empty["newer_cursor"] == second["newer_cursor"]
+
+
+def test_before_and_since_together_are_rejected(session_factory):
+    cursor = encode_cursor(ChatMessage(id=1, created_at=START))
+
+    with pytest.raises(InvalidCursorError):
+        _page(session_factory, before=cursor, since=cursor)
+
+
+def test_malformed_cursor_returns_400(chat_client):
+    response = chat_client.get("/chat/1/messages", params={"before": "не-курсор"})
+
+    assert response.status_code == 400
+
+
+def test_history_endpoint_returns_cursors(session_factory, chat_client):
+    _seed(session_factory, [START + timedelta(seconds=index) for index in range(3)])
+
+    response = chat_client.get("/chat/1/messages", params={"limit": 2})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [message["content"] for message in body["messages"]] == ["сообщение 1", "сообщение 2"]
+    assert chat_client.get("/chat/1/messages", params={"before": body["older_cursor"]}).json()["messages"][0]["content"] == "сообщение 0"
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+import pytest
+
+from app.services.chat_jobs import ChatJobManager, ChatJobQueueFull
+
+
+def _turn(log, name, seconds=0.02):
+    async def run():
+        log.append((name, "start"))
+        await asyncio.sleep(seconds)
+        log.append((name, "end"))
+        return {"turn": name}
+
+    return run
+
+
+async def _wait_finished(jobs, timeout=2.0):
+    started = time.monotonic()
+    while any(job.status not in ("succeeded", "failed") for job in jobs):
+        assert time.monotonic() - started < timeout, "задачи не завершились"
+        await asyncio.sleep(0.01)
+
+
+def test_turns_of_one_project_run_in_order():
+    log = []
+
+    async def run():
+        manager = ChatJobManager(workers=3, queue_size=10)
+        jobs = [manager.submit(1, "message", _turn(log, f"p1-{index}")) for index in range(3)]
+        jobs.append(manager.submit(2, "message", _turn(log, "p2")))
+        await _wait_finished(jobs)
+        await manager.stop()
+        return jobs
+
+    jobs = asyncio.run(run())
+    assert [entry for entry in log if entry[0].startswith("p1")] == [
+        ("p1-0", "start"), ("p1-0", "end"),
+        ("p1-1", "start"), ("p1-1", "end"),
+        ("p1-2", "start"), ("p1-2", "end"),
+    ]
+    # Второй проект не ждет всей очереди первого
+    assert log.index(("p2", "start")) < log.index(("p1-1", "start"))
+    assert [job.result for job in jobs] == [{"turn": "p1-0"}, {"turn": "p1-1"}, {"turn": "p1-2"}, {"turn": "p2"}]
+
+
+def test_submit_rejects_when_queue_is_full():
+    log = []
+
+    async def run():
+        manager = ChatJobManager(workers=1, queue_size=2)
+        # Ходы в очереди проекта тоже считаются ожидающими
+        jobs = [manager.submit(1, "message", _turn(log, "first")), manager.submit(1, "message", _turn(log, "second"))]
+        with pytest.raises(ChatJobQueueFull):
+            manager.submit(2, "message", _turn(log, "rejected"))
+        await _wait_finished(jobs)
+        # После выполнения место в очереди освобождается
+        jobs.append(manager.submit(2, "message", _turn(log, "accepted")))
+        await _wait_finished(jobs)
+        stats = manager.get_stats()
+        await manager.stop()
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats["rejected"] == 1
+    assert stats["succeeded"] == 3
+    assert stats["queued"] == 0
+    assert stats["projects"] == 0
+    assert ("rejected", "start") not in log
+
+
+def test_finished_jobs_are_evicted_after_ttl():
+    async def run():
+        manager = ChatJobManager(workers=1, queue_size=10, ttl_seconds=0.05)
+        job = manager.submit(1, "message", _turn([], "old", 0))
+        await _wait_finished([job])
+        assert manager.get_job(job.id) is job
+        await asyncio.sleep(0.1)
+        fresh = manager.submit(1, "message", _turn([], "fresh", 0))
+        await _wait_finished([fresh])
+        await manager.stop()
+        return manager, job, fresh
+
+    manager, job, fresh = asyncio.run(run())
+    assert manager.get_job(job.id) is None
+    assert manager.get_job(fresh.id) is fresh
+
+
+def test_status_events_fan_out_to_project_subscribers():
+    async def run():
+        manager = ChatJobManager(workers=1, queue_size=10)
+        async with manager.subscribe(1) as first, manager.subscribe(1) as second, manager.subscribe(2) as other:
+            job = manager.submit(1, "message", _turn([], "turn"))
+            await _wait_finished([job])
+            events = [[events.get_nowait()["status"] for _ in range(events.qsize())] for events in (first, second, other)]
+            assert manager.get_stats()["subscribers"] == 3
+        stats = manager.get_stats()
+        await manager.stop()
+        return events, stats
+
+    (first, second, other), stats = asyncio.run(run())
+    assert first == second == ["queued", "running", "succeeded"]
+    assert other == []
+    assert stats["subscribers"] == 0
+
+
+def test_stop_fails_queued_and_running_jobs():
+    async def run():
+        manager = ChatJobManager(workers=1, queue_size=10)
+        async with manager.subscribe(1) as events:
+            jobs = [manager.submit(1, "message", _turn([], f"turn-{index}", 10)) for index in range(2)]
+            jobs.append(manager.submit(2, "message", _turn([], "other", 10)))
+            await asyncio.sleep(0.02)
+            await manager.stop()
+            statuses = [events.get_nowait()["status"] for _ in range(events.qsize())]
+        return manager, jobs, statuses
+
+    manager, jobs, statuses = asyncio.run(run())
+    assert [job.status for job in jobs] == ["failed", "failed", "failed"]
+    assert all(job.finished_at is not None for job in jobs)
+    assert statuses.count("failed") == 2
+    stats = manager.get_stats()
+    assert stats["failed"] == 3
+    assert stats["queued"] == 0
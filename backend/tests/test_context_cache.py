@@ -0,0 +1,74 @@
+import pytest
+
+from app.core import api_setup
+
+MODEL = "models/gemini-2.5-flash"
+INSTRUCTION = "Статическая инструкция"
+
+
+@pytest.fixture
+def context_cache(monkeypatch):
+    """Чистый реестр context cache, управляемые часы и CachedContent.create с заданными исходами"""
+    clock = [1000.0]
+    outcomes = []
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(api_setup, "_context_caches", {})
+    monkeypatch.setattr(api_setup, "_context_cache_stats", {"created": 0, "failed": 0, "expired": 0})
+    monkeypatch.setattr(api_setup, "GEMINI_CONTEXT_CACHE_RETRY_SECONDS", 60.0)
+    monkeypatch.setattr(api_setup.time, "time", lambda: clock[0])
+    monkeypatch.setattr(api_setup.genai.caching.CachedContent, "create", create)
+    return clock, outcomes, calls
+
+
+def test_failed_cache_is_retried_after_backoff(context_cache):
+    clock, outcomes, calls = context_cache
+    outcomes.extend([RuntimeError("503"), "cache"])
+
+    assert api_setup._get_cached_content(MODEL, INSTRUCTION) is None
+    # До истечения паузы повторной попытки нет
+    clock[0] += 30
+    assert api_setup._get_cached_content(MODEL, INSTRUCTION) is None
+    assert len(calls) == 1
+
+    clock[0] += 31
+    assert api_setup._get_cached_content(MODEL, INSTRUCTION) == "cache"
+    assert len(calls) == 2
+    stats = api_setup.get_context_cache_stats()
+    assert (stats["failed"], stats["created"], stats["active"], stats["retry_pending"]) == (1, 1, 1, 0)
+
+
+def test_retry_backoff_doubles_on_consecutive_failures(context_cache):
+    clock, outcomes, calls = context_cache
+    outcomes.extend([RuntimeError("too short")] * 3)
+
+    api_setup._get_cached_content(MODEL, INSTRUCTION)
+    clock[0] += 61
+    api_setup._get_cached_content(MODEL, INSTRUCTION)
+    # Вторая неудача подряд - пауза 120 с
+    clock[0] += 61
+    api_setup._get_cached_content(MODEL, INSTRUCTION)
+    assert len(calls) == 2
+    clock[0] += 60
+    api_setup._get_cached_content(MODEL, INSTRUCTION)
+    assert len(calls) == 3
+    assert api_setup.get_context_cache_stats()["retry_pending"] == 1
+
+
+def test_created_cache_is_reused_until_expiry(context_cache):
+    clock, outcomes, calls = context_cache
+    outcomes.extend(["first", "second"])
+
+    assert api_setup._get_cached_content(MODEL, INSTRUCTION) == "first"
+    assert api_setup._get_cached_content(MODEL, INSTRUCTION) == "first"
+    clock[0] += api_setup.GEMINI_CONTEXT_CACHE_TTL_SECONDS
+    assert api_setup._get_cached_content(MODEL, INSTRUCTION) == "second"
+    assert len(calls) == 2
+    assert api_setup.get_context_cache_stats()["expired"] == 1
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from app.services import conversation_memory
+
+
+@pytest.fixture
+def summary_updates(monkeypatch):
+    """Обновление саммари без БД и модели: журнал начала и конца обновлений по проектам"""
+    log = []
+
+    async def update(project_id):
+        log.append((project_id, "start"))
+        await asyncio.sleep(0.01)
+        log.append((project_id, "end"))
+        return f"саммари {project_id}"
+
+    monkeypatch.setattr(conversation_memory, "_update_conversation_summary_locked", update)
+    return log
+
+
+def test_updates_of_one_project_are_serialized(summary_updates):
+    async def run():
+        return await asyncio.gather(*(conversation_memory.update_conversation_summary(1) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["саммари 1"] * 3
+    assert summary_updates == [(1, "start"), (1, "end")] * 3
+
+
+def test_locks_are_released_after_updates(summary_updates):
+    async def run():
+        await asyncio.gather(*(conversation_memory.update_conversation_summary(project_id) for project_id in range(50)))
+        await conversation_memory.update_conversation_summary(1)
+
+    asyncio.run(run())
+    assert conversation_memory._summary_locks == {}
+    assert conversation_memory._summary_lock_users == {}
+
+
+def test_lock_is_released_when_update_fails(monkeypatch):
+    async def failing(project_id):
+        raise RuntimeError("ошибка БД")
+
+    monkeypatch.setattr(conversation_memory, "_update_conversation_summary_locked", failing)
+    with pytest.raises(RuntimeError):
+        asyncio.run(conversation_memory.update_conversation_summary(7))
+    assert conversation_memory._summary_locks == {}
@@ -0,0 +1,49 @@
+import asyncio
+
+from app.services import gemini
+
+CURRENT = {
+    "utp": "Курсы Python с наставником",
+    "product_description": "Онлайн-школа программирования для начинающих.",
+    "funnel_elements": [{"name": "Бесплатный вебинар", "description": "Знакомство со школой"}],
+}
+
+
+def _analyze(monkeypatch, partials, current_data=CURRENT):
+    async def extract(chunk, chunk_number, chunk_count, use_cache=True):
+        return partials[chunk_number - 1]
+
+    monkeypatch.setattr(gemini, "_extract_document_chunk", extract)
+    return asyncio.run(gemini._analyze_document_chunks(["первый", "второй"], current_data))
+
+
+def test_existing_text_fields_survive_multi_chunk_document(monkeypatch):
+    result = _analyze(monkeypatch, [
+        {"utp": "Практика на реальных проектах", "product_description": "Курс длится 3 месяца.", "funnel_elements": []},
+        {"utp": "", "product_description": "Есть тариф с ревью кода.", "funnel_elements": [{"name": "Вебинар (бесплатный)", "description": ""}]},
+    ])
+
+    assert CURRENT["utp"] in result["utp"]
+    assert "Практика на реальных проектах" in result["utp"]
+    assert CURRENT["product_description"] in result["product_description"]
+    assert "Курс длится 3 месяца." in result["product_description"]
+    assert "Есть тариф с ревью кода." in result["product_description"]
+    assert [stage["name"] for stage in result["funnel_elements"]] == ["Бесплатный вебинар"]
+
+
+def test_empty_chunks_keep_current_data(monkeypatch):
+    empty = {"utp": "", "product_description": "", "funnel_elements": []}
+    result = _analyze(monkeypatch, [empty, empty])
+
+    assert result["utp"] == CURRENT["utp"]
+    assert result["product_description"] == CURRENT["product_description"]
+
+
+def test_document_without_current_data(monkeypatch):
+    result = _analyze(monkeypatch, [
+        {"utp": "Практика на реальных проектах", "product_description": "Курс длится 3 месяца.", "funnel_elements": []},
+        {"utp": "", "product_description": "", "funnel_elements": []},
+    ], current_data=None)
+
+    assert result["utp"] == "Практика на реальных проектах"
+    assert result["product_description"] == "Курс длится 3 месяца."
@@ -0,0 +1,65 @@
+import asyncio
+import sqlite3
+
+from app.services import llm_cache
+from app.services.llm_cache import LLMResponseCache
+
+
+def _table_bytes(path) -> int:
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+
+def test_disk_size_counter_tracks_writes_replacements_and_deletes(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = LLMResponseCache(db_path=str(path), max_disk_bytes=10_000, enabled=True)
+
+    async def run():
+        await cache.set("a", "x" * 100)
+        await cache.set("b", "я" * 100)
+        await cache.set("a", "x" * 50)
+        await cache.delete("b")
+
+    asyncio.run(run())
+    assert cache.get_stats()["disk_bytes"] == 50 == _table_bytes(path)
+
+
+def test_least_recently_used_entries_are_evicted_over_limit(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = LLMResponseCache(db_path=str(path), max_disk_bytes=250, enabled=True)
+
+    async def run():
+        for key in ("a", "b", "c"):
+            await cache.set(key, key * 100)
+        cache.clear_memory()
+        return [await cache.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == [None, "b" * 100, "c" * 100]
+    stats = cache.get_stats()
+    assert stats["disk_evictions"] == 1
+    assert stats["disk_bytes"] == 200 == _table_bytes(path)
+
+
+def test_size_is_recounted_from_table_periodically(tmp_path, monkeypatch):
+    path = tmp_path / "cache.db"
+    cache = LLMResponseCache(db_path=str(path), max_disk_bytes=10_000, enabled=True)
+    asyncio.run(cache.set("a", "x" * 100))
+    # Запись другого воркера, о которой счетчик процесса не знает
+    with sqlite3.connect(path) as db:
+        db.execute("INSERT INTO llm_cache VALUES ('other', ?, 9e18, 0, 300)", ("y" * 300,))
+
+    asyncio.run(cache.set("b", "x" * 10))
+    assert cache.get_stats()["disk_bytes"] == 110
+
+    monkeypatch.setattr(llm_cache, "_DISK_MAINTENANCE_SECONDS", 0)
+    asyncio.run(cache.set("c", "x" * 10))
+    assert cache.get_stats()["disk_bytes"] == 420 == _table_bytes(path)
+
+
+def test_existing_cache_file_size_is_counted_on_open(tmp_path):
+    path = tmp_path / "cache.db"
+    asyncio.run(LLMResponseCache(db_path=str(path), enabled=True).set("a", "x" * 100))
+
+    reopened = LLMResponseCache(db_path=str(path), enabled=True)
+    assert asyncio.run(reopened.get("a")) == "x" * 100
+    assert reopened.get_stats()["disk_bytes"] == 100
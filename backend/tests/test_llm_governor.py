@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+
+from app.core.llm_backends import FakeLLMError, parse_latency_spec
+from app.services.llm_governor import LLMGovernor, LLMOverloadedError
+
+MODEL = "gemini-test"
+
+
+def _use_latency(backend, spec: str):
+    backend.latency_spec = spec
+    backend._latency = parse_latency_spec(spec)
+
+
+def _governor(**kwargs) -> LLMGovernor:
+    options = {"max_concurrency": 1, "requests_per_minute": 60000, "burst": 100, "queue_timeout": 10}
+    options.update(kwargs)
+    return LLMGovernor(**options)
+
+
+def test_waiters_are_admitted_round_robin_by_key(fake_backend):
+    _use_latency(fake_backend, "0.01")
+    governor = _governor()
+    admitted = []
+
+    async def call(key: str):
+        async def model_call():
+            admitted.append(key)
+            return await fake_backend.generate(MODEL, key)
+
+        return await governor.run(model_call, key=key)
+
+    async def run():
+        # Пачка вызовов пользователя a встает в очередь раньше единственного вызова b
+        first = asyncio.ensure_future(call("a"))
+        await asyncio.sleep(0)
+        queued = [asyncio.ensure_future(call(key)) for key in ("a", "a", "a", "b")]
+        await asyncio.gather(first, *queued)
+
+    asyncio.run(run())
+    assert admitted == ["a", "a", "b", "a", "a"]
+    assert governor.get_stats()["admitted"] == 5
+
+
+def test_queue_timeout_raises_overloaded(fake_backend):
+    _use_latency(fake_backend, "0.3")
+    governor = _governor(queue_timeout=0.05)
+
+    async def run():
+        slow = asyncio.ensure_future(governor.run(lambda: fake_backend.generate(MODEL, "долгий")))
+        await asyncio.sleep(0)
+        with pytest.raises(LLMOverloadedError):
+            await governor.run(lambda: fake_backend.generate(MODEL, "ждет"), key="other")
+        await slow
+
+    asyncio.run(run())
+    stats = governor.get_stats()
+    assert stats["queue_timeouts"] == 1
+    assert stats["queue_depth"] == 0
+    assert stats["in_flight"] == 0
+
+
+def test_rate_limit_pauses_all_callers_for_backoff(fake_backend):
+    _use_latency(fake_backend, "0")
+    governor = _governor(max_concurrency=4, backoff_base=0.2, backoff_max=0.2)
+    events = {}
+    failed = []
+
+    async def rate_limited_once():
+        if not failed:
+            failed.append(time.monotonic())
+            raise FakeLLMError(429)
+        return await fake_backend.generate(MODEL, "повтор")
+
+    async def other_call():
+        events["other_started"] = time.monotonic()
+        return await fake_backend.generate(MODEL, "другой")
+
+    async def run():
+        first = asyncio.ensure_future(governor.run(rate_limited_once, key="a"))
+        await asyncio.sleep(0.01)
+        # Свободные слоты есть, но bucket приостановлен на время backoff после 429
+        await governor.run(other_call, key="b")
+        await first
+
+    asyncio.run(run())
+    # Задержка backoff - случайная в [base/2, base]
+    assert events["other_started"] - failed[0] >= 0.1 - 0.01
+    stats = governor.get_stats()
+    assert stats["retries"] == 1
+    assert stats["rate_limited"] == 1
+
+
+def test_non_retryable_error_is_not_retried(fake_backend):
+    governor = _governor()
+    calls = []
+
+    async def broken():
+        calls.append(1)
+        raise ValueError("плохой запрос")
+
+    with pytest.raises(ValueError):
+        asyncio.run(governor.run(broken))
+    assert len(calls) == 1
+    assert governor.get_stats()["in_flight"] == 0
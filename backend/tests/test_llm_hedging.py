@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from app.core.llm_backends import parse_latency_spec
+from app.services import llm_client
+from app.services.llm_governor import LLMGovernor
+from app.services.llm_hedging import HedgePolicy
+
+MODEL = "gemini-test"
+
+
+def _use_latency(backend, spec: str):
+    backend.latency_spec = spec
+    backend._latency = parse_latency_spec(spec)
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    """Hedging с известным p95 модели (0.1 с) и отдельный governor с одним слотом"""
+    policy = HedgePolicy(enabled=True, min_delay=0.01, max_ratio=1.0, min_samples=1)
+    for _ in range(20):
+        policy.observe(MODEL, 0.1)
+    governor = LLMGovernor(max_concurrency=1, requests_per_minute=60000, burst=100, queue_timeout=10)
+    monkeypatch.setattr(llm_client, "llm_hedging", policy)
+    monkeypatch.setattr(llm_client, "llm_governor", governor)
+    return policy, governor
+
+
+def _generate(count: int):
+    async def run():
+        return await asyncio.gather(*(
+            llm_client.generate_text(f"вопрос {i}", model_name=MODEL, use_cache=False) for i in range(count)
+        ))
+
+    return asyncio.run(run())
+
+
+def test_calls_slowed_by_queue_are_not_hedged(fake_backend, hedging):
+    policy, governor = hedging
+    # Каждый вызов модели быстрее p95, но с одним слотом последние ждут в очереди дольше p95
+    _use_latency(fake_backend, "0.05")
+
+    assert len(_generate(5)) == 5
+    assert governor.get_stats()["max_wait_seconds"] > 0.1
+    assert policy.get_stats()["hedged"] == 0
+
+
+def test_slow_model_call_is_hedged(fake_backend, hedging):
+    policy, governor = hedging
+    governor.max_concurrency = 2
+    _use_latency(fake_backend, "0.3")
+
+    _generate(1)
+    assert policy.get_stats()["hedged"] == 1
+
+
+def test_hedge_waits_for_admission_after_backoff(monkeypatch, fake_backend, hedging):
+    policy, governor = hedging
+    governor.backoff_base = 0.2
+    governor.backoff_max = 0.2
+    _use_latency(fake_backend, "0.02")
+    # Первая попытка - 429, затем пауза backoff (дольше p95) и быстрый повтор
+    fake_backend.error_rate = 1.0
+    fake_backend.error_codes = [429]
+    original = fake_backend._maybe_fail
+
+    def fail_once():
+        try:
+            original()
+        finally:
+            fake_backend.error_rate = 0.0
+
+    monkeypatch.setattr(fake_backend, "_maybe_fail", fail_once)
+
+    _generate(1)
+    assert governor.get_stats()["retries"] == 1
+    assert policy.get_stats()["hedged"] == 0
@@ -0,0 +1,53 @@
+import pytest
+
+from app.core import api_setup
+from app.services import prompt_budget
+from app.services.prompt_budget import PromptAssembler, get_model_token_budget, get_task_token_budget
+
+FAST = "models/gemini-2.0-flash-001"
+HEAVY = "models/gemini-2.5-flash"
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    monkeypatch.setattr(prompt_budget, "PROMPT_TOKEN_BUDGET", 0)
+    table = {
+        "fast_only": dict(api_setup._ROUTE_DEFAULTS, model=FAST, heavy_above_tokens=0),
+        "with_heavy": dict(api_setup._ROUTE_DEFAULTS, model=FAST, heavy_model=HEAVY, heavy_above_tokens=12000),
+        "heavy_base": dict(api_setup._ROUTE_DEFAULTS, model=HEAVY, heavy_above_tokens=0),
+        # Порог heavy выше бюджета базовой модели: промпт в рамках бюджета на heavy не уходит
+        "late_heavy": dict(api_setup._ROUTE_DEFAULTS, model=FAST, heavy_model=HEAVY, heavy_above_tokens=50000),
+    }
+    monkeypatch.setattr(api_setup, "_model_routes", table)
+
+
+@pytest.mark.parametrize("task, expected_model", [
+    ("fast_only", FAST),
+    ("with_heavy", HEAVY),
+    ("heavy_base", HEAVY),
+    ("late_heavy", FAST),
+])
+def test_task_budget_follows_routed_model(routes, task, expected_model):
+    assert get_task_token_budget(task) == get_model_token_budget(expected_model)
+    assert PromptAssembler("prompt", "{text}", task=task).budget == get_model_token_budget(expected_model)
+
+
+def test_explicit_model_overrides_route(routes):
+    assembler = PromptAssembler("prompt", "{text}", model_name=FAST, task="heavy_base")
+
+    assert assembler.budget == get_model_token_budget(FAST)
+    assert assembler.model_name == FAST
+
+
+def test_default_model_budget_without_task(routes):
+    assert PromptAssembler("prompt", "{text}").budget == get_model_token_budget(api_setup.DEFAULT_GEMINI_MODEL)
+
+
+@pytest.mark.parametrize("words, expected_model", [(10, FAST), (20000, HEAVY)])
+def test_report_shows_model_chosen_for_prompt_size(routes, words, expected_model):
+    assembler = PromptAssembler("prompt", "{text}", task="with_heavy")
+    assembler.add("text", "word " * words)
+    assembler.build()
+
+    assert assembler.report["model"] == expected_model
+    assert assembler.report["truncated"] is False
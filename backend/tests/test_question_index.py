@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+
+from app.db.models import AskedQuestion, ChatMessage
+from app.services import question_index
+from app.services.question_index import get_question_index, record_asked_questions
+
+
+@pytest.fixture(autouse=True)
+def clear_indexes():
+    question_index._indexes.clear()
+    yield
+    question_index._indexes.clear()
+
+
+def _run(session_factory, scenario):
+    async def main():
+        async with session_factory() as db:
+            return await scenario(db)
+    return asyncio.run(main())
+
+
+async def _count(db, model):
+    return await db.scalar(select(func.count()).select_from(model))
+
+
+def test_rolled_back_questions_do_not_reach_index(session_factory):
+    async def scenario(db):
+        assert await record_asked_questions(db, 1, "Сколько стоит курс?\nКто ваша аудитория?")
+        await db.rollback()
+        return (await get_question_index(db, 1)).recent()
+
+    assert _run(session_factory, scenario) == []
+
+
+def test_backfill_keeps_callers_pending_changes(session_factory):
+    async def scenario(db):
+        db.add(ChatMessage(project_id=1, role="assistant", content="Сколько стоит курс? Кто ваша аудитория?"))
+        await db.commit()
+        # Несохраненное сообщение вызывающего кода не должно попасть в БД из-за backfill
+        db.add(ChatMessage(project_id=1, role="user", content="Черновик"))
+        index = await get_question_index(db, 1)
+        await db.rollback()
+        return index.recent(), await _count(db, ChatMessage), await _count(db, AskedQuestion)
+
+    recent, messages, questions = _run(session_factory, scenario)
+    assert recent == ["Сколько стоит курс?", "Кто ваша аудитория?"]
+    assert messages == 1
+    assert questions == 2
+
+
+def test_late_commit_with_lower_id_is_loaded(session_factory):
+    async def scenario(db):
+        db.add_all([AskedQuestion(id=10, project_id=1, text="Сколько стоит курс?"), AskedQuestion(id=12, project_id=1, text="Кто ваша аудитория?")])
+        await db.commit()
+        index = await get_question_index(db, 1)
+        db.add(AskedQuestion(id=11, project_id=1, text="Как вы привлекаете клиентов?"))
+        await db.commit()
+        return (await get_question_index(db, 1)).recent(), index.last_id
+
+    recent, last_id = _run(session_factory, scenario)
+    assert "Как вы привлекаете клиентов?" in recent
+    assert len(recent) == 3
+    assert last_id == 12
+
+
+def test_near_duplicate_is_not_recorded_twice(session_factory):
+    async def scenario(db):
+        await record_asked_questions(db, 1, "Сколько стоит курс?")
+        await db.commit()
+        return await record_asked_questions(db, 1, "Сколько стоит ваш курс?")
+
+    assert _run(session_factory, scenario) == []
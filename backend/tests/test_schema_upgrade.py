@@ -0,0 +1,58 @@
+from sqlalchemy import create_engine, inspect
+
+from app.db import Base
+from app.db.schema_upgrade import upgrade_schema
+
+
+def _old_schema_engine(tmp_path):
+    """База со схемой до добавления памяти чата, индекса вопросов, загрузок и индекса истории"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+        connection.exec_driver_sql("DROP TABLE asked_questions")
+        connection.exec_driver_sql("DROP TABLE uploaded_files")
+        connection.exec_driver_sql("DROP INDEX ix_chat_messages_project_created_id")
+        connection.exec_driver_sql("ALTER TABLE projects DROP COLUMN conversation_summary")
+        connection.exec_driver_sql("ALTER TABLE projects DROP COLUMN summarized_message_id")
+        connection.exec_driver_sql("INSERT INTO users (id, email, username, hashed_password) VALUES (1, 'e@example.com', 'e', '')")
+        connection.exec_driver_sql("INSERT INTO projects (id, name, owner_id) VALUES (1, 'Проект', 1)")
+    return engine
+
+
+def test_upgrade_adds_missing_tables_columns_and_indexes(tmp_path):
+    engine = _old_schema_engine(tmp_path)
+
+    with engine.begin() as connection:
+        planned = upgrade_schema(connection, dry_run=True)
+    with engine.begin() as connection:
+        assert "asked_questions" not in inspect(connection).get_table_names()
+        applied = upgrade_schema(connection)
+
+    assert applied == planned
+    inspector = inspect(engine)
+    assert {"asked_questions", "uploaded_files"} <= set(inspector.get_table_names())
+    columns = {column["name"] for column in inspector.get_columns("projects")}
+    assert {"conversation_summary", "summarized_message_id"} <= columns
+    assert "ix_chat_messages_project_created_id" in {index["name"] for index in inspector.get_indexes("chat_messages")}
+    assert "ix_uploaded_files_project_sha256" in {index["name"] for index in inspector.get_indexes("uploaded_files")}
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT name, conversation_summary FROM projects").all() == [("Проект", None)]
+    engine.dispose()
+
+
+def test_upgrade_is_idempotent(tmp_path):
+    engine = _old_schema_engine(tmp_path)
+    with engine.begin() as connection:
+        assert upgrade_schema(connection)
+    with engine.begin() as connection:
+        assert upgrade_schema(connection) == []
+    engine.dispose()
+
+
+def test_upgrade_creates_full_schema_for_empty_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'empty.db'}")
+    with engine.begin() as connection:
+        changes = upgrade_schema(connection)
+    assert set(inspect(engine).get_table_names()) == set(Base.metadata.tables)
+    assert all(change.startswith("CREATE TABLE") for change in changes)
+    engine.dispose()
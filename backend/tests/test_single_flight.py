@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from app.services.single_flight import SingleFlight
+
+
+def test_concurrent_calls_are_executed_once():
+    flight = SingleFlight()
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return {"summary": "сводка"}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("summary", {"project_id": 1}, operation) for _ in range(3)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert results == [{"summary": "сводка"}] * 3
+    stats = flight.get_stats()
+    assert stats["operations"]["summary"] == {"executed": 1, "coalesced": 2}
+    assert stats["in_flight"] == 0
+
+
+def test_different_keys_are_not_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def run():
+        return await asyncio.gather(flight.do("summary", {"project_id": 1}, operation), flight.do("summary", {"project_id": 2}, operation))
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_every_caller_gets_its_own_copy():
+    flight = SingleFlight()
+
+    async def operation():
+        await asyncio.sleep(0.01)
+        return {"questions": ["первый"]}
+
+    async def leader():
+        result = await flight.do("questions", "key", operation)
+        # Первый изменяет свой результат до того, как присоединившиеся его получат
+        result["questions"].append("изменение первого")
+        return result
+
+    async def joiner():
+        await asyncio.sleep(0)
+        return await flight.do("questions", "key", operation)
+
+    async def run():
+        return await asyncio.gather(leader(), joiner(), joiner())
+
+    first, second, third = asyncio.run(run())
+    assert first["questions"] == ["первый", "изменение первого"]
+    assert second == third == {"questions": ["первый"]}
+    assert second is not third
+
+
+def test_cancelled_leader_does_not_cancel_operation():
+    flight = SingleFlight()
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "результат"
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do("link_fetch", "url", operation))
+        await asyncio.sleep(0)
+        joiner = asyncio.ensure_future(flight.do("link_fetch", "url", operation))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await joiner
+
+    assert asyncio.run(run()) == "результат"
+    assert len(calls) == 1
+
+
+def test_error_is_raised_to_every_caller():
+    flight = SingleFlight()
+
+    async def operation():
+        await asyncio.sleep(0.01)
+        raise ValueError("ошибка")
+
+    async def run():
+        return await asyncio.gather(*(flight.do("summary", "key", operation) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.in_flight() == 0
@@ -0,0 +1,31 @@
+import pytest
+
+from app.schemas.briefing import BriefingExtraction, BriefingTurnExtraction
+from app.services.structured_output import StructuredOutputError, gemini_response_schema, parse_structured_text
+
+
+@pytest.mark.parametrize("text", [
+    "Sure! {garbage here}",
+    '{"utp": "Лучший курс" "product_description": "abc"}',
+])
+def test_unrepairable_object_is_not_replaced_with_defaults(text):
+    with pytest.raises(StructuredOutputError):
+        parse_structured_text(text, BriefingExtraction)
+
+
+def test_truncated_object_keeps_complete_fields():
+    data, method = parse_structured_text('{"utp": "Лучший курс", "product_description": "Курс по Pyth', BriefingExtraction)
+    assert method == "repaired"
+    assert data["utp"] == "Лучший курс"
+
+
+def test_truncated_nested_array_rolls_back_to_empty_list():
+    data, method = parse_structured_text('{"utp": "Курс", "funnel_elements": [{"name"', BriefingExtraction)
+    assert method == "repaired"
+    assert data == {"utp": "Курс", "product_description": "", "funnel_elements": []}
+
+
+def test_default_factory_lists_are_not_nullable():
+    properties = gemini_response_schema(BriefingTurnExtraction)["properties"]
+    assert "nullable" not in properties["funnel_elements"]
+    assert "nullable" not in properties["follow_up_questions"]
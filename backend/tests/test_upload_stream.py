@@ -0,0 +1,125 @@
+import asyncio
+import functools
+import hashlib
+
+import pytest
+from starlette.requests import Request
+
+from app.services.upload_stream import InvalidUpload, UploadTooLarge, receive_upload
+
+BOUNDARY = "testboundary"
+
+
+def _multipart(fields):
+    """multipart-тело: fields - список (имя поля, имя файла или None, содержимое)"""
+    body = b""
+    for name, filename, content in fields:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\nContent-Type: text/plain\r\n\r\n".encode() + content + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def _request(body: bytes, chunk_size: int = 1024, content_length=True, consumed=None):
+    """Request, тело которого приходит частями по chunk_size; consumed - счетчик прочитанных частей"""
+    chunks = [body[offset:offset + chunk_size] for offset in range(0, len(body), chunk_size)] or [b""]
+    headers = [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())]
+    if content_length:
+        headers.append((b"content-length", str(len(body)).encode()))
+
+    async def receive():
+        if consumed is not None:
+            consumed.append(1)
+        chunk = chunks.pop(0) if chunks else b""
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    return Request({"type": "http", "method": "POST", "headers": headers}, receive)
+
+
+def _receive(request, **kwargs):
+    async def run():
+        upload = await receive_upload(request, **kwargs)
+        try:
+            return upload.filename, upload.size, upload.sha256, upload.read_text(), upload.spooled_to_disk
+        finally:
+            upload.close()
+
+    return asyncio.run(run())
+
+
+def test_file_field_is_received_with_size_and_sha256():
+    content = "Онлайн-курс по маркетингу".encode("utf-8") * 100
+    body = _multipart([("comment", None, b"skip me"), ("file", "brief.txt", content)])
+
+    filename, size, sha256, text, on_disk = _receive(_request(body, chunk_size=100), spool_bytes=1024)
+
+    assert filename == "brief.txt"
+    assert size == len(content)
+    assert sha256 == hashlib.sha256(content).hexdigest()
+    assert text == content.decode("utf-8")
+    assert on_disk
+
+
+def test_size_limit_is_enforced_while_streaming():
+    body = _multipart([("file", "big.txt", b"x" * 5000)])
+    consumed = []
+
+    # Без Content-Length лимит файла срабатывает по ходу приема
+    with pytest.raises(UploadTooLarge):
+        _receive(_request(body, chunk_size=500, content_length=False, consumed=consumed), max_bytes=1000)
+    assert len(consumed) < len(body) // 500
+
+
+def test_declared_content_length_is_rejected_before_reading_body():
+    body = _multipart([("file", "big.txt", b"x" * 200000)])
+    consumed = []
+
+    with pytest.raises(UploadTooLarge):
+        _receive(_request(body, consumed=consumed), max_bytes=1000)
+    assert consumed == []
+
+
+def test_missing_file_field_is_invalid():
+    body = _multipart([("document", "brief.txt", b"content")])
+
+    with pytest.raises(InvalidUpload):
+        _receive(_request(body))
+
+
+def test_non_multipart_body_is_invalid():
+    async def receive():
+        return {"type": "http.request", "body": b"{}", "more_body": False}
+
+    request = Request({"type": "http", "method": "POST", "headers": [(b"content-type", b"application/json")]}, receive)
+    with pytest.raises(InvalidUpload):
+        asyncio.run(receive_upload(request))
+
+
+def test_same_file_is_analyzed_once_per_project(fake_backend, chat_client):
+    files = {"file": ("brief.txt", "Мы продаем онлайн-курсы по Python для начинающих".encode("utf-8"), "text/plain")}
+    calls = []
+    original_generate = fake_backend.generate
+
+    async def generate(*args, **kwargs):
+        calls.append(1)
+        return await original_generate(*args, **kwargs)
+
+    fake_backend.generate = generate
+
+    first = chat_client.post("/chat/1/upload", files=files)
+    model_calls = len(calls)
+    second = chat_client.post("/chat/1/upload", files={"file": ("copy.txt", files["file"][1], "text/plain")})
+
+    assert first.status_code == 200 and not first.json().get("duplicate")
+    assert model_calls > 0
+    assert second.status_code == 200 and second.json()["duplicate"] is True
+    assert len(calls) == model_calls
+    assert "brief.txt" in second.json()["message"]["content"]
+
+
+def test_upload_over_limit_returns_413(chat_client, monkeypatch):
+    from app.api.endpoints import chat
+
+    monkeypatch.setattr(chat, "receive_upload", functools.partial(receive_upload, max_bytes=100))
+    response = chat_client.post("/chat/1/upload", files={"file": ("big.txt", b"x" * 1000, "text/plain")})
+
+    assert response.status_code == 413